@@ -4,11 +4,266 @@ from discord.ui import Modal, TextInput, View, Button, Select
 from discord import ButtonStyle, Interaction, app_commands, CategoryChannel, SelectOption, PermissionOverwrite, File
 import json
 import os
+import re
 import asyncio
 import io
+import tempfile
+import hashlib
+import gzip
+import shutil
+import datetime
+import sqlite3
+import sys
+import threading
+import time
+import bisect
+import contextlib
+import functools
+import socket
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict, deque
+import aiohttp
+from aiohttp import web
 
 CONFIG_FILE = "config.json"
 TICKET_FILE = "tickets.json"
+TICKET_JOURNAL_FILE = "tickets.journal"
+TICKET_DB_FILE = "tickets.db"
+TRANSCRIPT_DIR = "transcripts"
+SEARCH_INDEX_FILE = "search.db"
+RECONCILE_BATCH_SIZE = 500
+STARTED_AT = time.monotonic()
+COMMAND_SYNC_FILE = "command_sync.json"
+TICKET_TOPIC_OWNER = re.compile(r"\((\d+)\) \| Section: ")
+DM_CLAIM_TTL = 600
+
+class BotMetrics:
+    """In-process counters and latency histograms, exported in the Prometheus text format.
+
+    Updates may come from executor threads (JSON I/O), so they are guarded
+    by a lock. Gauges are pulled from registered collectors at render time.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._ratelimit_listeners = []
+        self._lock = threading.Lock()
+        self._runner = None
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observes the duration of the with-block in histogram name, labelled ok/error."""
+        start = time.perf_counter()
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        finally:
+            self.observe(name, time.perf_counter() - start, status=status, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator form of timer() for coroutine functions, including app command callbacks."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_collector(self, collector):
+        """Registers a callable returning (name, labels, value) gauge samples."""
+        self._collectors.append(collector)
+
+    def add_ratelimit_listener(self, listener):
+        """Registers a callable(url, retry_after) told about every 429 a REST call gets."""
+        self._ratelimit_listeners.append(listener)
+
+    def trace_config(self):
+        """aiohttp tracing hooks that count discord.py REST calls and 429s per route."""
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.start = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            route = self.route_label(params.method, params.url)
+            status = params.response.status
+            self.inc("discord_rest_requests_total", route=route, status=status)
+            if status == 429:
+                self.inc("discord_rest_ratelimited_total", route=route)
+                try:
+                    retry_after = float(params.response.headers.get("Retry-After", 0))
+                except ValueError:
+                    retry_after = 0.0
+                for listener in self._ratelimit_listeners:
+                    listener(params.url, retry_after)
+            self.observe("discord_rest_request_seconds", time.perf_counter() - context.start, route=route)
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        return trace
+
+    @staticmethod
+    def route_label(method, url):
+        """Collapses ids, tokens and emoji in a REST path so each route is a single label."""
+        parts = url.path.split("/")
+        if len(parts) > 2 and parts[1] == "api" and parts[2].startswith("v"):
+            parts = [""] + parts[3:]
+        route = []
+        for i, part in enumerate(parts):
+            if part.isdigit():
+                part = "{id}"
+            elif i >= 2 and parts[i - 2] in ("webhooks", "interactions"):
+                part = "{token}"
+            elif i >= 1 and parts[i - 1] == "reactions":
+                part = "{emoji}"
+            route.append(part)
+        return f"{method} {'/'.join(route)}"
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, v in labels)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, ([*h[0]], h[1], h[2])) for key, h in self._histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), (counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.BUCKETS + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        gauges = [("bot_uptime_seconds", {}, time.time() - self.started_at)]
+        for collector in self._collectors:
+            try:
+                gauges.extend(collector())
+            except Exception as e:
+                print(f"❌ Error collecting metrics: {e}")
+        for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{self._format_labels(self._key(name, labels)[1])} {value}")
+        return "\n".join(lines) + "\n"
+
+    def counter_totals(self, name, by):
+        """Sums counter name grouped by the value of label by."""
+        totals = {}
+        with self._lock:
+            for (counter_name, labels), value in self._counters.items():
+                if counter_name == name:
+                    group = dict(labels).get(by)
+                    totals[group] = totals.get(group, 0) + value
+        return totals
+
+    def histogram_summary(self, name, by):
+        """Per value of label by: count, mean and interpolated p50/p99 in milliseconds."""
+        merged = {}
+        with self._lock:
+            for (histogram_name, labels), (counts, total, count) in self._histograms.items():
+                if histogram_name != name:
+                    continue
+                group = merged.setdefault(dict(labels).get(by), [[0] * len(counts), 0.0, 0])
+                group[0] = [a + b for a, b in zip(group[0], counts)]
+                group[1] += total
+                group[2] += count
+        return {
+            key: {
+                "count": count,
+                "avg_ms": round(total / count * 1000, 1),
+                "p50_ms": round(self._quantile(counts, count, 0.5) * 1000, 1),
+                "p99_ms": round(self._quantile(counts, count, 0.99) * 1000, 1)
+            } for key, (counts, total, count) in merged.items() if count
+        }
+
+    def _quantile(self, counts, count, q):
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.BUCKETS[i - 1] if i else 0.0
+                upper = self.BUCKETS[i] if i < len(self.BUCKETS) else self.BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.BUCKETS[-1]
+
+    async def start_server(self, host, port):
+        """Serves render() on http://host:port/metrics; does nothing if already running."""
+        if self._runner is not None:
+            return
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain")
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        self._runner = runner
+        print(f"📈 Metrics endpoint listening on http://{host}:{port}/metrics")
+
+metrics = BotMetrics()
+
+def resident_memory_bytes():
+    """Current resident set size of this process, or the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _format_memory(value):
+    return f"{value / (1024 * 1024):.1f} MB" if value else "unknown"
+
+def _json_metric_file(filename):
+    name = os.path.basename(filename)
+    return "export_state" if name.endswith(".export.json") else name
 
 def load_json(filename, default_data=None):
     """Loads data from a JSON file."""
@@ -16,7 +271,7 @@ def load_json(filename, default_data=None):
         default_data = {}
     if os.path.exists(filename):
         try:
-            with open(filename, "r", encoding='utf-8') as f:
+            with metrics.timer("json_io_seconds", op="load", file=_json_metric_file(filename)), open(filename, "r", encoding='utf-8') as f:
                 content = f.read()
                 if not content:
                     return default_data
@@ -37,13 +292,2330 @@ def save_json(filename, data):
             data_to_save = {str(k): v for k, v in data.items()}
         else:
             data_to_save = data
-        with open(filename, "w", encoding='utf-8') as f:
-            json.dump(data_to_save, f, indent=4, ensure_ascii=False)
+        temp_filename = f"{filename}.tmp"
+        with metrics.timer("json_io_seconds", op="save", file=_json_metric_file(filename)):
+            with open(temp_filename, "w", encoding='utf-8') as f:
+                json.dump(data_to_save, f, indent=4, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_filename, filename)
         return True
     except Exception as e:
         print(f"❌ Error saving {filename}: {e}")
         return False
 
+class Lease:
+    """Handle yielded by KeyedLocks.hold(); lost turns True once a LeaseLocks lease stops being ours."""
+    __slots__ = ("name", "lost")
+
+    def __init__(self, name):
+        self.name = name
+        self.lost = False
+
+    def check(self):
+        """Raises LeaseLost if the lease was lost; call it before each step that must not run without it."""
+        if self.lost:
+            raise LeaseLost(f"lease {self.name} was lost while held")
+
+class KeyedLocks:
+    """asyncio.Lock per key, created on first use and dropped once nobody holds or waits for it.
+
+    Handlers lock only the user, channel or section they touch, so unrelated
+    tickets keep running concurrently. hold() yields a Lease, which a local
+    lock never loses; before_release is only used by LeaseLocks.
+    """
+    def __init__(self):
+        self._locks = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key, before_release=None):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield Lease(key)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def locked(self, key):
+        entry = self._locks.get(key)
+        return entry is not None and entry[0].locked()
+
+    def __len__(self):
+        return len(self._locks)
+
+class LeaseLocks(KeyedLocks):
+    """KeyedLocks that also take a lease in the shared key-value service, making each key exclusive across processes.
+
+    The local lock is taken first, so a process asks for a lease at most once
+    per key. While held the lease is renewed every ttl/3; on_acquired runs
+    right after it is granted (to catch up on other processes' writes) and
+    the holder's before_release right before it is returned (to flush the
+    store it wrote to), so the next holder always sees what the previous one
+    did. If the lease is lost while held (taken over, or not renewed before
+    it expired) the yielded Lease is marked lost. Nothing is interrupted:
+    the holder calls lease.check() before each step that needs exclusivity
+    and gets LeaseLost there, at a point where it can clean up.
+    """
+    def __init__(self, kv, owner, ttl=15.0, on_acquired=None):
+        super().__init__()
+        self.kv = kv
+        self.owner = owner
+        self.ttl = ttl
+        self.on_acquired = on_acquired
+
+    @staticmethod
+    def lease_name(key):
+        parts = key if isinstance(key, tuple) else (key,)
+        return "lock/" + ":".join(str(part) for part in parts)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key, before_release=None):
+        async with super().hold(key):
+            loop = asyncio.get_running_loop()
+            lease = Lease(self.lease_name(key))
+            delay = 0.05
+            with metrics.timer("lease_wait_seconds"):
+                while not await loop.run_in_executor(None, self.kv.acquire, lease.name, self.owner, self.ttl):
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 1.0)
+            renew_task = loop.create_task(self._renew(lease))
+            try:
+                if self.on_acquired:
+                    await self.on_acquired()
+                yield lease
+            finally:
+                try:
+                    if before_release:
+                        await before_release()
+                finally:
+                    renew_task.cancel()
+                    try:
+                        await loop.run_in_executor(None, self.kv.release, lease.name, self.owner)
+                    except KvError as e:
+                        print(f"⚠️ Could not release lease {lease.name}; it expires in {self.ttl:.0f}s: {e}")
+
+    async def _renew(self, lease):
+        loop = asyncio.get_running_loop()
+        renewed_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                if await loop.run_in_executor(None, self.kv.acquire, lease.name, self.owner, self.ttl):
+                    renewed_at = time.monotonic()
+                    continue
+                print(f"⚠️ Lease {lease.name} was taken over by another process while still held.")
+            except KvError as e:
+                if time.monotonic() - renewed_at + self.ttl / 3 < self.ttl:
+                    print(f"⚠️ Could not renew lease {lease.name}: {e}")
+                    continue
+                print(f"⚠️ Lease {lease.name} expires before it can be renewed: {e}")
+            metrics.inc("lease_lost_total")
+            lease.lost = True
+            return
+
+class JsonTicketBackend:
+    """Stores open tickets in TICKET_FILE.
+
+    With a journal_file, each change is appended as one fsync'd JSON line and
+    replayed over the snapshot on load; the snapshot is rewritten and the
+    journal truncated once it grows past compact_bytes.
+    """
+    def __init__(self, filename, journal_file=None, compact_bytes=256 * 1024):
+        self.filename = filename
+        self.journal_file = journal_file
+        self.compact_bytes = compact_bytes
+        self._journal_size = 0
+
+    @property
+    def needs_snapshot(self):
+        return not self.journal_file
+
+    def load(self):
+        data = load_json(self.filename, {})
+        tickets = {str(k): v for k, v in data.items()} if isinstance(data, dict) else {}
+        if self.journal_file:
+            replayed = self._replay_journal(tickets)
+            if replayed:
+                print(f"📜 Replayed {replayed} journal entries from {self.journal_file}.")
+        return tickets
+
+    def _replay_journal(self, tickets):
+        if not os.path.exists(self.journal_file):
+            self._journal_size = 0
+            return 0
+        replayed = 0
+        with open(self.journal_file, "rb") as f:
+            data = f.read()
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            # A crash mid-append leaves a partial last line; cut it off so the next append starts on a fresh line.
+            print(f"⚠️ Warning: Dropping an incomplete entry ({len(data) - complete} bytes) at the end of {self.journal_file}.")
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(complete)
+                f.flush()
+                os.fsync(f.fileno())
+        for line_no, line in enumerate(data[:complete].decode("utf-8", errors="replace").splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"⚠️ Warning: Skipping corrupt line {line_no} in {self.journal_file}.")
+                continue
+            key = str(entry.get("key"))
+            if entry.get("op") == "set" and isinstance(entry.get("value"), dict):
+                tickets[key] = entry["value"]
+            elif entry.get("op") == "del":
+                tickets.pop(key, None)
+            else:
+                continue
+            replayed += 1
+        self._journal_size = os.path.getsize(self.journal_file)
+        return replayed
+
+    def write(self, changes, snapshot=None):
+        if not self.journal_file:
+            return save_json(self.filename, snapshot)
+        lines = []
+        for op, key, ticket_info, status, closed_at in changes:
+            if op == "set":
+                entry = {"op": "set", "key": key, "value": ticket_info}
+            else:
+                entry = {"op": "del", "key": key, "status": status}
+            lines.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        try:
+            payload = "".join(lines).encode("utf-8")
+            with open(self.journal_file, "ab") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_size += len(payload)
+            return True
+        except Exception as e:
+            print(f"❌ Error appending to {self.journal_file}: {e}")
+            return False
+
+    def needs_compaction(self):
+        return bool(self.journal_file) and self._journal_size >= self.compact_bytes
+
+    def compact(self, snapshot):
+        if not save_json(self.filename, snapshot):
+            return False
+        try:
+            with open(self.journal_file, "wb") as f:
+                os.fsync(f.fileno())
+            self._journal_size = 0
+            return True
+        except Exception as e:
+            print(f"❌ Error truncating {self.journal_file}: {e}")
+            return False
+
+    def shutdown(self, changes, snapshot):
+        if self.journal_file:
+            return self.compact(snapshot) if changes or self._journal_size else True
+        return save_json(self.filename, snapshot) if changes else True
+
+class SqliteTicketBackend:
+    """Stores tickets in SQLite, keeping closed tickets as history instead of deleting them."""
+    needs_snapshot = False
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tickets (
+            channel_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            category_key TEXT,
+            status TEXT NOT NULL DEFAULT 'open',
+            opened_at REAL,
+            closed_at REAL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_tickets_user ON tickets (user_id, status);
+        CREATE INDEX IF NOT EXISTS idx_tickets_category ON tickets (category_key, status);
+        CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets (status);
+        CREATE INDEX IF NOT EXISTS idx_tickets_opened_at ON tickets (opened_at);
+        CREATE INDEX IF NOT EXISTS idx_tickets_closed_at ON tickets (closed_at);
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def load(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT channel_id, data FROM tickets WHERE status = 'open'").fetchall()
+        tickets = {}
+        for channel_id, data in rows:
+            try:
+                tickets[channel_id] = json.loads(data)
+            except json.JSONDecodeError:
+                print(f"⚠️ Warning: Skipping ticket {channel_id} with invalid data in {self.filename}.")
+        return tickets
+
+    def write(self, changes, snapshot=None):
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    for op, key, ticket_info, status, closed_at in changes:
+                        data = json.dumps(ticket_info, ensure_ascii=False)
+                        if op == "set":
+                            conn.execute(
+                                "INSERT INTO tickets (channel_id, user_id, category_key, status, opened_at, closed_at, data) "
+                                "VALUES (?, ?, ?, 'open', ?, NULL, ?) "
+                                "ON CONFLICT(channel_id) DO UPDATE SET user_id = excluded.user_id, category_key = excluded.category_key, "
+                                "status = 'open', opened_at = excluded.opened_at, closed_at = NULL, data = excluded.data",
+                                (key, ticket_info.get("user_id"), ticket_info.get("category_key"), ticket_info.get("opened_at"), data)
+                            )
+                        else:
+                            conn.execute(
+                                "INSERT INTO tickets (channel_id, user_id, category_key, status, opened_at, closed_at, data) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                                "ON CONFLICT(channel_id) DO UPDATE SET status = excluded.status, closed_at = excluded.closed_at",
+                                (key, ticket_info.get("user_id"), ticket_info.get("category_key"), status, ticket_info.get("opened_at"), closed_at, data)
+                            )
+            return True
+        except sqlite3.Error as e:
+            print(f"❌ Error writing tickets to {self.filename}: {e}")
+            return False
+
+    def history(self, channel_id):
+        """(ticket info, closed_at) of a ticket in any status, or (None, None) if it was never stored here."""
+        try:
+            with self._lock:
+                row = self._connect().execute("SELECT data, closed_at FROM tickets WHERE channel_id = ?", (str(channel_id),)).fetchone()
+            return (json.loads(row[0]), row[1]) if row else (None, None)
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            print(f"❌ Error reading ticket {channel_id} from {self.filename}: {e}")
+            return None, None
+
+    def needs_compaction(self):
+        return False
+
+    def compact(self, snapshot):
+        return True
+
+    def shutdown(self, changes, snapshot):
+        saved = self.write(changes) if changes else True
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        return saved
+
+    def import_json(self, filename, journal_file=None):
+        """One-shot import of open tickets from a JSON store; existing rows are left untouched."""
+        tickets = JsonTicketBackend(filename, journal_file=journal_file).load()
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    before = conn.total_changes
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO tickets (channel_id, user_id, category_key, status, opened_at, closed_at, data) "
+                        "VALUES (?, ?, ?, 'open', ?, NULL, ?)",
+                        [(key, info.get("user_id"), info.get("category_key"), info.get("opened_at"), json.dumps(info, ensure_ascii=False))
+                         for key, info in tickets.items() if isinstance(info, dict)]
+                    )
+                    return conn.total_changes - before
+        except sqlite3.Error as e:
+            print(f"❌ Error importing {filename} into {self.filename}: {e}")
+            return None
+
+class KvError(Exception):
+    """The shared key-value service could not be reached or gave an unexpected answer."""
+
+class LeaseLost(KvError):
+    """Raised by Lease.check() inside a LeaseLocks.hold() block whose lease was lost."""
+
+class KvClient:
+    """Blocking client for the shared key-value service (see kv_server.py for the protocol).
+
+    Every call is a plain HTTP request, so callers on the event loop run it
+    in an executor. Versioned writes are compare-and-set: version=0 only
+    creates, version=n only replaces version n.
+    """
+    def __init__(self, url, timeout=5.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method, path, payload=None, timeout=None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={"Content-Type": "application/json"})
+        try:
+            try:
+                with urllib.request.urlopen(request, timeout=timeout or self.timeout) as response:
+                    return response.status, json.loads(response.read() or b"{}")
+            except urllib.error.HTTPError as e:
+                if e.code not in (404, 409):
+                    raise KvError(f"{method} {path}: HTTP {e.code}") from e
+                return e.code, json.loads(e.read() or b"{}")
+        except (OSError, ValueError) as e:
+            raise KvError(f"{method} {path}: {e}") from e
+
+    @staticmethod
+    def _path(route, key):
+        return f"/{route}/{urllib.parse.quote(key, safe='/')}"
+
+    def get(self, key):
+        """(value, version) of a key, or (None, 0) if it does not exist."""
+        status, body = self._request("GET", self._path("kv", key))
+        return (body.get("value"), body.get("version", 0)) if status == 200 else (None, 0)
+
+    def put(self, key, value, version=None, ttl=None):
+        """(written, version); on a version conflict written is False and version is the current one."""
+        status, body = self._request("PUT", self._path("kv", key), {"value": value, "version": version, "ttl": ttl})
+        return status == 200, body.get("version", 0)
+
+    def delete(self, key, version=None):
+        query = f"?version={version}" if version is not None else ""
+        status, _ = self._request("DELETE", self._path("kv", key) + query)
+        return status == 200
+
+    def scan(self, prefix):
+        """({key: (value, version)} of every key under prefix, current change sequence)."""
+        _, body = self._request("GET", f"/scan?prefix={urllib.parse.quote(prefix, safe='')}")
+        return {item["key"]: (item["value"], item["version"]) for item in body.get("items", [])}, body.get("seq", 0)
+
+    def acquire(self, name, owner, ttl):
+        """Takes or renews a lease; False while another owner holds it."""
+        status, _ = self._request("POST", self._path("lease", name), {"owner": owner, "ttl": ttl})
+        return status == 200
+
+    def release(self, name, owner):
+        self._request("DELETE", self._path("lease", name) + f"?owner={urllib.parse.quote(owner, safe='')}")
+
+    def changes(self, since=None, timeout=0):
+        """Writes after since, waiting up to timeout seconds for one; {"reset": true} if since is too old."""
+        query = f"?since={since if since is not None else ''}&timeout={timeout}"
+        _, body = self._request("GET", "/changes" + query, timeout=timeout + self.timeout)
+        return body
+
+class KvSync:
+    """Follows the shared store's change feed and hands other processes' writes to the local caches.
+
+    Handlers subscribe to a key prefix and get (rest of key, value, version)
+    with value None for deletes. The feed position is taken when the watcher
+    is created, before any store loads, so nothing written in between is
+    missed. If this process falls out of the server's change history the
+    reset handlers reload everything.
+    """
+    def __init__(self, kv, poll_timeout=25.0):
+        self.kv = kv
+        self.poll_timeout = poll_timeout
+        self.seq = kv.changes().get("seq", 0)
+        self._handlers = []
+        self._reset_handlers = []
+        self._task = None
+
+    def subscribe(self, prefix, handler):
+        self._handlers.append((prefix, handler))
+
+    def on_reset(self, handler):
+        self._reset_handlers.append(handler)
+
+    async def _apply(self, result):
+        if result.get("reset"):
+            print(f"⚠️ Fell behind the shared store's change feed (at {self.seq}, now {result.get('seq')}). Reloading shared state.")
+            self.seq = result.get("seq", self.seq)
+            for handler in self._reset_handlers:
+                await handler()
+            return
+        for change in result.get("changes", []):
+            if change["seq"] <= self.seq:
+                continue
+            self.seq = change["seq"]
+            for prefix, handler in self._handlers:
+                if change["key"].startswith(prefix):
+                    handler(change["key"][len(prefix):], change.get("value"), change.get("version", 0))
+        self.seq = max(self.seq, result.get("seq", self.seq))
+        metrics.inc("kv_changes_total", len(result.get("changes", [])))
+
+    async def catch_up(self):
+        """Applies every change written so far without waiting for the long poll."""
+        result = await asyncio.get_running_loop().run_in_executor(None, self.kv.changes, self.seq, 0)
+        await self._apply(result)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                result = await loop.run_in_executor(None, self.kv.changes, self.seq, self.poll_timeout)
+                await self._apply(result)
+            except KvError as e:
+                print(f"⚠️ Lost the shared store's change feed: {e}. Retrying in 1s.")
+                await asyncio.sleep(1)
+
+class KvTicketBackend:
+    """Stores open tickets as tickets/<guild_id>/<channel_id> keys in the shared key-value service.
+
+    Closing a ticket deletes its key, like the JSON store; processes sharing
+    the service learn about each other's writes through KvSync.
+    """
+    needs_snapshot = False
+
+    def __init__(self, kv, guild_id):
+        self.kv = kv
+        self.prefix = f"tickets/{guild_id}/"
+        self.filename = f"{kv.url}/kv/{self.prefix}"
+
+    def load(self):
+        items, _ = self.kv.scan(self.prefix)
+        return {key[len(self.prefix):]: value for key, (value, _) in items.items() if isinstance(value, dict)}
+
+    def write(self, changes, snapshot=None):
+        try:
+            for op, key, ticket_info, status, closed_at in changes:
+                if op == "set":
+                    self.kv.put(self.prefix + key, ticket_info)
+                else:
+                    self.kv.delete(self.prefix + key)
+            return True
+        except KvError as e:
+            print(f"❌ Error writing tickets to {self.filename}: {e}")
+            return False
+
+    def needs_compaction(self):
+        return False
+
+    def compact(self, snapshot):
+        return True
+
+    def shutdown(self, changes, snapshot):
+        return self.write(changes) if changes else True
+
+    def import_json(self, filename, journal_file=None):
+        """One-shot import of open tickets from a JSON store; keys that already exist are left untouched."""
+        tickets = JsonTicketBackend(filename, journal_file=journal_file).load()
+        imported = 0
+        try:
+            for key, ticket_info in tickets.items():
+                if isinstance(ticket_info, dict) and self.kv.put(self.prefix + key, ticket_info, version=0)[0]:
+                    imported += 1
+        except KvError as e:
+            print(f"❌ Error importing {filename} into {self.filename}: {e}")
+            return None
+        return imported
+
+class WriteBehind:
+    """Background flushing for the write-behind buffers (tickets, transcripts, gateway captures).
+
+    schedule() keeps at most one flush task running. The task waits out the
+    owner's batching window, calls flush() and repeats while has_pending()
+    is still true, so changes made while a write sits in the executor go out
+    without waiting for the next change. A flush that returns False (a
+    failed write the owner requeued) ends the run; the next change retries.
+    """
+    def __init__(self, flush, has_pending, wait):
+        self._flush = flush
+        self._has_pending = has_pending
+        self._wait = wait
+        self._task = None
+        self._lock = None
+
+    @property
+    def lock(self):
+        """Serializes flushes with anything else that must not overlap a write (compaction, finalizing)."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def schedule(self):
+        if self._task and not self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self._wait()
+            if await self._flush() is False or not self._has_pending():
+                return
+
+class TicketStore:
+    """Authoritative in-memory view of open tickets, persisted in the background through a storage backend.
+
+    With an owner_index the store also registers each ticket there under
+    its scope (the guild id), so owners can be looked up across stores.
+    """
+    def __init__(self, backend, flush_delay=1.0, owner_index=None, scope=None):
+        self.backend = backend
+        self.flush_delay = flush_delay
+        self.owner_index = owner_index
+        self.scope = scope
+        self._tickets = {}
+        self._by_user = {}
+        self._dirty = set()
+        self._closed = {}
+        self._flusher = WriteBehind(self.flush, lambda: bool(self._dirty), self._wait_to_flush)
+        self._compact_task = None
+
+    def load(self):
+        self._tickets = self.backend.load()
+        self._rebuild_indexes()
+        self._dirty.clear()
+        self._closed.clear()
+        return len(self._tickets)
+
+    def _rebuild_indexes(self):
+        if self.owner_index is not None:
+            for user_id, keys in self._by_user.items():
+                for key in keys:
+                    self.owner_index.discard(user_id, self.scope, key)
+        self._by_user = {}
+        for key, ticket_info in self._tickets.items():
+            self._index(key, ticket_info)
+
+    def _index(self, key, ticket_info):
+        if not isinstance(ticket_info, dict):
+            return
+        user_id = ticket_info.get("user_id")
+        if user_id is not None:
+            self._by_user.setdefault(user_id, set()).add(key)
+            if self.owner_index is not None:
+                self.owner_index.add(user_id, self.scope, key)
+
+    def _unindex(self, key, ticket_info):
+        if not isinstance(ticket_info, dict):
+            return
+        if self.owner_index is not None:
+            self.owner_index.discard(ticket_info.get("user_id"), self.scope, key)
+        user_id = ticket_info.get("user_id")
+        keys = self._by_user.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[user_id]
+
+    def channels_for_user(self, user_id):
+        return list(self._by_user.get(user_id, ()))
+
+    def get(self, channel_id):
+        return self._tickets.get(str(channel_id))
+
+    def items(self):
+        return list(self._tickets.items())
+
+    def __contains__(self, channel_id):
+        return str(channel_id) in self._tickets
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def set(self, channel_id, ticket_info):
+        key = str(channel_id)
+        if key in self._tickets:
+            self._unindex(key, self._tickets[key])
+        self._tickets[key] = ticket_info
+        self._closed.pop(key, None)
+        self._index(key, ticket_info)
+        self._mark_dirty(key)
+
+    def remove(self, channel_id, status="closed"):
+        """Drops a ticket from the open set; backends that keep history record it with the given status."""
+        key = str(channel_id)
+        ticket_info = self._tickets.pop(key, None)
+        if ticket_info is None:
+            return False
+        self._unindex(key, ticket_info)
+        self._closed[key] = (ticket_info, status, time.time())
+        self._mark_dirty(key)
+        return True
+
+    def apply_remote(self, channel_id, ticket_info):
+        """Takes another process's write (None for a close) without queueing it again; unflushed local changes win."""
+        key = str(channel_id)
+        if key in self._dirty:
+            return False
+        old_info = self._tickets.pop(key, None)
+        if old_info is not None:
+            self._unindex(key, old_info)
+        if ticket_info is not None:
+            self._tickets[key] = ticket_info
+            self._index(key, ticket_info)
+        return old_info is not None or ticket_info is not None
+
+    def replace_remote(self, tickets):
+        """Brings the store in line with a full reload from a shared backend, keeping unflushed local changes."""
+        for key in set(self._tickets) | set(tickets):
+            self.apply_remote(key, tickets.get(key))
+
+    def _mark_dirty(self, key):
+        self._dirty.add(key)
+        self._flusher.schedule()
+
+    async def _wait_to_flush(self):
+        await asyncio.sleep(self.flush_delay if self.backend.needs_snapshot else 0)
+
+    def _snapshot(self):
+        return {k: dict(v) for k, v in self._tickets.items()}
+
+    def _take_changes(self):
+        changes = []
+        for key in self._dirty:
+            if key in self._tickets:
+                changes.append(("set", key, dict(self._tickets[key]), None, None))
+            else:
+                ticket_info, status, closed_at = self._closed.pop(key, ({}, "closed", time.time()))
+                changes.append(("close", key, dict(ticket_info), status, closed_at))
+        self._dirty.clear()
+        return changes
+
+    def _requeue(self, changes):
+        for op, key, ticket_info, status, closed_at in changes:
+            if op == "close" and key not in self._tickets:
+                self._closed.setdefault(key, (ticket_info, status, closed_at))
+            self._dirty.add(key)
+
+    async def flush(self):
+        """Writes pending changes off the event loop, coalescing everything dirty so far."""
+        async with self._flusher.lock:
+            if not self._dirty:
+                return True
+            changes = self._take_changes()
+            snapshot = self._snapshot() if self.backend.needs_snapshot else None
+            loop = asyncio.get_running_loop()
+            with metrics.timer("ticket_store_flush_seconds"):
+                saved = await loop.run_in_executor(None, self.backend.write, changes, snapshot)
+            if not saved:
+                self._requeue(changes)
+            elif self.backend.needs_compaction():
+                if not self._compact_task or self._compact_task.done():
+                    self._compact_task = loop.create_task(self.compact())
+            return saved
+
+    async def compact(self):
+        """Folds the backend's journal into a fresh snapshot."""
+        async with self._flusher.lock:
+            snapshot = self._snapshot()
+            compacted = await asyncio.get_running_loop().run_in_executor(None, self.backend.compact, snapshot)
+        if compacted:
+            print(f"🗜️ Compacted ticket journal into {self.backend.filename} ({len(snapshot)} entries).")
+        return compacted
+
+    def flush_sync(self):
+        """Blocking flush used at shutdown, after the event loop has stopped."""
+        changes = self._take_changes()
+        if self.backend.shutdown(changes, self._snapshot()):
+            return True
+        self._requeue(changes)
+        return False
+
+class TicketOwnerIndex:
+    """user id -> (scope, channel key) of every open ticket, shared by the TicketStores of all guilds."""
+    def __init__(self):
+        self._by_user = {}
+
+    def add(self, user_id, scope, key):
+        self._by_user.setdefault(user_id, set()).add((scope, key))
+
+    def discard(self, user_id, scope, key):
+        entries = self._by_user.get(user_id)
+        if entries is not None:
+            entries.discard((scope, key))
+            if not entries:
+                del self._by_user[user_id]
+
+    def lookup(self, user_id):
+        return list(self._by_user.get(user_id, ()))
+
+    def __len__(self):
+        return len(self._by_user)
+
+class ConfigCache:
+    """Parsed config.json with precomputed category lookups.
+
+    The file's mtime is checked at most every check_interval seconds, so hot
+    paths like the category picker normally touch no disk at all.
+    """
+    def __init__(self, filename, check_interval=5.0):
+        self.filename = filename
+        self.check_interval = check_interval
+        self.data = {}
+        self.categories = {}
+        self.archive_category_ids = frozenset()
+        self.overflow_owners = {}
+        self.select_options = []
+        self._mtime = None
+        self._checked_at = 0.0
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return None
+
+    def _apply(self, data):
+        categories = {}
+        archive_category_ids = set()
+        overflow_owners = {}
+        raw_categories = data.get("active_categories") or {}
+        if not isinstance(raw_categories, dict):
+            print(f"⚠️ Warning: active_categories in {self.filename} is not an object. Ignoring.")
+            raw_categories = {}
+        for key, cat_info in raw_categories.items():
+            if not isinstance(cat_info, dict):
+                print(f"⚠️ Warning: Category '{key}' in {self.filename} is not an object. Ignoring.")
+                continue
+            parsed = dict(cat_info)
+            for id_field in ("category_id", "archive_category_id"):
+                raw_id = cat_info.get(id_field)
+                try:
+                    parsed[id_field] = int(raw_id) if raw_id else None
+                except (ValueError, TypeError):
+                    print(f"⚠️ Warning: Invalid {id_field} '{raw_id}' for category '{key}' in {self.filename}.")
+                    parsed[id_field] = None
+            for list_field in ("overflow_category_ids", "archive_overflow_category_ids"):
+                overflow_ids = []
+                for raw_id in cat_info.get(list_field) or []:
+                    try:
+                        overflow_ids.append(int(raw_id))
+                    except (ValueError, TypeError):
+                        print(f"⚠️ Warning: Invalid id '{raw_id}' in {list_field} for category '{key}' in {self.filename}.")
+                parsed[list_field] = overflow_ids
+                for overflow_id in overflow_ids:
+                    overflow_owners[overflow_id] = (key, list_field)
+            if parsed["archive_category_id"]:
+                archive_category_ids.add(parsed["archive_category_id"])
+            archive_category_ids.update(parsed["archive_overflow_category_ids"])
+            categories[key] = parsed
+
+        if categories:
+            select_options = [SelectOption(label=cat_info.get("name", key), value=key, emoji=cat_info.get("emoji")) for key, cat_info in categories.items()]
+        else:
+            select_options = [SelectOption(label="لا توجد أقسام متاحة حالياً", value="no_category", emoji="⚠️")]
+
+        self.data = data
+        self.categories = categories
+        self.archive_category_ids = frozenset(archive_category_ids)
+        self.overflow_owners = overflow_owners
+        self.select_options = select_options
+
+    def reload(self):
+        """Re-reads the file unconditionally. Returns the number of categories loaded."""
+        mtime = self._file_mtime()
+        data = load_json(self.filename, {})
+        self._apply(data if isinstance(data, dict) else {})
+        self._mtime = mtime
+        self._checked_at = time.monotonic()
+        return len(self.categories)
+
+    def refresh(self):
+        """Reloads only if the file's mtime changed since the last load."""
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+        mtime = self._file_mtime()
+        if mtime == self._mtime:
+            return False
+        print(f"🔄 {self.filename} changed on disk. Reloading configuration.")
+        self.reload()
+        return True
+
+    def get(self):
+        self.refresh()
+        return self
+
+    def save(self, data):
+        """Writes new config data and swaps it in without waiting for the mtime check."""
+        if not save_json(self.filename, data):
+            return False
+        self._saved(data)
+        return True
+
+    def _saved(self, data):
+        self._apply(data)
+        self._mtime = self._file_mtime()
+        self._checked_at = time.monotonic()
+
+    async def reload_async(self):
+        """reload() for callers on the event loop; KvConfigCache fetches the shared sections off the loop here."""
+        return self.reload()
+
+    async def save_async(self, data):
+        """save() for callers on the event loop: the file is written in an executor, the new data swapped in on the loop."""
+        if not await asyncio.get_running_loop().run_in_executor(None, save_json, self.filename, data):
+            return False
+        self._saved(data)
+        return True
+
+class KvConfigCache(ConfigCache):
+    """ConfigCache whose sections (active_categories) live in the shared key-value service under config/<guild_id>.
+
+    Everything else still comes from the local file. The shared key is
+    seeded from the file the first time any process starts. reload() and
+    refresh() only re-read the local file and merge the sections last seen,
+    which KvSync keeps current through apply_remote(); anything that talks to
+    the service goes through reload_async() and save_async() in an executor.
+    Saving is a compare-and-set against the version last seen: if another
+    process changed the sections in the meantime nothing is written, the
+    cache picks up their version and the save returns False like a failed
+    disk write.
+    """
+    SHARED_KEYS = ("active_categories",)
+
+    def __init__(self, filename, kv, guild_id, check_interval=5.0):
+        super().__init__(filename, check_interval)
+        self.kv = kv
+        self.key = f"config/{guild_id}"
+        self.shared = None
+        self.version = 0
+
+    def _read_local(self):
+        local = load_json(self.filename, {})
+        return local if isinstance(local, dict) else {}
+
+    def _shared_part(self, data):
+        return {k: data[k] for k in self.SHARED_KEYS if k in data}
+
+    def _merge(self, local, shared):
+        data = {k: v for k, v in local.items() if k not in self.SHARED_KEYS}
+        data.update(shared or {})
+        return data
+
+    def _use_shared(self, shared, version):
+        if version < self.version:
+            return False
+        self.shared, self.version = shared or {}, version
+        return True
+
+    def pull(self):
+        """Blocking: (sections, version) from the service, seeding the key from the local file if it does not exist yet."""
+        shared, version = self.kv.get(self.key)
+        if version == 0:
+            shared = self._shared_part(self._read_local())
+            created, version = self.kv.put(self.key, shared, version=0)
+            if not created:
+                shared, version = self.kv.get(self.key)
+        return shared, version
+
+    def load_shared(self):
+        """Blocking first load, used before the event loop runs."""
+        try:
+            self._use_shared(*self.pull())
+        except KvError as e:
+            print(f"❌ Error reading {self.key} from the shared store: {e}. Using sections from {self.filename}.")
+        return self.reload()
+
+    def reload(self):
+        mtime = self._file_mtime()
+        local = self._read_local()
+        self._apply(self._merge(local, self.shared if self.shared is not None else self._shared_part(local)))
+        self._mtime = mtime
+        self._checked_at = time.monotonic()
+        return len(self.categories)
+
+    async def reload_async(self):
+        try:
+            self._use_shared(*await asyncio.get_running_loop().run_in_executor(None, self.pull))
+        except KvError as e:
+            print(f"❌ Error reading {self.key} from the shared store: {e}. Keeping the sections last seen.")
+        return self.reload()
+
+    def apply_remote(self, shared, version):
+        if version <= self.version:
+            return False
+        self._use_shared(shared, version)
+        self._apply(self._merge(self.data, self.shared))
+        return True
+
+    def _put_shared(self, shared, version):
+        saved, new_version = self.kv.put(self.key, shared, version=version)
+        if saved:
+            return True, shared, new_version
+        current, current_version = self.kv.get(self.key)
+        return False, current, current_version
+
+    def _finish_save(self, data, shared, result):
+        saved, current, version = result
+        if not saved:
+            print(f"⚠️ {self.key} was changed by another process. Reloading it instead of saving.")
+            self.apply_remote(current, version)
+            return False
+        self._use_shared(shared, version)
+        self._apply(self._merge(data, shared))
+        self._checked_at = time.monotonic()
+        return True
+
+    def save(self, data):
+        """Blocking compare-and-set; on the event loop use save_async()."""
+        shared = self._shared_part(data)
+        try:
+            return self._finish_save(data, shared, self._put_shared(shared, self.version))
+        except KvError as e:
+            print(f"❌ Error saving {self.key} to the shared store: {e}")
+            return False
+
+    async def save_async(self, data):
+        shared = self._shared_part(data)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(None, self._put_shared, shared, self.version)
+        except KvError as e:
+            print(f"❌ Error saving {self.key} to the shared store: {e}")
+            return False
+        return self._finish_save(data, shared, result)
+
+class UserCache:
+    """Bounded LRU/TTL cache of ticket owners and their DM channels, keyed by user id.
+
+    Misses are resolved from the member/user cache first and only fall back
+    to a REST fetch when discord.py does not know the user.
+    """
+    def __init__(self, client, max_size=1024, ttl=600.0):
+        self.client = client
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.rest_fetches = 0
+
+    def _lookup(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return entry
+
+    def _store(self, user_id, user, dm_channel=None):
+        self._entries[user_id] = (time.monotonic() + self.ttl, user, dm_channel)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get_user(self, user_id, guild=None):
+        entry = self._lookup(user_id)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        user = (guild.get_member(user_id) if guild else None) or self.client.get_user(user_id)
+        if user is None:
+            user = await self.client.fetch_user(user_id)
+            self.rest_fetches += 1
+        self._store(user_id, user)
+        return user
+
+    async def get_dm_channel(self, user_id, guild=None):
+        entry = self._lookup(user_id)
+        if entry is not None and entry[2] is not None:
+            self.hits += 1
+            return entry[2]
+        user = await self.get_user(user_id, guild)
+        dm_channel = user.dm_channel or await user.create_dm()
+        entry = self._entries.get(user_id)
+        self._store(user_id, entry[1] if entry else user, dm_channel)
+        return dm_channel
+
+    async def get_member(self, user_id, guild):
+        """Like get_user() but returns a guild Member, fetching it when the member cache does not hold it."""
+        member = guild.get_member(user_id)
+        if member is None:
+            entry = self._lookup(user_id)
+            if entry is not None and isinstance(entry[1], discord.Member) and entry[1].guild.id == guild.id:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            member = await guild.fetch_member(user_id)
+            self.rest_fetches += 1
+        self.remember(member)
+        return member
+
+    def remember(self, user):
+        """Caches a user or member seen in an event, keeping a known DM channel."""
+        entry = self._entries.get(user.id)
+        self._store(user.id, user, entry[2] if entry else None)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "rest_fetches": self.rest_fetches,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0
+        }
+
+PRIORITY_INTERACTION = 0
+PRIORITY_RELAY = 1
+PRIORITY_NOTIFY = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTION: "interaction", PRIORITY_RELAY: "relay", PRIORITY_NOTIFY: "notify"}
+
+class RouteBucket:
+    """Token bucket for one REST route; reserve() hands out future slots instead of blocking."""
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    def reserve(self):
+        """Consumes one token and returns how long the caller must wait before using it."""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens * self.per / self.rate
+
+    def penalize(self, retry_after):
+        self._refill()
+        self.tokens = min(self.tokens, -retry_after * self.rate / self.per)
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.rate
+
+class SendScheduler:
+    """Central outbound queue: per-route token buckets, priority classes and bounded queues.
+
+    Items are dispatched strictly by priority (interaction follow-ups, then
+    relays, then notifications) through a global bucket; each then waits on
+    its own route bucket without holding up other routes. submit() blocks once
+    a priority class has queue_size items pending, which pushes back on callers.
+    Routes follow Discord's: messages to a user go through their DM channel,
+    so both kinds of target are bucketed by the channel id the REST call hits.
+    """
+    def __init__(self, queue_size=256, route_rate=5, route_per=5.0, global_rate=45, global_per=1.0):
+        self.queue_size = queue_size
+        self.route_rate = route_rate
+        self.route_per = route_per
+        self._global = RouteBucket(global_rate, global_per)
+        self._buckets = {}
+        self._queue = None
+        self._capacity = None
+        self._dispatcher = None
+        self._seq = 0
+        self._pending = {p: 0 for p in PRIORITY_NAMES}
+        self._sent = {p: 0 for p in PRIORITY_NAMES}
+        self._wait_total = {p: 0.0 for p in PRIORITY_NAMES}
+        self._wait_max = {p: 0.0 for p in PRIORITY_NAMES}
+        self.rate_limited = 0
+
+    def _ensure_started(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            if self._queue is None:
+                self._queue = asyncio.PriorityQueue()
+                self._capacity = {p: asyncio.Semaphore(self.queue_size) for p in PRIORITY_NAMES}
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    def _bucket(self, route):
+        bucket = self._buckets.get(route)
+        if bucket is None:
+            if len(self._buckets) > 1024:
+                for idle_route in [r for r, b in self._buckets.items() if b.idle()]:
+                    del self._buckets[idle_route]
+            bucket = self._buckets[route] = RouteBucket(self.route_rate, self.route_per)
+        return bucket
+
+    async def submit(self, route, factory, priority=PRIORITY_RELAY):
+        """Queues factory() (a coroutine function) on route and returns its result once sent."""
+        self._ensure_started()
+        await self._capacity[priority].acquire()
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self._pending[priority] += 1
+        self._queue.put_nowait((priority, self._seq, route, factory, future, time.monotonic()))
+        return await future
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            priority = item[0]
+            self._pending[priority] -= 1
+            self._capacity[priority].release()
+            global_wait = self._global.reserve()
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+            loop.create_task(self._execute(item, self._bucket(item[2]).reserve()))
+
+    async def _execute(self, item, route_wait):
+        priority, _, route, factory, future, enqueued_at = item
+        if route_wait > 0:
+            await asyncio.sleep(route_wait)
+        waited = time.monotonic() - enqueued_at
+        self._sent[priority] += 1
+        self._wait_total[priority] += waited
+        self._wait_max[priority] = max(self._wait_max[priority], waited)
+        if future.cancelled():
+            return
+        try:
+            result = await factory()
+        except Exception as e:
+            if not future.done(): future.set_exception(e)
+        else:
+            if not future.done(): future.set_result(result)
+
+    async def send(self, target, *args, priority=PRIORITY_RELAY, **kwargs):
+        """Schedules target.send(*args, **kwargs) on the route of the channel it posts to."""
+        if isinstance(target, discord.abc.User):
+            target = target.dm_channel or await target.create_dm()
+        return await self.submit(f"channel:{target.id}", lambda: target.send(*args, **kwargs), priority)
+
+    def note_rate_limit(self, url, retry_after):
+        """Counts a 429 on a channel's message route (the one send() uses) and slows that route down."""
+        parts = url.path.split("/")
+        if "channels" not in parts:
+            return
+        index = parts.index("channels") + 1
+        if index < len(parts) and parts[index].isdigit() and parts[index + 1:] == ["messages"]:
+            self.rate_limited += 1
+            route = f"channel:{parts[index]}"
+            if route in self._buckets:
+                self._bucket(route).penalize(retry_after or self.route_per)
+
+    async def followup(self, interaction, *args, **kwargs):
+        """Schedules interaction.followup.send at interaction priority."""
+        return await self.submit(f"interaction:{interaction.id}", lambda: interaction.followup.send(*args, **kwargs), PRIORITY_INTERACTION)
+
+    def stats(self):
+        stats = {
+            PRIORITY_NAMES[p]: {
+                "queued": self._pending[p],
+                "sent": self._sent[p],
+                "avg_wait_ms": round(self._wait_total[p] / self._sent[p] * 1000, 1) if self._sent[p] else 0.0,
+                "max_wait_ms": round(self._wait_max[p] * 1000, 1)
+            } for p in PRIORITY_NAMES
+        }
+        stats["routes"] = len(self._buckets)
+        stats["rate_limited"] = self.rate_limited
+        return stats
+
+def batch_embeds(embeds, max_embeds=10, max_chars=6000):
+    """Splits embeds into groups that fit in a single Discord message."""
+    batch, batch_chars = [], 0
+    for embed in embeds:
+        embed_chars = len(embed)
+        if batch and (len(batch) >= max_embeds or batch_chars + embed_chars > max_chars):
+            yield batch
+            batch, batch_chars = [], 0
+        batch.append(embed)
+        batch_chars += embed_chars
+    if batch:
+        yield batch
+
+class RelayCoalescer:
+    """Buffers relayed staff messages per ticket for a short window and delivers them together.
+
+    The window starts with the first buffered message and is not extended by
+    later ones, so no message waits longer than window seconds.
+    """
+    def __init__(self, window):
+        self.window = window
+        self._buffers = {}
+        self._tasks = {}
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def add(self, ticket_key, embed, deliver):
+        self._buffers.setdefault(ticket_key, []).append(embed)
+        if ticket_key not in self._tasks:
+            self._tasks[ticket_key] = asyncio.get_running_loop().create_task(self._deliver_later(ticket_key, deliver))
+
+    async def _deliver_later(self, ticket_key, deliver):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            self._tasks.pop(ticket_key, None)
+        embeds = self._buffers.pop(ticket_key, [])
+        if embeds:
+            await deliver(embeds)
+
+class AttachmentDedupCache:
+    """Maps attachment content digests to the CDN URL of a copy already uploaded to the same ticket channel.
+
+    Entries expire after max_age seconds (CDN links are signed and go stale)
+    and the oldest are evicted beyond max_entries.
+    """
+    def __init__(self, max_entries=2048, max_age=6 * 3600.0):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def lookup(self, scope, digest, size):
+        key = (scope, digest)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.bytes_saved += size
+        return entry[1]
+
+    def remember(self, scope, digest, url):
+        key = (scope, digest)
+        self._entries[key] = (time.monotonic() + self.max_age, url)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0
+        }
+
+class ForwardedAttachments:
+    """Downloaded attachments ready to send; close() frees their buffers and byte budget."""
+    def __init__(self, forwarder):
+        self.forwarder = forwarder
+        self.files = []
+        self.notes = []
+        self._digests = []
+        self._buffers = []
+        self._reserved = 0
+
+    def remember_upload(self, scope, sent_message):
+        """Records the CDN URLs of freshly uploaded files so later copies can be linked instead."""
+        dedup = self.forwarder.dedup
+        if dedup is None or sent_message is None:
+            return
+        for digest, uploaded in zip(self._digests, sent_message.attachments):
+            dedup.remember(scope, digest, uploaded.url)
+
+    async def close(self):
+        for fp in self._buffers:
+            fp.close()
+        self._buffers.clear()
+        if self._reserved:
+            await self.forwarder._release(self._reserved)
+            self._reserved = 0
+
+class AttachmentForwarder:
+    """Streams DM attachments concurrently under a global in-flight byte budget.
+
+    Each message reserves the budget for all of its files in one step (capped
+    at the whole budget), with waiters served in arrival order, so a message
+    never waits while already holding part of the budget. Files up to
+    spill_bytes are kept in memory, as long as the message's in-memory total
+    fits the budget, and hold their share until sent; the rest are streamed
+    to temporary files and give their share back once downloaded.
+    """
+    def __init__(self, budget_bytes=32 * 1024 * 1024, spill_bytes=2 * 1024 * 1024, chunk_size=64 * 1024, dedup=None):
+        if budget_bytes <= 0:
+            print(f"⚠️ Warning: attachment_budget_bytes must be positive, got {budget_bytes}. Using {32 * 1024 * 1024}.")
+            budget_bytes = 32 * 1024 * 1024
+        if spill_bytes < 0 or spill_bytes > budget_bytes:
+            print(f"⚠️ Warning: attachment_spill_bytes must be between 0 and attachment_budget_bytes ({budget_bytes}), got {spill_bytes}. Clamping.")
+            spill_bytes = max(0, min(spill_bytes, budget_bytes))
+        self.budget_bytes = budget_bytes
+        self.spill_bytes = spill_bytes
+        self.chunk_size = chunk_size
+        self.dedup = dedup
+        self._available = budget_bytes
+        self._waiters = deque()
+        self._condition = None
+
+    def _get_condition(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def _acquire(self, size):
+        size = min(size, self.budget_bytes)
+        condition = self._get_condition()
+        waiter = object()
+        async with condition:
+            self._waiters.append(waiter)
+            try:
+                await condition.wait_for(lambda: self._waiters[0] is waiter and self._available >= size)
+                self._available -= size
+            finally:
+                self._waiters.remove(waiter)
+                condition.notify_all()
+        return size
+
+    async def _release(self, size):
+        condition = self._get_condition()
+        async with condition:
+            self._available += size
+            condition.notify_all()
+
+    async def _download(self, session, attachment, in_memory, forwarded):
+        fp = io.BytesIO() if in_memory else tempfile.TemporaryFile()
+        digest = hashlib.sha256()
+        try:
+            received = 0
+            async with session.get(attachment.url) as resp:
+                if resp.status != 200:
+                    raise ValueError(f"CDN returned HTTP {resp.status}")
+                async for chunk in resp.content.iter_chunked(self.chunk_size):
+                    received += len(chunk)
+                    if received > attachment.size:
+                        raise ValueError("attachment larger than advertised")
+                    fp.write(chunk)
+                    digest.update(chunk)
+            fp.seek(0)
+        except BaseException:
+            fp.close()
+            raise
+        forwarded._buffers.append(fp)
+        return File(fp, filename=attachment.filename), digest.hexdigest()
+
+    async def forward(self, attachments, size_limit, dedup_scope=None):
+        """Downloads every attachment that fits in size_limit (per file and in total).
+
+        With a dedup cache and dedup_scope, files already uploaded to that scope
+        are turned into links in notes instead of being re-uploaded.
+        """
+        forwarded = ForwardedAttachments(self)
+        accepted = []
+        total = 0
+        for attachment in attachments:
+            if attachment.size >= size_limit or total + attachment.size > size_limit:
+                forwarded.notes.append(f"{attachment.filename} (حجم كبير)")
+            else:
+                accepted.append(attachment)
+                total += attachment.size
+        if not accepted:
+            return forwarded
+        in_memory = []
+        memory_total = 0
+        for attachment in accepted:
+            keep = attachment.size <= self.spill_bytes and memory_total + attachment.size <= self.budget_bytes
+            in_memory.append(keep)
+            memory_total += attachment.size if keep else 0
+        reserved = await self._acquire(total)
+        try:
+            async with aiohttp.ClientSession() as session:
+                results = await asyncio.gather(*(self._download(session, attachment, keep, forwarded) for attachment, keep in zip(accepted, in_memory)), return_exceptions=True)
+        except BaseException:
+            await self._release(reserved)
+            raise
+        # Spilled files are on disk now; only the in-memory ones keep their share until close().
+        forwarded._reserved = min(memory_total, reserved)
+        if reserved > forwarded._reserved:
+            await self._release(reserved - forwarded._reserved)
+        for attachment, result in zip(accepted, results):
+            if isinstance(result, BaseException):
+                print(f"Could not forward attachment {attachment.filename}: {result}")
+                forwarded.notes.append(f"{attachment.filename} (خطأ في القراءة)")
+            else:
+                file, digest = result
+                cached_url = self.dedup.lookup(dedup_scope, digest, attachment.size) if self.dedup and dedup_scope else None
+                if cached_url:
+                    forwarded.notes.append(f"[{attachment.filename}]({cached_url}) (مكرر)")
+                else:
+                    forwarded.files.append(file)
+                    forwarded._digests.append(digest)
+        return forwarded
+
+class ChannelPool:
+    """Hidden, pre-created ticket channels per section, claimed on open and topped up in the background.
+
+    Sizes come from "pool_size" and "pool_refill_interval" (seconds between
+    creations) on each entry of active_categories. Pool channels are marked by
+    their topic so they can be re-adopted after a restart. They are placed
+    through the section's CategoryOverflow like any other ticket channel, so
+    they count against the category limit and spill into overflow categories.
+    """
+    TOPIC_PREFIX = "ticket-pool:"
+
+    def __init__(self, category_overflow):
+        self.category_overflow = category_overflow
+        self._channels = {}
+        self._refill_tasks = {}
+
+    def _topic(self, category_key):
+        return f"{self.TOPIC_PREFIX}{category_key}"
+
+    def adopt(self, guild, categories, claimed_ids):
+        """Collects existing pool channels from each section's active category chain."""
+        adopted = 0
+        for category_key in categories:
+            topic = self._topic(category_key)
+            channel_ids = []
+            for category_id in self.category_overflow.chain_ids(category_key, "active"):
+                category = guild.get_channel(category_id)
+                if isinstance(category, CategoryChannel):
+                    channel_ids += [c.id for c in category.text_channels if c.topic == topic and c.id not in claimed_ids]
+            self._channels[category_key] = channel_ids
+            adopted += len(channel_ids)
+        return adopted
+
+    def claim(self, guild, category_key):
+        chain_ids = set(self.category_overflow.chain_ids(category_key, "active"))
+        channel_ids = self._channels.get(category_key, [])
+        while channel_ids:
+            channel = guild.get_channel(channel_ids.pop(0))
+            if isinstance(channel, discord.TextChannel) and channel.category_id in chain_ids:
+                return channel
+        return None
+
+    def refill(self, guild, category_key, cat_info):
+        if int(cat_info.get("pool_size") or 0) <= 0:
+            return
+        task = self._refill_tasks.get(category_key)
+        if task and not task.done():
+            return
+        self._refill_tasks[category_key] = asyncio.get_running_loop().create_task(self._refill(guild, category_key, cat_info))
+
+    def refill_all(self, guild, categories):
+        for category_key, cat_info in categories.items():
+            self.refill(guild, category_key, cat_info)
+
+    async def _refill(self, guild, category_key, cat_info):
+        pool_size = int(cat_info.get("pool_size") or 0)
+        interval = float(cat_info.get("pool_refill_interval") or 5)
+        channel_ids = self._channels.setdefault(category_key, [])
+        overwrites = {
+            guild.default_role: PermissionOverwrite(read_messages=False, view_channel=False),
+            guild.me: PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True, manage_messages=True, embed_links=True, attach_files=True, view_channel=True)
+        }
+        while len(channel_ids) < pool_size:
+            try:
+                category = await self.category_overflow.acquire(guild, category_key, "active")
+            except KvError as e:
+                print(f"⚠️ Warning: Cannot refill channel pool for '{category_key}': {e}")
+                return
+            if category is None:
+                print(f"⚠️ Warning: Cannot refill channel pool for '{category_key}': no active category with room.")
+                return
+            try:
+                channel = await guild.create_text_channel(
+                    f"pool-{category_key}"[:100],
+                    overwrites=overwrites,
+                    category=category,
+                    topic=self._topic(category_key),
+                    reason=f"Pre-created ticket channel for section {category_key}"
+                )
+                self.category_overflow.channel_added(category.id, channel.id)
+            except discord.errors.Forbidden:
+                print(f"❌ Bot lacks permission to pre-create channels in category {category.id}.")
+                return
+            except Exception as e:
+                print(f"❌ Error pre-creating ticket channel for '{category_key}': {e}")
+                return
+            finally:
+                self.category_overflow.release(category.id)
+            channel_ids.append(channel.id)
+            if len(channel_ids) < pool_size:
+                await asyncio.sleep(interval)
+
+    def stats(self):
+        return {category_key: len(channel_ids) for category_key, channel_ids in self._channels.items()}
+
+class CategoryOverflow:
+    """Chains of overflow categories per section, chosen from a live per-category channel count.
+
+    Discord caps a category at 50 channels. Each section keeps its extra
+    categories in "overflow_category_ids" / "archive_overflow_category_ids";
+    acquire() returns the first category in the chain with room, creating a
+    new overflow category when all are full, and empty overflow categories
+    are deleted again by reclaim(). Channels are tracked by id, so counting
+    a new channel from its create call and again from the gateway event is
+    harmless; callers count the result before giving up their reservation.
+    Pass the bot's shared ticket locks so that, with a key-value service,
+    only one process at a time can pick or create a section's category.
+    """
+    CHAINS = {
+        "active": ("category_id", "overflow_category_ids"),
+        "archive": ("archive_category_id", "archive_overflow_category_ids")
+    }
+
+    def __init__(self, config_cache, limit=50, locks=None):
+        self.config_cache = config_cache
+        self.limit = limit
+        self.locks = locks if locks is not None else KeyedLocks()
+        self._channels = {}
+        self._pending = {}
+
+    def rebuild(self, guild):
+        channels = {}
+        for channel in guild.channels:
+            if channel.category_id:
+                channels.setdefault(channel.category_id, set()).add(channel.id)
+        self._channels = channels
+
+    def channel_added(self, category_id, channel_id):
+        if category_id:
+            self._channels.setdefault(category_id, set()).add(channel_id)
+
+    def channel_removed(self, category_id, channel_id):
+        channel_ids = self._channels.get(category_id)
+        if channel_ids is not None:
+            channel_ids.discard(channel_id)
+
+    def count(self, category_id):
+        return len(self._channels.get(category_id, ())) + self._pending.get(category_id, 0)
+
+    def release(self, category_id):
+        if self._pending.get(category_id, 0) > 0:
+            self._pending[category_id] -= 1
+
+    def chain_ids(self, category_key, chain):
+        """Ids of the section's primary category followed by its overflow categories."""
+        cat_info = self.config_cache.get().categories.get(category_key)
+        if not cat_info:
+            return []
+        primary_field, overflow_field = self.CHAINS[chain]
+        return [cat_id for cat_id in [cat_info.get(primary_field)] + cat_info.get(overflow_field, []) if cat_id]
+
+    async def acquire(self, guild, category_key, chain):
+        """Reserves a slot in the first category of the chain that has room.
+
+        Pair with release(), after counting the created or moved channel with channel_added().
+        Raises LeaseLost instead of creating an overflow category once the lock is no longer exclusive.
+        """
+        async with self.locks.hold(("overflow", guild.id, category_key, chain)) as lease:
+            if category_key not in self.config_cache.get().categories:
+                return None
+            overflow_field = self.CHAINS[chain][1]
+            chain_ids = self.chain_ids(category_key, chain)
+            for cat_id in chain_ids:
+                category = guild.get_channel(cat_id)
+                if isinstance(category, CategoryChannel) and self.count(cat_id) < self.limit:
+                    self._pending[cat_id] = self._pending.get(cat_id, 0) + 1
+                    return category
+            lease.check()
+            category = await self._create_overflow(guild, category_key, overflow_field, chain_ids)
+            if category:
+                self._pending[category.id] = self._pending.get(category.id, 0) + 1
+            return category
+
+    async def _create_overflow(self, guild, category_key, overflow_field, chain_ids):
+        template = guild.get_channel(chain_ids[0]) if chain_ids else None
+        if not isinstance(template, CategoryChannel):
+            return None
+        try:
+            category = await guild.create_category(
+                name=f"{template.name} ({len(chain_ids) + 1})"[:100],
+                overwrites=template.overwrites,
+                reason=f"Overflow category for section {category_key}"
+            )
+        except discord.errors.Forbidden:
+            print(f"❌ Bot lacks permission to create an overflow category for '{category_key}'.")
+            return None
+        except Exception as e:
+            print(f"❌ Error creating overflow category for '{category_key}': {e}")
+            return None
+        if not await self._update_chain(category_key, overflow_field, add=category.id):
+            print(f"⚠️ Overflow category {category.id} created but could not be saved to config.")
+        print(f"📂 Created overflow category {category.name} ({category.id}) for section '{category_key}'.")
+        return category
+
+    async def _update_chain(self, category_key, overflow_field, add=None, remove=None):
+        data = dict(self.config_cache.get().data)
+        categories = dict(data.get("active_categories") or {})
+        if category_key not in categories:
+            return False
+        cat_info = dict(categories[category_key])
+        overflow_ids = [i for i in cat_info.get(overflow_field) or [] if str(i) != str(remove)]
+        if add is not None:
+            overflow_ids.append(add)
+        cat_info[overflow_field] = overflow_ids
+        categories[category_key] = cat_info
+        data["active_categories"] = categories
+        return await self.config_cache.save_async(data)
+
+    async def reclaim(self, guild, category_id):
+        """Deletes an overflow category once it holds no channels."""
+        owner = self.config_cache.get().overflow_owners.get(category_id)
+        if not owner or self.count(category_id) > 0:
+            return False
+        category_key, overflow_field = owner
+        async with self.locks.hold(("overflow", guild.id, category_key, "archive" if overflow_field.startswith("archive") else "active")) as lease:
+            category = guild.get_channel(category_id)
+            if self.count(category_id) > 0 or (isinstance(category, CategoryChannel) and category.channels):
+                return False
+            if lease.lost:
+                print(f"⚠️ Not reclaiming overflow category {category_id}: {lease.name} was lost.")
+                return False
+            if category:
+                try:
+                    await category.delete(reason=f"Empty overflow category for section {category_key}")
+                except discord.NotFound:
+                    pass
+                except Exception as e:
+                    print(f"⚠️ Could not delete empty overflow category {category_id}: {e}")
+                    return False
+            self._channels.pop(category_id, None)
+            self._pending.pop(category_id, None)
+            await self._update_chain(category_key, overflow_field, remove=category_id)
+            print(f"🧹 Reclaimed empty overflow category {category_id} of section '{category_key}'.")
+            return True
+
+    def reclaim_all(self, guild):
+        for category_id in list(self.config_cache.get().overflow_owners):
+            if self.count(category_id) == 0:
+                asyncio.get_running_loop().create_task(self.reclaim(guild, category_id))
+
+class TranscriptArchiver:
+    """Exports archived ticket channels past their retention period to gzip'd JSONL and deletes them.
+
+    History is streamed page by page; every page is appended as its own gzip
+    member and the last exported message id is checkpointed next to it, so
+    an interrupted export resumes where it stopped (repeating at most one page).
+    """
+    def __init__(self, directory, retention_days, interval=3600.0, page_size=100, on_exported=None):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.interval = interval
+        self.page_size = page_size
+        self.on_exported = on_exported
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.retention_days > 0
+
+    def transcript_path(self, channel_id):
+        return os.path.join(self.directory, f"{channel_id}.jsonl.gz")
+
+    def _state_path(self, channel_id):
+        return os.path.join(self.directory, f"{channel_id}.export.json")
+
+    def start(self, targets_provider):
+        """targets_provider() returns the (guild, archive category ids) pairs to sweep on each pass."""
+        if not self.enabled or (self._task and not self._task.done()):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._task = asyncio.get_running_loop().create_task(self._run(targets_provider))
+
+    async def _run(self, targets_provider):
+        while True:
+            for guild, archive_category_ids in targets_provider():
+                try:
+                    await self.sweep(guild, archive_category_ids)
+                except Exception as e:
+                    print(f"❌ Error during archive sweep of guild {guild.id}: {e}")
+            await asyncio.sleep(self.interval)
+
+    def _last_activity(self, channel):
+        if channel.last_message_id:
+            return discord.utils.snowflake_time(channel.last_message_id)
+        return channel.created_at
+
+    async def sweep(self, guild, archive_category_ids):
+        cutoff = discord.utils.utcnow() - datetime.timedelta(days=self.retention_days)
+        exported = 0
+        for category_id in archive_category_ids:
+            category = guild.get_channel(category_id)
+            if not isinstance(category, CategoryChannel):
+                continue
+            for channel in list(category.text_channels):
+                if self._last_activity(channel) > cutoff and not os.path.exists(self._state_path(channel.id)):
+                    continue
+                if await self.export_and_delete(channel):
+                    exported += 1
+        if exported:
+            print(f"📦 Exported and deleted {exported} archived ticket channels.")
+        return exported
+
+    @staticmethod
+    def _message_record(message):
+        return {
+            "id": message.id,
+            "created_at": message.created_at.isoformat(),
+            "author_id": message.author.id,
+            "author": str(message.author),
+            "content": message.content,
+            "attachments": [att.url for att in message.attachments],
+            "embeds": [embed.to_dict() for embed in message.embeds]
+        }
+
+    def _append_page(self, path, lines):
+        with gzip.open(path, "ab") as f:
+            f.write("".join(lines).encode("utf-8"))
+        with open(path, "rb") as f:
+            os.fsync(f.fileno())
+
+    async def export_and_delete(self, channel):
+        state_path = self._state_path(channel.id)
+        transcript_path = self.transcript_path(channel.id)
+        state = load_json(state_path, {"last_message_id": None, "messages": 0, "complete": False})
+        loop = asyncio.get_running_loop()
+        if not state.get("complete"):
+            after = discord.Object(id=state["last_message_id"]) if state.get("last_message_id") else None
+            page = []
+            try:
+                async for message in channel.history(limit=None, oldest_first=True, after=after):
+                    page.append(json.dumps(self._message_record(message), ensure_ascii=False, separators=(",", ":")) + "\n")
+                    state["last_message_id"] = message.id
+                    if len(page) >= self.page_size:
+                        await loop.run_in_executor(None, self._append_page, transcript_path, page)
+                        state["messages"] += len(page)
+                        page = []
+                        await loop.run_in_executor(None, save_json, state_path, state)
+                if page:
+                    await loop.run_in_executor(None, self._append_page, transcript_path, page)
+                    state["messages"] += len(page)
+            except discord.errors.Forbidden:
+                print(f"❌ Bot cannot read history of archived channel {channel.id}. Skipping export.")
+                return False
+            except Exception as e:
+                print(f"❌ Error exporting archived channel {channel.id}: {e}")
+                return False
+            state["complete"] = True
+            await loop.run_in_executor(None, save_json, state_path, state)
+            if self.on_exported:
+                await loop.run_in_executor(None, self.on_exported, channel, transcript_path)
+        try:
+            await channel.delete(reason=f"Archived ticket exported to {transcript_path}")
+        except discord.NotFound:
+            pass
+        except Exception as e:
+            print(f"❌ Could not delete exported channel {channel.id}: {e}")
+            return False
+        try:
+            os.remove(state_path)
+        except OSError:
+            pass
+        print(f"📦 Exported {state['messages']} messages from #{channel.name} to {transcript_path}.")
+        return True
+
+class TranscriptWriter:
+    """Appends ticket messages to a per-ticket JSONL file as they pass through the bot.
+
+    Records are buffered in memory and appended off the event loop every
+    flush_delay seconds (or once max_buffer records are pending), so /close
+    only has to compress an already complete transcript.
+    """
+    def __init__(self, directory, flush_delay=2.0, max_buffer=200):
+        self.directory = directory
+        self.flush_delay = flush_delay
+        self.max_buffer = max_buffer
+        self._buffers = {}
+        self._pending = 0
+        self._flusher = WriteBehind(self.flush, lambda: bool(self._buffers), self._wait_to_flush)
+
+    def live_path(self, channel_id):
+        return os.path.join(self.directory, f"{channel_id}.open.jsonl")
+
+    def final_path(self, channel_id):
+        return os.path.join(self.directory, f"{channel_id}.transcript.jsonl.gz")
+
+    def record(self, channel_id, source, author, content, attachments=(), timestamp=None):
+        entry = {
+            "t": (timestamp or discord.utils.utcnow()).isoformat(),
+            "s": source,
+            "a": author.id,
+            "n": str(author),
+            "c": content
+        }
+        if attachments:
+            entry["f"] = [att.url for att in attachments]
+        self._buffers.setdefault(channel_id, []).append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._pending += 1
+        self._flusher.schedule()
+
+    def record_message(self, channel_id, source, message):
+        self.record(channel_id, source, message.author, message.content, message.attachments, message.created_at)
+
+    async def _wait_to_flush(self):
+        waited = 0.0
+        while self._pending < self.max_buffer and waited < self.flush_delay:
+            await asyncio.sleep(0.25)
+            waited += 0.25
+
+    def _write(self, buffers):
+        os.makedirs(self.directory, exist_ok=True)
+        for channel_id, lines in buffers.items():
+            try:
+                with open(self.live_path(channel_id), "a", encoding="utf-8") as f:
+                    f.write("".join(lines))
+            except Exception as e:
+                print(f"❌ Error appending transcript for channel {channel_id}: {e}")
+
+    async def flush(self):
+        async with self._flusher.lock:
+            if not self._buffers:
+                return
+            buffers, self._buffers, self._pending = self._buffers, {}, 0
+            await asyncio.get_running_loop().run_in_executor(None, self._write, buffers)
+
+    def flush_sync(self):
+        buffers, self._buffers, self._pending = self._buffers, {}, 0
+        if buffers:
+            self._write(buffers)
+
+    def _compress(self, channel_id):
+        live_path = self.live_path(channel_id)
+        if not os.path.exists(live_path):
+            return None
+        final_path = self.final_path(channel_id)
+        with open(live_path, "rb") as src, gzip.open(final_path, "ab") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(live_path)
+        return final_path
+
+    async def finalize(self, channel_id):
+        """Flushes and compresses a ticket's transcript; returns its path, or None if nothing was captured."""
+        await self.flush()
+        async with self._flusher.lock:
+            try:
+                return await asyncio.get_running_loop().run_in_executor(None, self._compress, channel_id)
+            except Exception as e:
+                print(f"❌ Error finalizing transcript for channel {channel_id}: {e}")
+                return None
+
+class GatewayRecorder:
+    """Appends the gateway events the bot handles to a gzip'd JSONL capture for offline replay.
+
+    install() wraps entries of the connection state's parser table, so each
+    event is recorded exactly as discord.py received it, before any handler
+    runs. Lines are {"t": seconds since start, "e": event, "d": payload} and
+    are appended off the event loop like TranscriptWriter. Events of every
+    guild in guild_ids are kept, plus DMs. Interaction tokens
+    are always dropped; with redact, message text, names and attachment/embed
+    text are replaced by placeholders of the same length.
+    """
+    EVENTS = ("READY", "GUILD_CREATE", "MESSAGE_CREATE", "INTERACTION_CREATE", "CHANNEL_CREATE", "CHANNEL_UPDATE", "CHANNEL_DELETE")
+    REDACTED_KEYS = {"content", "username", "global_name", "nick", "avatar", "banner", "filename", "url", "proxy_url", "description", "title", "topic", "value", "text"}
+
+    def __init__(self, filename, guild_ids, redact=False, ticket_prefix="ticket-", flush_delay=1.0, max_buffer=500):
+        self.filename = filename
+        self.guild_ids = {str(guild_id) for guild_id in guild_ids}
+        self.redact = redact
+        self.ticket_prefix = ticket_prefix
+        self.flush_delay = flush_delay
+        self.max_buffer = max_buffer
+        self.recorded = 0
+        self._started = time.monotonic()
+        self._buffer = []
+        self._flusher = WriteBehind(self.flush, lambda: bool(self._buffer), self._wait_to_flush)
+
+    def install(self, state, config_data, tickets):
+        """Starts a capture with the current config (minus the token) and open tickets, then hooks the parsers."""
+        self._append("CONFIG", {k: v for k, v in config_data.items() if k != "bot_token"}, 0.0)
+        self._append("TICKETS", dict(tickets), 0.0)
+        for event in self.EVENTS:
+            parser = state.parsers.get(event)
+            if parser:
+                state.parsers[event] = self._wrap(event, parser)
+
+    def _wrap(self, event, parser):
+        def recording_parser(data):
+            try:
+                self.record(event, data)
+            except Exception as e:
+                print(f"❌ Error recording gateway event {event}: {e}")
+            return parser(data)
+        return recording_parser
+
+    def _wanted(self, event, data):
+        if event == "READY":
+            return True
+        guild_id = data.get("id") if event == "GUILD_CREATE" else data.get("guild_id")
+        if guild_id is None:
+            return event in ("MESSAGE_CREATE", "INTERACTION_CREATE")
+        return str(guild_id) in self.guild_ids
+
+    def record(self, event, data):
+        if not self._wanted(event, data):
+            return
+        if event == "READY":
+            data = {"user": data["user"]}
+        if event == "INTERACTION_CREATE":
+            data = dict(data, token="redacted")
+        if self.redact:
+            data = self._redact(data)
+        self._append(event, data, time.monotonic() - self._started)
+        self._flusher.schedule()
+
+    def _append(self, event, data, offset):
+        self._buffer.append(json.dumps({"t": round(offset, 4), "e": event, "d": data}, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.recorded += 1
+
+    def _redact(self, value, key=None):
+        if isinstance(value, dict):
+            return {k: self._redact(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._redact(v, key) for v in value]
+        if isinstance(value, str):
+            if key in self.REDACTED_KEYS:
+                return "x" * len(value)
+            if key == "name":
+                for prefix in (self.ticket_prefix, "archived-"):
+                    if value.startswith(prefix) and "-" in value[len(prefix):]:
+                        owner, _, section = value[len(prefix):].rpartition("-")
+                        return f"{prefix}{'x' * len(owner)}-{section}"
+        return value
+
+    async def _wait_to_flush(self):
+        waited = 0.0
+        while len(self._buffer) < self.max_buffer and waited < self.flush_delay:
+            await asyncio.sleep(0.25)
+            waited += 0.25
+
+    def _write(self, lines):
+        try:
+            with gzip.open(self.filename, "ab") as f:
+                f.write("".join(lines).encode("utf-8"))
+        except Exception as e:
+            print(f"❌ Error appending gateway capture to {self.filename}: {e}")
+
+    async def flush(self):
+        async with self._flusher.lock:
+            if not self._buffer:
+                return
+            lines, self._buffer = self._buffer, []
+            await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+
+    def flush_sync(self):
+        lines, self._buffer = self._buffer, []
+        if lines:
+            self._write(lines)
+
+class TicketSearchIndex:
+    """SQLite FTS5 index over closed ticket transcripts and their metadata, queried off the event loop."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS indexed_tickets (
+            channel_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            category_key TEXT,
+            opened_at REAL,
+            closed_at REAL,
+            message_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_indexed_user ON indexed_tickets (user_id, closed_at);
+        CREATE INDEX IF NOT EXISTS idx_indexed_category ON indexed_tickets (category_key, closed_at);
+        CREATE INDEX IF NOT EXISTS idx_indexed_closed_at ON indexed_tickets (closed_at);
+        CREATE VIRTUAL TABLE IF NOT EXISTS ticket_messages USING fts5(
+            content, author, channel_id UNINDEXED, created_at UNINDEXED, tokenize = 'unicode61'
+        );
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filename, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    @staticmethod
+    def _read_transcript(path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                content = entry.get("c", entry.get("content")) or ""
+                embed_text = " ".join(e.get("description") or "" for e in entry.get("embeds", []))
+                text = f"{content} {embed_text}".strip()
+                if text:
+                    yield text, entry.get("n", entry.get("author")) or "", entry.get("t", entry.get("created_at"))
+
+    def index_ticket(self, channel_id, ticket_info, closed_at=None, transcript_path=None):
+        """Adds or replaces one closed ticket; returns the number of messages indexed."""
+        channel_id = str(channel_id)
+        rows = []
+        try:
+            if transcript_path and os.path.exists(transcript_path):
+                rows = [(text, author, channel_id, created_at) for text, author, created_at in self._read_transcript(transcript_path)]
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.execute("DELETE FROM ticket_messages WHERE channel_id = ?", (channel_id,))
+                    conn.executemany("INSERT INTO ticket_messages (content, author, channel_id, created_at) VALUES (?, ?, ?, ?)", rows)
+                    conn.execute(
+                        "INSERT INTO indexed_tickets (channel_id, user_id, category_key, opened_at, closed_at, message_count) VALUES (?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT(channel_id) DO UPDATE SET user_id = COALESCE(excluded.user_id, user_id), "
+                        "category_key = COALESCE(excluded.category_key, category_key), opened_at = COALESCE(excluded.opened_at, opened_at), "
+                        "closed_at = COALESCE(excluded.closed_at, closed_at), message_count = excluded.message_count",
+                        (channel_id, ticket_info.get("user_id"), ticket_info.get("category_key"), ticket_info.get("opened_at"), closed_at, len(rows))
+                    )
+            return len(rows)
+        except (sqlite3.Error, OSError, EOFError) as e:
+            print(f"❌ Error indexing ticket {channel_id} into {self.filename}: {e}")
+            return 0
+
+    @staticmethod
+    def _match_expression(query):
+        return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+    def search(self, query=None, user_id=None, category_key=None, limit=10, offset=0):
+        """Returns up to limit hits as dicts; text queries return one hit per matching message."""
+        filters, params = [], []
+        if user_id is not None:
+            filters.append("t.user_id = ?"); params.append(user_id)
+        if category_key:
+            filters.append("t.category_key = ?"); params.append(category_key)
+        if query and query.strip():
+            where = " AND ".join(["ticket_messages MATCH ?"] + filters)
+            sql = ("SELECT m.channel_id, t.user_id, t.category_key, t.closed_at, snippet(ticket_messages, 0, '**', '**', '…', 16) "
+                   "FROM ticket_messages m JOIN indexed_tickets t ON t.channel_id = m.channel_id "
+                   f"WHERE {where} ORDER BY rank LIMIT ? OFFSET ?")
+            params = [self._match_expression(query)] + params
+        else:
+            where = f"WHERE {' AND '.join(filters)}" if filters else ""
+            sql = ("SELECT t.channel_id, t.user_id, t.category_key, t.closed_at, NULL FROM indexed_tickets t "
+                   f"{where} ORDER BY t.closed_at DESC LIMIT ? OFFSET ?")
+        with self._lock:
+            rows = self._connect().execute(sql, params + [limit, offset]).fetchall()
+        return [{"channel_id": r[0], "user_id": r[1], "category_key": r[2], "closed_at": r[3], "snippet": r[4]} for r in rows]
+
+    def indexed_channel_ids(self):
+        """Ids (as strings) of every ticket already in the index."""
+        try:
+            with self._lock:
+                return {row[0] for row in self._connect().execute("SELECT channel_id FROM indexed_tickets")}
+        except sqlite3.Error as e:
+            print(f"❌ Error reading indexed tickets from {self.filename}: {e}")
+            return set()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class InteractionTrace:
+    """Stage timestamps for one interaction, relative to when its handler started."""
+    def __init__(self, name, interaction):
+        self.name = name
+        self.age = max(0.0, (discord.utils.utcnow() - interaction.created_at).total_seconds())
+        self.started = time.perf_counter()
+        self.stages = [("start", self.started)]
+        self.watchdog = None
+        self.deferring = False
+        self.auto_deferred = False
+
+    def stage(self, label):
+        self.stages.append((label, time.perf_counter()))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def breakdown(self):
+        return " → ".join(f"{label} +{(at - previous) * 1000:.0f}ms" for (_, previous), (label, at) in zip(self.stages, self.stages[1:]))
+
+class InteractionTracer:
+    """Traces interaction handlers and defers them before Discord's 3 second acknowledgement deadline.
+
+    The deadline is measured from the interaction's snowflake time, so time
+    spent in the gateway and the event loop queue counts against it. If the
+    handler has not responded margin seconds before the deadline, a watchdog
+    task defers it; handlers answer through respond(), which turns into a
+    followup once that happened. Handlers slower than slow_threshold seconds
+    are logged with their stage breakdown.
+    """
+    DEADLINE = 3.0
+
+    def __init__(self, margin=1.0, slow_threshold=1.5):
+        self.margin = margin
+        self.slow_threshold = slow_threshold
+        self._traces = {}
+
+    @contextlib.asynccontextmanager
+    async def trace(self, interaction, name, auto_defer=True, ephemeral=True):
+        trace = InteractionTrace(name, interaction)
+        self._traces[interaction.id] = trace
+        metrics.observe("interaction_gateway_age_seconds", trace.age, handler=name)
+        if auto_defer and self.margin > 0:
+            trace.watchdog = asyncio.get_running_loop().create_task(self._watch(interaction, trace, ephemeral))
+        try:
+            yield trace
+        finally:
+            self._traces.pop(interaction.id, None)
+            if trace.watchdog and not trace.deferring:
+                trace.watchdog.cancel()
+            trace.stage("done")
+            self._report(trace)
+
+    def traced(self, name, **options):
+        """Decorator form of trace() for handlers taking the interaction as an argument."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                interaction = next(arg for arg in args if isinstance(arg, discord.Interaction))
+                async with self.trace(interaction, name, **options):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stage(self, interaction, label):
+        trace = self._traces.get(interaction.id)
+        if trace:
+            trace.stage(label)
+
+    async def _watch(self, interaction, trace, ephemeral):
+        await asyncio.sleep(max(self.DEADLINE - self.margin - trace.age - trace.elapsed(), 0))
+        if interaction.response.is_done():
+            return
+        trace.deferring = True
+        trace.stage("auto_defer")
+        try:
+            await interaction.response.defer(ephemeral=ephemeral, thinking=True)
+            trace.auto_deferred = True
+            metrics.inc("interaction_auto_defer_total", handler=trace.name)
+        except (discord.InteractionResponded, discord.HTTPException) as e:
+            print(f"⚠️ Could not auto-defer interaction '{trace.name}' ({interaction.id}): {e}")
+
+    async def respond(self, interaction, *args, **kwargs):
+        """Sends the initial response, or a followup if the interaction was already deferred."""
+        trace = self._traces.get(interaction.id)
+        if trace and trace.watchdog:
+            if trace.deferring:
+                await asyncio.wait([trace.watchdog])
+            else:
+                trace.watchdog.cancel()
+        self.stage(interaction, "respond")
+        if interaction.response.is_done():
+            return await outbound.followup(interaction, *args, **kwargs)
+        return await interaction.response.send_message(*args, **kwargs)
+
+    def _report(self, trace):
+        elapsed = trace.elapsed()
+        if elapsed < self.slow_threshold and not trace.auto_deferred:
+            return
+        deferred = ", auto-deferred" if trace.auto_deferred else ""
+        print(f"🐢 Slow interaction '{trace.name}': {elapsed * 1000:.0f}ms after {trace.age * 1000:.0f}ms in transit{deferred}: {trace.breakdown()}")
+
+def parse_optional_id(raw_id, field, filename):
+    if not raw_id:
+        return None
+    try:
+        return int(raw_id)
+    except (ValueError, TypeError):
+        print(f"⚠️ Warning: {field} '{raw_id}' in {filename} is not a valid integer. Ignoring.")
+        return None
+
+class GuildState:
+    """Config, ticket store and channel bookkeeping of one guild.
+
+    Every guild reads its own config file and keeps its ticket data (and
+    search index) in its own data directory, so a slow flush or a busy
+    section in one guild never holds a lock or a file another guild needs.
+    Storage settings missing from a guild's config fall back to defaults
+    (the main config.json). With a kv client the sections and, by default,
+    the open tickets are kept in the shared key-value service instead.
+    """
+    def __init__(self, guild_id, config_file, data_dir="", defaults=None, owner_index=None, kv=None, locks=None):
+        self.guild_id = guild_id
+        self.data_dir = data_dir
+        self.config_cache = KvConfigCache(config_file, kv, guild_id) if kv else ConfigCache(config_file)
+        if kv:
+            self.config_cache.load_shared()
+        else:
+            self.config_cache.reload()
+        settings = self.config_cache.data
+        defaults = defaults or {}
+        def setting(key, default=None):
+            return settings.get(key, defaults.get(key, default))
+        self.config_cache.check_interval = float(setting("config_check_interval", 5.0))
+        self.mod_role_id = parse_optional_id(settings.get("moderator_role_id"), "moderator_role_id", config_file)
+        self.ticket_prefix = setting("ticket_prefix", "ticket-")
+        self.category_overflow = CategoryOverflow(self.config_cache, limit=int(setting("category_channel_limit", 50)), locks=locks)
+        self.channel_pool = ChannelPool(self.category_overflow)
+
+        storage_backend = str(setting("storage_backend", "kv" if kv else "json")).lower()
+        if storage_backend == "kv" and kv:
+            self.ticket_backend = KvTicketBackend(kv, guild_id)
+        elif storage_backend == "sqlite":
+            self.ticket_backend = SqliteTicketBackend(os.path.join(data_dir, setting("sqlite_file") or TICKET_DB_FILE))
+        else:
+            if storage_backend == "kv":
+                print(f"⚠️ Warning: storage_backend 'kv' in {config_file} needs kv_url in config.json. Falling back to json.")
+            elif storage_backend != "json":
+                print(f"⚠️ Warning: Unknown storage_backend '{storage_backend}' in {config_file}. Falling back to json.")
+            self.ticket_backend = JsonTicketBackend(
+                os.path.join(data_dir, TICKET_FILE),
+                journal_file=os.path.join(data_dir, TICKET_JOURNAL_FILE) if setting("ticket_journal", False) else None,
+                compact_bytes=int(setting("ticket_journal_compact_bytes", 256 * 1024))
+            )
+        self.ticket_store = TicketStore(self.ticket_backend, owner_index=owner_index, scope=guild_id)
+        print(f"📂 Loaded {self.ticket_store.load()} open ticket entries from {self.ticket_backend.filename}.")
+        self.search_index = TicketSearchIndex(os.path.join(data_dir, setting("search_index_file", SEARCH_INDEX_FILE))) if setting("search_index", False) else None
+
+    def follow(self, kv_sync):
+        """Applies other processes' ticket and section writes for this guild from the shared change feed."""
+        if isinstance(self.ticket_backend, KvTicketBackend):
+            kv_sync.subscribe(self.ticket_backend.prefix, lambda key, value, version: self.ticket_store.apply_remote(key, value))
+        if isinstance(self.config_cache, KvConfigCache):
+            kv_sync.subscribe(self.config_cache.key, self._apply_remote_config)
+
+    def _apply_remote_config(self, rest, value, version):
+        if rest:
+            # Subscriptions match by prefix, so config/1 also sees config/12 and the like; those belong to other guilds.
+            return
+        self.config_cache.apply_remote(value, version)
+
+class GuildRegistry:
+    """GuildState per configured guild, plus the cross-guild index used to route DMs to open tickets."""
+    def __init__(self, kv=None, locks=None):
+        self.kv = kv
+        self.locks = locks
+        self.owner_index = TicketOwnerIndex()
+        self._states = {}
+
+    def add(self, guild_id, config_file, data_dir="", defaults=None):
+        state = GuildState(guild_id, config_file, data_dir, defaults=defaults, owner_index=self.owner_index, kv=self.kv, locks=self.locks)
+        self._states[guild_id] = state
+        return state
+
+    def get(self, guild_id):
+        return self._states.get(guild_id)
+
+    def ids(self):
+        return sorted(self._states)
+
+    def __iter__(self):
+        return iter(list(self._states.values()))
+
+    def __len__(self):
+        return len(self._states)
+
+    def open_tickets_for_user(self, user_id):
+        """(state, channel key, ticket info) of the user's open tickets in every guild, newest first."""
+        tickets = []
+        for guild_id, key in self.owner_index.lookup(user_id):
+            state = self._states.get(guild_id)
+            ticket_info = state.ticket_store.get(key) if state else None
+            if ticket_info is not None:
+                tickets.append((state, key, ticket_info))
+        tickets.sort(key=lambda item: item[2].get("opened_at") or 0, reverse=True)
+        return tickets
+
 config = load_json(CONFIG_FILE, {
     "bot_token": None, "guild_id": None, "moderator_role_id": None,
     "ticket_prefix": "ticket-", "active_categories": {}
@@ -69,48 +2641,185 @@ except (ValueError, TypeError):
     print(f"❌ Error: guild_id '{config.get('guild_id')}' in config.json is not a valid integer!")
     exit()
 
-MOD_ROLE_ID = None
-mod_role_id_raw = config.get("moderator_role_id")
-if mod_role_id_raw:
+kv = None
+kv_sync = None
+kv_owner = config.get("kv_owner") or f"{socket.gethostname()}:{os.getpid()}"
+if config.get("kv_url"):
+    kv = KvClient(config["kv_url"], timeout=float(config.get("kv_timeout", 5.0)))
     try:
-        MOD_ROLE_ID = int(mod_role_id_raw)
-    except (ValueError, TypeError):
-        print(f"⚠️ Warning: moderator_role_id '{mod_role_id_raw}' in config.json is not a valid integer. Ignoring.")
-
-TICKET_PREFIX = config.get("ticket_prefix", "ticket-")
-
-ticket_data = load_json(TICKET_FILE, {})
+        kv_sync = KvSync(kv, poll_timeout=float(config.get("kv_poll_seconds", 25.0)))
+    except KvError as e:
+        print(f"❌ Error: Cannot reach the shared store at {kv.url}: {e}")
+        exit()
+    print(f"🗄️ Sharing tickets, sections and locks through {kv.url} as {kv_owner}.")
+
+async def reload_shared_state():
+    """Re-reads every guild's sections and tickets from the shared store after falling behind its change feed."""
+    loop = asyncio.get_running_loop()
+    for state in guild_states:
+        await state.config_cache.reload_async()
+        if isinstance(state.ticket_backend, KvTicketBackend):
+            try:
+                state.ticket_store.replace_remote(await loop.run_in_executor(None, state.ticket_backend.load))
+            except KvError as e:
+                print(f"❌ Error reloading tickets from {state.ticket_backend.filename}: {e}")
+
+if kv_sync:
+    ticket_locks = LeaseLocks(kv, kv_owner, ttl=float(config.get("kv_lease_seconds", 15.0)), on_acquired=kv_sync.catch_up)
+    kv_sync.on_reset(reload_shared_state)
+else:
+    ticket_locks = KeyedLocks()
+
+guild_states = GuildRegistry(kv=kv, locks=ticket_locks)
+guild_states.add(GUILD_ID, CONFIG_FILE)
+guilds_dir = config.get("guilds_dir")
+if guilds_dir and os.path.isdir(guilds_dir):
+    for entry in sorted(os.listdir(guilds_dir)):
+        guild_config_file = os.path.join(guilds_dir, entry, CONFIG_FILE)
+        if not entry.isdigit() or not os.path.isfile(guild_config_file):
+            continue
+        if int(entry) == GUILD_ID:
+            print(f"⚠️ Warning: {guild_config_file} duplicates the main guild {GUILD_ID}. Ignoring.")
+            continue
+        guild_states.add(int(entry), guild_config_file, os.path.join(guilds_dir, entry), defaults=config)
+if kv_sync:
+    for state in guild_states:
+        state.follow(kv_sync)
+if len(guild_states) > 1:
+    print(f"🌍 Serving {len(guild_states)} guilds: {', '.join(str(guild_id) for guild_id in guild_states.ids())}")
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.guilds = True
 intents.members = True
-bot = commands.Bot(command_prefix="/", intents=intents)
+lean_gateway = config.get("lean_gateway", False)
+bot_options = {}
+if lean_gateway:
+    # Without the members intent role.members stays empty, moderators included. Staff access
+    # comes from role overwrites and command checks from interaction permissions, so nothing here
+    # needs that list; code that does must fetch members lazily through user_cache.get_member().
+    intents.members = False
+    bot_options.update(
+        max_messages=int(config.get("message_cache_size", 100)) or None,
+        chunk_guilds_at_startup=False,
+        member_cache_flags=discord.MemberCacheFlags.none()
+    )
+if config.get("sharded", len(guild_states) > 1):
+    if config.get("shard_count"):
+        bot_options["shard_count"] = int(config["shard_count"])
+        if config.get("shard_ids"):
+            bot_options["shard_ids"] = [int(shard_id) for shard_id in config["shard_ids"]]
+    bot = commands.AutoShardedBot(command_prefix="/", intents=intents, http_trace=metrics.trace_config(), **bot_options)
+else:
+    bot = commands.Bot(command_prefix="/", intents=intents, http_trace=metrics.trace_config(), **bot_options)
+outbound = SendScheduler(queue_size=int(config.get("send_queue_size", 256)))
+metrics.add_ratelimit_listener(outbound.note_rate_limit)
+startup_task = None
+interaction_tracer = InteractionTracer(
+    margin=float(config.get("interaction_defer_margin", 1.0)),
+    slow_threshold=float(config.get("slow_interaction_seconds", 1.5))
+)
+attachment_dedup_entries = int(config.get("attachment_dedup_entries", 2048))
+attachment_forwarder = AttachmentForwarder(
+    budget_bytes=int(config.get("attachment_budget_bytes", 32 * 1024 * 1024)),
+    spill_bytes=int(config.get("attachment_spill_bytes", 2 * 1024 * 1024)),
+    dedup=AttachmentDedupCache(
+        max_entries=attachment_dedup_entries,
+        max_age=float(config.get("attachment_dedup_max_age", 6 * 3600))
+    ) if attachment_dedup_entries > 0 else None
+)
+transcript_writer = TranscriptWriter(config.get("transcript_dir") or TRANSCRIPT_DIR) if config.get("transcript_capture", False) else None
+
+def ticket_transcript_path(transcript_dir, channel_id):
+    """The one transcript indexed for a ticket: the archiver's export if there is one, else the capture finalized at close.
+
+    The export is read back from the channel's full history, while the
+    capture only holds what the bot saw live, so the export wins once the
+    archiver has run.
+    """
+    for suffix in (".jsonl.gz", ".transcript.jsonl.gz"):
+        path = os.path.join(transcript_dir, f"{channel_id}{suffix}")
+        if os.path.exists(path):
+            return path
+    return None
+
+def closed_ticket_info(state, channel_id, channel=None):
+    """(ticket info, closed_at) for a ticket that left the open set, from the store's history or else the channel itself."""
+    if isinstance(state.ticket_backend, SqliteTicketBackend):
+        ticket_info, closed_at = state.ticket_backend.history(channel_id)
+        if ticket_info is not None:
+            return ticket_info, closed_at
+    ticket_info = {}
+    if channel is not None:
+        match = TICKET_TOPIC_OWNER.search(channel.topic or "")
+        if match:
+            ticket_info["user_id"] = int(match.group(1))
+        for key, cat_info in state.config_cache.categories.items():
+            if channel.category_id and (channel.category_id == cat_info["archive_category_id"] or channel.category_id in cat_info["archive_overflow_category_ids"]):
+                ticket_info["category_key"] = key
+                break
+    return ticket_info, None
+
+def index_exported_transcript(channel, transcript_path):
+    state = guild_states.get(channel.guild.id)
+    if state and state.search_index:
+        ticket_info, closed_at = closed_ticket_info(state, channel.id, channel)
+        state.search_index.index_ticket(channel.id, ticket_info, closed_at, ticket_transcript_path(os.path.dirname(transcript_path), channel.id))
+
+transcript_archiver = TranscriptArchiver(
+    config.get("transcript_dir") or TRANSCRIPT_DIR,
+    retention_days=float(config.get("archive_retention_days", 0)),
+    interval=float(config.get("archive_sweep_interval", 3600)),
+    on_exported=index_exported_transcript
+)
+relay_coalescer = RelayCoalescer(float(config.get("relay_debounce_seconds", 0)))
+user_cache = UserCache(bot, max_size=int(config.get("user_cache_size", 1024)), ttl=float(config.get("user_cache_ttl", 600)))
+
+def collect_component_stats():
+    """Gauge samples for /metrics from the stats() of the caches, send queue and channel pool."""
+    for state in guild_states:
+        yield "ticket_store_open_tickets", {"guild": str(state.guild_id)}, len(state.ticket_store)
+        for category_key, ready in state.channel_pool.stats().items():
+            yield "channel_pool_ready", {"guild": str(state.guild_id), "section": category_key}, ready
+    rss = resident_memory_bytes()
+    if rss:
+        yield "process_resident_memory_bytes", {}, rss
+    yield "gateway_cached_members", {}, sum(len(guild.members) for guild in bot.guilds)
+    for key, value in user_cache.stats().items():
+        yield f"user_cache_{key}", {}, value
+    scheduler_stats = outbound.stats()
+    for priority in PRIORITY_NAMES.values():
+        for key, value in scheduler_stats[priority].items():
+            yield f"send_queue_{key}", {"priority": priority}, value
+    yield "send_queue_routes", {}, scheduler_stats["routes"]
+    yield "send_queue_rate_limited", {}, scheduler_stats["rate_limited"]
+    if attachment_forwarder.dedup:
+        for key, value in attachment_forwarder.dedup.stats().items():
+            yield f"attachment_dedup_{key}", {}, value
+
+metrics.add_collector(collect_component_stats)
+
+gateway_recorder = GatewayRecorder(
+    config["gateway_capture_file"], guild_states.ids(),
+    redact=bool(config.get("gateway_capture_redact", False)),
+    ticket_prefix=guild_states.get(GUILD_ID).ticket_prefix
+) if config.get("gateway_capture_file") else None
 
 class TicketOpenView(View):
     def __init__(self):
         super().__init__(timeout=None)
 
 class CategorySelect(Select):
-    def __init__(self, user_id):
+    def __init__(self, user_id, state):
         self.user_id = user_id
-        options = []
-        current_config = load_json(CONFIG_FILE)
-        active_categories = current_config.get("active_categories", {})
-        if not active_categories:
-             options.append(SelectOption(label="لا توجد أقسام متاحة حالياً", value="no_category", emoji="⚠️"))
-        else:
-            for key, cat_info in active_categories.items():
-                category_emoji = cat_info.get("emoji")
-                options.append(SelectOption(
-                    label=cat_info.get("name", key),
-                    value=key,
-                    emoji=category_emoji
-                ))
+        self.state = state
+        options = list(state.config_cache.get().select_options)
         super().__init__(placeholder="اختر قسم التذكرة...", min_values=1, max_values=1, options=options, custom_id="category_select")
 
+    @metrics.timed("interaction_handler_seconds", handler="category_select")
+    @interaction_tracer.traced("category_select", auto_defer=False)
     async def callback(self, interaction: Interaction):
-        if not interaction.guild or interaction.guild.id != GUILD_ID: return
+        if not interaction.guild or interaction.guild.id != self.state.guild_id: return
         if interaction.user.id != self.user_id:
             await interaction.response.send_message("لا يمكنك اختيار قسم لتذكرة مستخدم آخر.", ephemeral=True)
             return
@@ -121,57 +2830,59 @@ class CategorySelect(Select):
              return
 
         await interaction.response.defer(ephemeral=True, thinking=True)
+        interaction_tracer.stage(interaction, "defer")
+        try:
+            async with ticket_locks.hold(("user", interaction.user.id), before_release=self.state.ticket_store.flush) as lease:
+                interaction_tracer.stage(interaction, "user_lock")
+                await self.open_ticket(interaction, selected_category_key, lease)
+        except LeaseLost as e:
+            print(f"⚠️ Gave up opening a ticket for {interaction.user.id}: {e}")
+            await outbound.followup(interaction, "❌ تعذر فتح التذكرة بسبب تعارض مؤقت. يرجى المحاولة مرة أخرى.", ephemeral=True)
+
+    async def open_ticket(self, interaction: Interaction, selected_category_key, lease):
+        """Creates the ticket; runs under the user's lock so repeated picks cannot open two channels.
+
+        Raises LeaseLost if the lock stops being exclusive before the ticket is
+        recorded; a channel created by then is deleted again.
+        """
         user = interaction.user
         guild = interaction.guild
+        state = self.state
+        ticket_store = state.ticket_store
 
-        current_tickets = load_json(TICKET_FILE)
-        current_config_check = load_json(CONFIG_FILE)
-
-        all_archive_category_ids = set()
-        for cat_data in current_config_check.get("active_categories", {}).values():
-            if cat_data.get("archive_category_id"):
-                try:
-                    all_archive_category_ids.add(int(cat_data["archive_category_id"]))
-                except (ValueError, TypeError):
-                    pass
+        current_config = state.config_cache.get()
+        all_archive_category_ids = current_config.archive_category_ids
 
         existing_ticket_channel_id = None
-        for chan_id_str, ticket_info in list(current_tickets.items()):
-            if ticket_info.get("user_id") == user.id:
-                try:
-                    chan_id = int(chan_id_str)
-                    existing_channel = guild.get_channel(chan_id)
-                    if existing_channel:
-                        if existing_channel.category_id not in all_archive_category_ids:
-                            existing_ticket_channel_id = chan_id
-                            break
-                        else:
-                            print(f"Ticket channel {chan_id} for user {user.id} found but is archived. Cleaning data.")
-                            if chan_id_str in current_tickets:
-                                del current_tickets[chan_id_str]
-                                save_json(TICKET_FILE, current_tickets)
+        for chan_id_str in ticket_store.channels_for_user(user.id):
+            try:
+                chan_id = int(chan_id_str)
+                existing_channel = guild.get_channel(chan_id)
+                if existing_channel:
+                    if existing_channel.category_id not in all_archive_category_ids:
+                        existing_ticket_channel_id = chan_id
+                        break
                     else:
-                        print(f"Orphaned ticket data found for user {user.id}, channel {chan_id} not found. Cleaning.")
-                        if chan_id_str in current_tickets:
-                            del current_tickets[chan_id_str]
-                            save_json(TICKET_FILE, current_tickets)
-                except (ValueError, TypeError):
-                    print(f"Invalid channel ID key '{chan_id_str}' found during check. Cleaning.")
-                    if chan_id_str in current_tickets:
-                        del current_tickets[chan_id_str]
-                        save_json(TICKET_FILE, current_tickets)
-
+                        print(f"Ticket channel {chan_id} for user {user.id} found but is archived. Cleaning data.")
+                        ticket_store.remove(chan_id_str)
+                else:
+                    print(f"Orphaned ticket data found for user {user.id}, channel {chan_id} not found. Cleaning.")
+                    ticket_store.remove(chan_id_str, status="orphaned")
+            except (ValueError, TypeError):
+                print(f"Invalid channel ID key '{chan_id_str}' found during check. Cleaning.")
+                ticket_store.remove(chan_id_str, status="orphaned")
+
+        interaction_tracer.stage(interaction, "existing_check")
         if existing_ticket_channel_id:
-            await interaction.followup.send(f"❌ لديك تذكرة مفتوحة بالفعل: <#{existing_ticket_channel_id}>", ephemeral=True)
+            await outbound.followup(interaction, f"❌ لديك تذكرة مفتوحة بالفعل: <#{existing_ticket_channel_id}>", ephemeral=True)
             try: await interaction.message.edit(content="لديك تذكرة مفتوحة بالفعل.", view=None)
             except discord.NotFound: pass
             except Exception as e_edit: print(f"Error editing interaction message on existing ticket: {e_edit}")
             return
 
-        current_config = load_json(CONFIG_FILE)
-        category_config = current_config.get("active_categories", {}).get(selected_category_key)
+        category_config = current_config.categories.get(selected_category_key)
         if not category_config or not category_config.get("category_id"):
-            await interaction.followup.send(f"❌ خطأ: القسم المختار '{selected_category_key}' غير معرف بشكل صحيح.", ephemeral=True)
+            await outbound.followup(interaction, f"❌ خطأ: القسم المختار '{selected_category_key}' غير معرف بشكل صحيح.", ephemeral=True)
             try: await interaction.message.edit(content="حدث خطأ في اختيار القسم.", view=None)
             except: pass
             return
@@ -180,13 +2891,13 @@ class CategorySelect(Select):
         target_category = guild.get_channel(target_category_id)
         if not target_category or not isinstance(target_category, CategoryChannel):
             print(f"⚠️ Warning: Active Category ID {target_category_id} for key '{selected_category_key}' not found or not a category.")
-            await interaction.followup.send(f"❌ خطأ: لم يتم العثور على الـ Category النشطة لقسم '{category_config.get('name', selected_category_key)}'.", ephemeral=True)
+            await outbound.followup(interaction, f"❌ خطأ: لم يتم العثور على الـ Category النشطة لقسم '{category_config.get('name', selected_category_key)}'.", ephemeral=True)
             try: await interaction.message.edit(content="حدث خطأ في العثور على فئة القسم.", view=None)
             except: pass
             return
 
-        mod_role = guild.get_role(MOD_ROLE_ID) if MOD_ROLE_ID else None
-        if not mod_role: print(f"⚠️ Warning: Moderator role {MOD_ROLE_ID} not found or not set.")
+        mod_role = guild.get_role(state.mod_role_id) if state.mod_role_id else None
+        if not mod_role: print(f"⚠️ Warning: Moderator role {state.mod_role_id} not found or not set.")
 
         overwrites = {
             guild.default_role: PermissionOverwrite(read_messages=False, view_channel=False),
@@ -196,36 +2907,72 @@ class CategorySelect(Select):
         if mod_role:
             overwrites[mod_role] = PermissionOverwrite(read_messages=True, send_messages=True, manage_messages=True, embed_links=True, attach_files=True, view_channel=True, manage_channels=False)
 
+        lease.check()
+        channel = None
         try:
             clean_user_name = "".join(c for c in user.name if c.isalnum() or c in ('-', '_')).lower()
             if not clean_user_name: clean_user_name = str(user.id)
-            channel_name = f"{TICKET_PREFIX}{clean_user_name}-{selected_category_key}"[:100]
-            channel = await guild.create_text_channel(
-                channel_name,
-                overwrites=overwrites,
-                category=target_category,
-                topic=f"Ticket for {user.name} ({user.id}) | Section: {category_config.get('name', selected_category_key)}",
-                reason=f"Ticket opened by {user.name} ({user.id}) for section {selected_category_key}"
-            )
+            channel_name = f"{state.ticket_prefix}{clean_user_name}-{selected_category_key}"[:100]
+            channel_topic = f"Ticket for {user.name} ({user.id}) | Section: {category_config.get('name', selected_category_key)}"
+            channel_reason = f"Ticket opened by {user.name} ({user.id}) for section {selected_category_key}"
+            pooled_channel = state.channel_pool.claim(guild, selected_category_key)
+            if pooled_channel:
+                state.channel_pool.refill(guild, selected_category_key, category_config)
+                try:
+                    await pooled_channel.edit(name=channel_name, overwrites=overwrites, topic=channel_topic, reason=channel_reason)
+                    channel = pooled_channel
+                except discord.NotFound:
+                    print(f"⚠️ Pooled channel {pooled_channel.id} vanished before it could be claimed.")
+            if channel is None:
+                reserved_category = await state.category_overflow.acquire(guild, selected_category_key, "active")
+                if reserved_category is None:
+                    print(f"❌ All categories for section '{selected_category_key}' are full and no overflow category could be created.")
+                    await outbound.followup(interaction, "❌ جميع فئات هذا القسم ممتلئة حالياً. يرجى المحاولة لاحقاً.", ephemeral=True)
+                    try: await interaction.message.edit(content="حدث خطأ في العثور على فئة القسم.", view=None)
+                    except: pass
+                    return
+                try:
+                    channel = await guild.create_text_channel(
+                        channel_name,
+                        overwrites=overwrites,
+                        category=reserved_category,
+                        topic=channel_topic,
+                        reason=channel_reason
+                    )
+                    state.category_overflow.channel_added(reserved_category.id, channel.id)
+                finally:
+                    state.category_overflow.release(reserved_category.id)
+        except LeaseLost:
+            raise
         except discord.errors.Forbidden:
             print(f"❌ Bot lacks permission to create channels in category {target_category_id}.")
-            await interaction.followup.send("❌ ليس لدى البوت صلاحية إنشاء قنوات في الفئة المحددة!", ephemeral=True)
+            await outbound.followup(interaction, "❌ ليس لدى البوت صلاحية إنشاء قنوات في الفئة المحددة!", ephemeral=True)
             try: await interaction.message.edit(content="حدث خطأ في صلاحيات البوت.", view=None)
             except: pass
             return
         except Exception as e:
             print(f"❌ Error creating channel for {user.name}: {e}")
-            await interaction.followup.send("❌ حدث خطأ أثناء محاولة إنشاء القناة.", ephemeral=True)
+            await outbound.followup(interaction, "❌ حدث خطأ أثناء محاولة إنشاء القناة.", ephemeral=True)
             try: await interaction.message.edit(content="حدث خطأ غير متوقع.", view=None)
             except: pass
             return
 
-        current_tickets = load_json(TICKET_FILE)
-        current_tickets[str(channel.id)] = {
+        interaction_tracer.stage(interaction, "channel_pooled" if channel is pooled_channel else "channel_created")
+        new_ticket_info = {
             "user_id": user.id,
-            "category_key": selected_category_key
+            "category_key": selected_category_key,
+            "opened_at": time.time()
         }
-        save_json(TICKET_FILE, current_tickets)
+        if lease.lost:
+            try:
+                await channel.delete(reason="Ticket lock was lost before the ticket was recorded")
+            except Exception as e:
+                print(f"⚠️ Could not delete half-created ticket channel {channel.id}; recording it as orphaned: {e}")
+                ticket_store.set(channel.id, new_ticket_info)
+                ticket_store.remove(channel.id, status="orphaned")
+            lease.check()
+        ticket_store.set(channel.id, new_ticket_info)
+        user_cache.remember(user)
 
         category_display_name = category_config.get('name', selected_category_key)
         category_emoji = category_config.get('emoji')
@@ -237,16 +2984,16 @@ class CategorySelect(Select):
         )
         welcome_embed.set_footer(text="لإغلاق التذكرة، استخدم أمر /close")
         mention_message = f"{user.mention}" + (f" {mod_role.mention}" if mod_role else "")
-        await channel.send(mention_message, embed=welcome_embed)
+        await outbound.send(channel, mention_message, embed=welcome_embed, priority=PRIORITY_NOTIFY)
 
         try:
             dm_embed = discord.Embed(title="📨 تم فتح التذكرة!", description=f"تم فتح تذكرة لك في **{guild.name}** قسم **{category_display_name}**.\nالقناة: <#{channel.id}>\nيمكنك الرد على هذه الرسالة مباشرة.", color=discord.Color.green())
-            await user.send(embed=dm_embed)
+            await outbound.send(user, embed=dm_embed, priority=PRIORITY_NOTIFY)
         except discord.errors.Forbidden:
             print(f"Could not send DM to {user.name}.")
-            await channel.send(f"⚠️ {user.mention} لم أتمكن من إرسال رسالة لك في الخاص.", delete_after=60)
+            await outbound.send(channel, f"⚠️ {user.mention} لم أتمكن من إرسال رسالة لك في الخاص.", delete_after=60, priority=PRIORITY_NOTIFY)
 
-        await interaction.followup.send(f"✅ تم فتح التذكرة بنجاح! <#{channel.id}>", ephemeral=True)
+        await outbound.followup(interaction, f"✅ تم فتح التذكرة بنجاح! <#{channel.id}>", ephemeral=True)
         try:
             await interaction.message.edit(content=f"تم فتح تذكرتك في قسم **{category_display_name}**: <#{channel.id}>", view=None)
         except discord.NotFound:
@@ -279,22 +3026,24 @@ class SetupModal(Modal, title="إعداد رسالة التيكت"):
             if embed_to_send: await interaction.channel.send(content=content_to_send, embed=embed_to_send, view=view)
             elif content_to_send: await interaction.channel.send(content=content_to_send, view=view)
             else: await interaction.channel.send(view=view)
-            await interaction.followup.send("✅ تم إعداد رسالة فتح التيكت بنجاح!", ephemeral=True)
+            await outbound.followup(interaction, "✅ تم إعداد رسالة فتح التيكت بنجاح!", ephemeral=True)
         except discord.errors.Forbidden:
-            await interaction.followup.send("❌ ليس لدى البوت صلاحية الإرسال في هذه القناة!", ephemeral=True)
+            await outbound.followup(interaction, "❌ ليس لدى البوت صلاحية الإرسال في هذه القناة!", ephemeral=True)
         except Exception as e_send:
             print(f"Error sending setup message: {e_send}")
-            await interaction.followup.send("❌ حدث خطأ أثناء إرسال الرسالة.", ephemeral=True)
+            await outbound.followup(interaction, "❌ حدث خطأ أثناء إرسال الرسالة.", ephemeral=True)
 
     async def on_error(self, interaction: Interaction, error: Exception) -> None:
         print(f"Error in SetupModal: {error}")
         if not interaction.response.is_done():
             await interaction.response.send_message("❌ حدث خطأ أثناء معالجة الإعداد.", ephemeral=True)
         else:
-            await interaction.followup.send("❌ حدث خطأ أثناء معالجة الإعداد.", ephemeral=True)
+            await outbound.followup(interaction, "❌ حدث خطأ أثناء معالجة الإعداد.", ephemeral=True)
 
 @bot.tree.command(name="setup", description="إرسال رسالة فتح تيكت مخصصة مع زر")
 @app_commands.checks.has_permissions(manage_guild=True)
+@metrics.timed("interaction_handler_seconds", handler="setup")
+@interaction_tracer.traced("setup", auto_defer=False)
 async def setup_command(interaction: discord.Interaction):
     await interaction.response.send_modal(SetupModal())
 
@@ -302,11 +3051,11 @@ async def setup_command(interaction: discord.Interaction):
 async def setup_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
     if isinstance(error, app_commands.MissingPermissions):
         if not interaction.response.is_done(): await interaction.response.send_message("❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
-        else: await interaction.followup.send("❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
+        else: await outbound.followup(interaction, "❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
     else:
         print(f"Error in setup command: {error}")
         if not interaction.response.is_done(): await interaction.response.send_message("❌ خطأ غير متوقع.", ephemeral=True)
-        else: await interaction.followup.send("❌ خطأ غير متوقع.", ephemeral=True)
+        else: await outbound.followup(interaction, "❌ خطأ غير متوقع.", ephemeral=True)
 
 @bot.tree.command(name="ctc", description="إنشاء قسم تيكت جديد مع فئة أرشيف خاصة به")
 @app_commands.describe(
@@ -315,209 +3064,251 @@ async def setup_command_error(interaction: discord.Interaction, error: app_comma
     emoji="الأيقونة (Emoji) التي ستظهر بجانب اسم القسم (اختياري)"
 )
 @app_commands.checks.has_permissions(manage_guild=True)
+@metrics.timed("interaction_handler_seconds", handler="ctc")
+@interaction_tracer.traced("ctc", auto_defer=False)
 async def create_ticket_category(interaction: discord.Interaction, internal_key: str, display_name: str, emoji: str = None):
     await interaction.response.defer(ephemeral=True)
     guild = interaction.guild
-
-    current_config = load_json(CONFIG_FILE)
-    active_categories = current_config.get("active_categories", {})
+    state = guild_states.get(interaction.guild_id)
+    if state is None:
+        await outbound.followup(interaction, "❌ هذا السيرفر غير مُعد لاستخدام البوت.", ephemeral=True); return
 
     internal_key = internal_key.lower().strip().replace(" ", "_")
     if not internal_key:
-        await interaction.followup.send("❌ المعرف الداخلي لا يمكن أن يكون فارغًا.", ephemeral=True); return
-    if internal_key in active_categories:
-        await interaction.followup.send(f"❌ المعرف الداخلي '{internal_key}' مستخدم بالفعل.", ephemeral=True); return
+        await outbound.followup(interaction, "❌ المعرف الداخلي لا يمكن أن يكون فارغًا.", ephemeral=True); return
+    async with ticket_locks.hold(("section", state.guild_id, internal_key)):
+        if internal_key in state.config_cache.get().categories:
+            await outbound.followup(interaction, f"❌ المعرف الداخلي '{internal_key}' مستخدم بالفعل.", ephemeral=True); return
 
-    mod_role = guild.get_role(MOD_ROLE_ID) if MOD_ROLE_ID else None
+        mod_role = guild.get_role(state.mod_role_id) if state.mod_role_id else None
 
-    active_overwrites = {
-        guild.default_role: PermissionOverwrite(read_messages=False, view_channel=False),
-        bot.user: PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True, view_channel=True)
-    }
-    if mod_role:
-        active_overwrites[mod_role] = PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True, view_channel=True)
+        active_overwrites = {
+            guild.default_role: PermissionOverwrite(read_messages=False, view_channel=False),
+            bot.user: PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True, view_channel=True)
+        }
+        if mod_role:
+            active_overwrites[mod_role] = PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True, view_channel=True)
 
-    new_active_category = None
-    new_archive_category = None
-    try:
-        active_category_name = f"{emoji} {display_name}" if emoji else display_name
-        new_active_category = await guild.create_category(
-            name=active_category_name[:100],
-            overwrites=active_overwrites,
-            reason=f"Active ticket category created by {interaction.user.name}"
-        )
-        print(f"✅ Created active category: {new_active_category.name} ({new_active_category.id})")
-    except discord.errors.Forbidden:
-        await interaction.followup.send("❌ ليس لدى البوت صلاحية إنشاء Categories!", ephemeral=True); return
-    except Exception as e:
-        print(f"❌ Error creating active Discord category: {e}")
-        await interaction.followup.send("❌ حدث خطأ أثناء إنشاء الـ Category النشطة.", ephemeral=True); return
+        new_active_category = None
+        new_archive_category = None
+        try:
+            active_category_name = f"{emoji} {display_name}" if emoji else display_name
+            new_active_category = await guild.create_category(
+                name=active_category_name[:100],
+                overwrites=active_overwrites,
+                reason=f"Active ticket category created by {interaction.user.name}"
+            )
+            print(f"✅ Created active category: {new_active_category.name} ({new_active_category.id})")
+        except discord.errors.Forbidden:
+            await outbound.followup(interaction, "❌ ليس لدى البوت صلاحية إنشاء Categories!", ephemeral=True); return
+        except Exception as e:
+            print(f"❌ Error creating active Discord category: {e}")
+            await outbound.followup(interaction, "❌ حدث خطأ أثناء إنشاء الـ Category النشطة.", ephemeral=True); return
 
-    archive_overwrites = {
-        guild.default_role: PermissionOverwrite(read_messages=False, view_channel=False),
-        bot.user: PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True, view_channel=True)
-    }
-    if mod_role:
-        archive_overwrites[mod_role] = PermissionOverwrite(read_messages=True, send_messages=False, manage_channels=True, view_channel=True)
+        archive_overwrites = {
+            guild.default_role: PermissionOverwrite(read_messages=False, view_channel=False),
+            bot.user: PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True, view_channel=True)
+        }
+        if mod_role:
+            archive_overwrites[mod_role] = PermissionOverwrite(read_messages=True, send_messages=False, manage_channels=True, view_channel=True)
 
-    try:
-        archive_category_name = f"📦 Archived - {display_name}"[:100]
-        new_archive_category = await guild.create_category(
-            name=archive_category_name,
-            overwrites=archive_overwrites,
-            reason=f"Archive category for '{display_name}' created by {interaction.user.name}"
-        )
-        print(f"✅ Created archive category: {new_archive_category.name} ({new_archive_category.id})")
-    except discord.errors.Forbidden:
-        await interaction.followup.send("❌ تم إنشاء الفئة النشطة، لكن ليس لدى البوت صلاحية إنشاء فئة الأرشيف!", ephemeral=True)
-        if new_active_category:
-            try: await new_active_category.delete(reason="Failed to create corresponding archive category")
-            except: print(f"⚠️ Failed to rollback active category {new_active_category.id}")
-        return
-    except Exception as e:
-        print(f"❌ Error creating archive Discord category: {e}")
-        await interaction.followup.send("❌ تم إنشاء الفئة النشطة، لكن حدث خطأ أثناء إنشاء فئة الأرشيف.", ephemeral=True)
-        if new_active_category:
-            try: await new_active_category.delete(reason="Failed to create corresponding archive category")
-            except: print(f"⚠️ Failed to rollback active category {new_active_category.id}")
-        return
+        try:
+            archive_category_name = f"📦 Archived - {display_name}"[:100]
+            new_archive_category = await guild.create_category(
+                name=archive_category_name,
+                overwrites=archive_overwrites,
+                reason=f"Archive category for '{display_name}' created by {interaction.user.name}"
+            )
+            print(f"✅ Created archive category: {new_archive_category.name} ({new_archive_category.id})")
+        except discord.errors.Forbidden:
+            await outbound.followup(interaction, "❌ تم إنشاء الفئة النشطة، لكن ليس لدى البوت صلاحية إنشاء فئة الأرشيف!", ephemeral=True)
+            if new_active_category:
+                try: await new_active_category.delete(reason="Failed to create corresponding archive category")
+                except: print(f"⚠️ Failed to rollback active category {new_active_category.id}")
+            return
+        except Exception as e:
+            print(f"❌ Error creating archive Discord category: {e}")
+            await outbound.followup(interaction, "❌ تم إنشاء الفئة النشطة، لكن حدث خطأ أثناء إنشاء فئة الأرشيف.", ephemeral=True)
+            if new_active_category:
+                try: await new_active_category.delete(reason="Failed to create corresponding archive category")
+                except: print(f"⚠️ Failed to rollback active category {new_active_category.id}")
+            return
 
-    active_categories[internal_key] = {
-        "name": display_name,
-        "category_id": new_active_category.id,
-        "emoji": emoji,
-        "archive_category_id": new_archive_category.id
-    }
-    current_config["active_categories"] = active_categories
-    if save_json(CONFIG_FILE, current_config):
-        global config
-        config = current_config
-        emoji_text = f" بالأيقونة {emoji}" if emoji else ""
-        await interaction.followup.send(
-            f"✅ تم إنشاء قسم التذاكر '{display_name}'{emoji_text} بنجاح.\n"
-            f"   - الفئة النشطة: {new_active_category.mention} (`{new_active_category.id}`)\n"
-            f"   - فئة الأرشيف: {new_archive_category.mention} (`{new_archive_category.id}`)",
-            ephemeral=True
-        )
-    else:
-        try: await new_active_category.delete(reason="Failed to save config")
-        except: pass
-        try: await new_archive_category.delete(reason="Failed to save config")
-        except: pass
-        await interaction.followup.send("❌ حدث خطأ أثناء حفظ الإعدادات. لم يتم حفظ القسم الجديد وتمت محاولة حذف الفئات.", ephemeral=True)
+        current_config = dict(state.config_cache.get().data)
+        active_categories = dict(current_config.get("active_categories") or {})
+        active_categories[internal_key] = {
+            "name": display_name,
+            "category_id": new_active_category.id,
+            "emoji": emoji,
+            "archive_category_id": new_archive_category.id
+        }
+        current_config["active_categories"] = active_categories
+        if await state.config_cache.save_async(current_config):
+            emoji_text = f" بالأيقونة {emoji}" if emoji else ""
+            await outbound.followup(interaction, 
+                f"✅ تم إنشاء قسم التذاكر '{display_name}'{emoji_text} بنجاح.\n"
+                f"   - الفئة النشطة: {new_active_category.mention} (`{new_active_category.id}`)\n"
+                f"   - فئة الأرشيف: {new_archive_category.mention} (`{new_archive_category.id}`)",
+                ephemeral=True
+            )
+        else:
+            try: await new_active_category.delete(reason="Failed to save config")
+            except: pass
+            try: await new_archive_category.delete(reason="Failed to save config")
+            except: pass
+            await outbound.followup(interaction, "❌ حدث خطأ أثناء حفظ الإعدادات. لم يتم حفظ القسم الجديد وتمت محاولة حذف الفئات.", ephemeral=True)
 
 @create_ticket_category.error
 async def create_ticket_category_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
      if isinstance(error, app_commands.MissingPermissions):
          if not interaction.response.is_done(): await interaction.response.send_message("❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
-         else: await interaction.followup.send("❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
+         else: await outbound.followup(interaction, "❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
      else:
          print(f"Error in create_ticket_category: {error}")
          if not interaction.response.is_done(): await interaction.response.send_message("❌ خطأ غير متوقع.", ephemeral=True)
-         else: await interaction.followup.send("❌ خطأ غير متوقع.", ephemeral=True)
+         else: await outbound.followup(interaction, "❌ خطأ غير متوقع.", ephemeral=True)
 
 @bot.tree.command(name="close", description="إغلاق وأرشفة التيكت الحالي إلى فئته المخصصة")
 @app_commands.checks.has_permissions(manage_messages=True)
+@metrics.timed("interaction_handler_seconds", handler="close")
+@interaction_tracer.traced("close")
 async def close_ticket(interaction: discord.Interaction):
     channel = interaction.channel
-    if not isinstance(channel, discord.TextChannel) or channel.guild.id != GUILD_ID:
-        await interaction.response.send_message("❌ هذا الأمر يعمل فقط في قنوات التيكت النصية داخل السيرفر.", ephemeral=True); return
+    state = guild_states.get(interaction.guild_id)
+    if not isinstance(channel, discord.TextChannel) or state is None:
+        await interaction_tracer.respond(interaction, "❌ هذا الأمر يعمل فقط في قنوات التيكت النصية داخل السيرفر.", ephemeral=True); return
 
     channel_id_str = str(channel.id)
-    current_tickets = load_json(TICKET_FILE)
-    ticket_info = current_tickets.get(channel_id_str)
+    ticket_store = state.ticket_store
+    ticket_info = ticket_store.get(channel_id_str)
+    interaction_tracer.stage(interaction, "ticket_lookup")
 
-    if not ticket_info and not channel.name.startswith(TICKET_PREFIX):
-         await interaction.response.send_message("❌ هذه القناة لا تبدو كقناة تيكت نشطة.", ephemeral=True); return
+    if not ticket_info and not channel.name.startswith(state.ticket_prefix):
+         await interaction_tracer.respond(interaction, "❌ هذه القناة لا تبدو كقناة تيكت نشطة.", ephemeral=True); return
 
     category_key = None
     if ticket_info:
         category_key = ticket_info.get("category_key")
     else:
         parts = channel.name.split('-')
-        if len(parts) > 1 and channel.name.startswith(TICKET_PREFIX):
+        if len(parts) > 1 and channel.name.startswith(state.ticket_prefix):
             potential_key = parts[-1]
-            temp_config = load_json(CONFIG_FILE)
-            if potential_key in temp_config.get("active_categories", {}):
+            if potential_key in state.config_cache.get().categories:
                 category_key = potential_key
                 print(f"ℹ️ Inferred category key '{category_key}' from channel name for closing.")
             else:
-                 await interaction.response.send_message(f"❌ لم أتمكن من تحديد القسم الأصلي للتذكرة من اسمها ('{potential_key}' غير موجود).", ephemeral=True); return
+                 await interaction_tracer.respond(interaction, f"❌ لم أتمكن من تحديد القسم الأصلي للتذكرة من اسمها ('{potential_key}' غير موجود).", ephemeral=True); return
         else:
-            await interaction.response.send_message("❌ لم أتمكن من تحديد القسم الأصلي للتذكرة.", ephemeral=True); return
+            await interaction_tracer.respond(interaction, "❌ لم أتمكن من تحديد القسم الأصلي للتذكرة.", ephemeral=True); return
 
     if not category_key:
-        await interaction.response.send_message("❌ لم يتم العثور على مفتاح القسم المرتبط بهذه التذكرة في البيانات.", ephemeral=True); return
+        await interaction_tracer.respond(interaction, "❌ لم يتم العثور على مفتاح القسم المرتبط بهذه التذكرة في البيانات.", ephemeral=True); return
 
-    current_config = load_json(CONFIG_FILE)
-    category_settings = current_config.get("active_categories", {}).get(category_key)
+    category_settings = state.config_cache.get().categories.get(category_key)
 
     if not category_settings:
-        await interaction.response.send_message(f"❌ خطأ: إعدادات القسم '{category_key}' غير موجودة في `config.json`.", ephemeral=True); return
+        await interaction_tracer.respond(interaction, f"❌ خطأ: إعدادات القسم '{category_key}' غير موجودة في `config.json`.", ephemeral=True); return
 
     archive_category_id = category_settings.get("archive_category_id")
     if not archive_category_id:
-        await interaction.response.send_message(f"❌ خطأ: لم يتم تحديد فئة أرشيف مخصصة للقسم '{category_settings.get('name', category_key)}' في الإعدادات!", ephemeral=True); return
+        await interaction_tracer.respond(interaction, f"❌ خطأ: لم يتم تحديد فئة أرشيف مخصصة للقسم '{category_settings.get('name', category_key)}' في الإعدادات!", ephemeral=True); return
 
     try:
-        archive_category = interaction.guild.get_channel(int(archive_category_id))
+        archive_category = interaction.guild.get_channel(archive_category_id)
         if not archive_category or not isinstance(archive_category, CategoryChannel):
-            await interaction.response.send_message(f"❌ خطأ: فئة الأرشيف المخصصة (ID: {archive_category_id}) للقسم '{category_settings.get('name', category_key)}' غير موجودة أو ليست Category صالحة!", ephemeral=True); return
+            await interaction_tracer.respond(interaction, f"❌ خطأ: فئة الأرشيف المخصصة (ID: {archive_category_id}) للقسم '{category_settings.get('name', category_key)}' غير موجودة أو ليست Category صالحة!", ephemeral=True); return
     except (ValueError, TypeError):
-         await interaction.response.send_message(f"❌ خطأ: ID فئة الأرشيف المخصصة ('{archive_category_id}') غير صالح في الإعدادات.", ephemeral=True); return
+         await interaction_tracer.respond(interaction, f"❌ خطأ: ID فئة الأرشيف المخصصة ('{archive_category_id}') غير صالح في الإعدادات.", ephemeral=True); return
     except discord.NotFound:
-         await interaction.response.send_message(f"❌ خطأ: فئة الأرشيف المخصصة (ID: {archive_category_id}) غير موجودة في Discord.", ephemeral=True); return
+         await interaction_tracer.respond(interaction, f"❌ خطأ: فئة الأرشيف المخصصة (ID: {archive_category_id}) غير موجودة في Discord.", ephemeral=True); return
 
-    if channel.category_id == archive_category.id:
-        await interaction.response.send_message("❌ هذه القناة موجودة بالفعل في فئة الأرشيف الخاصة بها.", ephemeral=True); return
+    if channel.category_id == archive_category.id or channel.category_id in category_settings.get("archive_overflow_category_ids", []):
+        await interaction_tracer.respond(interaction, "❌ هذه القناة موجودة بالفعل في فئة الأرشيف الخاصة بها.", ephemeral=True); return
 
+    interaction_tracer.stage(interaction, "archive_lookup")
     confirm_view = View(timeout=30)
+    @metrics.timed("interaction_handler_seconds", handler="close_confirm")
     async def confirm_callback(confirm_interaction: Interaction):
         if confirm_interaction.user.id != interaction.user.id:
             await confirm_interaction.response.send_message("فقط المستخدم الذي بدأ الأمر يمكنه التأكيد.", ephemeral=True); return
 
         await confirm_interaction.response.edit_message(content=f"⏳ جارٍ أرشفة التيكت {channel.mention} إلى {archive_category.mention}...", view=None)
 
-        user_id = ticket_info.get("user_id") if ticket_info else None
-        original_user = interaction.guild.get_member(user_id) if user_id else None
+        try:
+            async with ticket_locks.hold(("channel", channel.id), before_release=ticket_store.flush) as lease:
+                if (ticket_info and channel_id_str not in ticket_store) or channel.category_id in state.config_cache.get().archive_category_ids:
+                    await outbound.followup(confirm_interaction, "ℹ️ تمت أرشفة هذا التيكت بالفعل.", ephemeral=True); return
+
+                user_id = ticket_info.get("user_id") if ticket_info else None
+                original_user = None
+                if user_id:
+                    try: original_user = await user_cache.get_member(user_id, interaction.guild)
+                    except discord.HTTPException: pass
+
+                new_overwrites = channel.overwrites.copy()
+                if original_user:
+                     new_overwrites[original_user] = PermissionOverwrite(read_messages=True, send_messages=False, view_channel=True)
+                new_overwrites[interaction.guild.default_role] = PermissionOverwrite(send_messages=False, view_channel=False)
+                mod_role = interaction.guild.get_role(state.mod_role_id) if state.mod_role_id else None
+                if mod_role:
+                     new_overwrites[mod_role] = PermissionOverwrite(read_messages=True, send_messages=False, manage_channels=True, view_channel=True)
+                new_overwrites[bot.user] = PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True, view_channel=True)
+
+                target_archive_category = await state.category_overflow.acquire(interaction.guild, category_key, "archive")
+                if target_archive_category is None:
+                    await outbound.followup(confirm_interaction, "❌ جميع فئات الأرشيف لهذا القسم ممتلئة ولم أتمكن من إنشاء فئة إضافية.", ephemeral=True); return
 
-        new_overwrites = channel.overwrites.copy()
-        if original_user:
-             new_overwrites[original_user] = PermissionOverwrite(read_messages=True, send_messages=False, view_channel=True)
-        new_overwrites[interaction.guild.default_role] = PermissionOverwrite(send_messages=False, view_channel=False)
-        mod_role = interaction.guild.get_role(MOD_ROLE_ID) if MOD_ROLE_ID else None
-        if mod_role:
-             new_overwrites[mod_role] = PermissionOverwrite(read_messages=True, send_messages=False, manage_channels=True, view_channel=True)
-        new_overwrites[bot.user] = PermissionOverwrite(read_messages=True, send_messages=True, manage_channels=True, view_channel=True)
-
-        try:
-            base_name = channel.name.replace(TICKET_PREFIX, "", 1)
-            new_name = f"archived-{base_name}"[:100]
-            await channel.edit(
-                name=new_name,
-                category=archive_category,
-                overwrites=new_overwrites,
-                sync_permissions=False,
-                reason=f"Ticket archived by {interaction.user.name} to category {category_key}"
-            )
-        except discord.errors.Forbidden:
-            await confirm_interaction.followup.send("❌ ليس لدى البوت صلاحية نقل القناة أو تعديل صلاحياتها!", ephemeral=True); return
-        except Exception as e:
-            print(f"Error archiving channel {channel.id} to category {archive_category.id}: {e}")
-            await confirm_interaction.followup.send("❌ حدث خطأ أثناء أرشفة القناة.", ephemeral=True); return
+                try:
+                    lease.check()
+                    base_name = channel.name.replace(state.ticket_prefix, "", 1)
+                    new_name = f"archived-{base_name}"[:100]
+                    previous_category_id = channel.category_id
+                    await channel.edit(
+                        name=new_name,
+                        category=target_archive_category,
+                        overwrites=new_overwrites,
+                        sync_permissions=False,
+                        reason=f"Ticket archived by {interaction.user.name} to category {category_key}"
+                    )
+                    state.category_overflow.channel_removed(previous_category_id, channel.id)
+                    state.category_overflow.channel_added(target_archive_category.id, channel.id)
+                except LeaseLost:
+                    raise
+                except discord.errors.Forbidden:
+                    await outbound.followup(confirm_interaction, "❌ ليس لدى البوت صلاحية نقل القناة أو تعديل صلاحياتها!", ephemeral=True); return
+                except Exception as e:
+                    print(f"Error archiving channel {channel.id} to category {target_archive_category.id}: {e}")
+                    await outbound.followup(confirm_interaction, "❌ حدث خطأ أثناء أرشفة القناة.", ephemeral=True); return
+                finally:
+                    state.category_overflow.release(target_archive_category.id)
+
+                ticket_store.remove(channel_id_str)
+                if lean_gateway and user_id and not guild_states.open_tickets_for_user(user_id):
+                    user_cache.invalidate(user_id)
+
+                transcript_path = None
+                if transcript_writer:
+                    transcript_path = await transcript_writer.finalize(channel.id)
+                    if transcript_path and os.path.getsize(transcript_path) < interaction.guild.filesize_limit:
+                        try:
+                            await outbound.send(channel, "📜 سجل محادثة التذكرة:", file=File(transcript_path, filename=f"{channel.name}-transcript.jsonl.gz"), priority=PRIORITY_NOTIFY)
+                        except Exception as e_transcript:
+                            print(f"Error uploading transcript for channel {channel.id}: {e_transcript}")
 
-        current_tickets_on_confirm = load_json(TICKET_FILE)
-        if channel_id_str in current_tickets_on_confirm:
-            del current_tickets_on_confirm[channel_id_str]
-            save_json(TICKET_FILE, current_tickets_on_confirm)
+                if original_user:
+                    try:
+                        await outbound.send(original_user, priority=PRIORITY_NOTIFY, content=f"✅ تم إغلاق وأرشفة التيكت الخاص بك (قسم {category_settings.get('name', category_key)}) في سيرفر **{interaction.guild.name}** بواسطة {interaction.user.mention}.")
+                    except discord.errors.Forbidden: print(f"Could not notify user {user_id} about ticket archival (DM closed).")
+                    except Exception as e_dm: print(f"Error notifying user {user_id} about ticket archival: {e_dm}")
 
-        if original_user:
-            try:
-                await original_user.send(f"✅ تم إغلاق وأرشفة التيكت الخاص بك (قسم {category_settings.get('name', category_key)}) في سيرفر **{interaction.guild.name}** بواسطة {interaction.user.mention}.")
-            except discord.errors.Forbidden: print(f"Could not notify user {user_id} about ticket archival (DM closed).")
-            except Exception as e_dm: print(f"Error notifying user {user_id} about ticket archival: {e_dm}")
+                await outbound.followup(confirm_interaction, f"✅ تم أرشفة التيكت {channel.mention} إلى {target_archive_category.mention} بنجاح.", ephemeral=True)
 
-        await confirm_interaction.followup.send(f"✅ تم أرشفة التيكت {channel.mention} إلى {archive_category.mention} بنجاح.", ephemeral=True)
+                if state.search_index:
+                    index_info = dict(ticket_info) if ticket_info else {"category_key": category_key}
+                    await asyncio.get_running_loop().run_in_executor(None, state.search_index.index_ticket, channel.id, index_info, time.time(), transcript_path)
+        except LeaseLost as e:
+            print(f"⚠️ Gave up archiving ticket channel {channel.id}: {e}")
+            await outbound.followup(confirm_interaction, "❌ تعذر أرشفة التيكت بسبب تعارض مؤقت. يرجى المحاولة مرة أخرى.", ephemeral=True)
 
     async def cancel_callback(cancel_interaction: Interaction):
          if cancel_interaction.user.id != interaction.user.id:
@@ -530,78 +3321,99 @@ async def close_ticket(interaction: discord.Interaction):
     cancel_button.callback = cancel_callback
     confirm_view.add_item(confirm_button)
     confirm_view.add_item(cancel_button)
-    await interaction.response.send_message(f"❓ هل أنت متأكد من إغلاق وأرشفة التيكت {channel.mention}؟ سيتم نقله إلى {archive_category.mention}.", view=confirm_view, ephemeral=True)
+    await interaction_tracer.respond(interaction, f"❓ هل أنت متأكد من إغلاق وأرشفة التيكت {channel.mention}؟ سيتم نقله إلى {archive_category.mention}.", view=confirm_view, ephemeral=True)
 
 @close_ticket.error
 async def close_ticket_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
      if isinstance(error, app_commands.MissingPermissions):
          if not interaction.response.is_done(): await interaction.response.send_message("❌ ليس لديك صلاحية `Manage Messages`.", ephemeral=True)
-         else: await interaction.followup.send("❌ ليس لديك صلاحية `Manage Messages`.", ephemeral=True)
+         else: await outbound.followup(interaction, "❌ ليس لديك صلاحية `Manage Messages`.", ephemeral=True)
      else:
          print(f"Error in close command: {error}")
          if not interaction.response.is_done(): await interaction.response.send_message("❌ خطأ غير متوقع.", ephemeral=True)
-         else: await interaction.followup.send("❌ خطأ غير متوقع.", ephemeral=True)
+         else: await outbound.followup(interaction, "❌ خطأ غير متوقع.", ephemeral=True)
 
 @bot.tree.command(name="r", description="رد على المستخدم صاحب التيكت في رسائله الخاصة")
 @app_commands.describe(message="الرسالة التي تريد إرسالها للمستخدم")
 @app_commands.checks.has_permissions(manage_messages=True)
+@metrics.timed("interaction_handler_seconds", handler="r")
+@interaction_tracer.traced("r")
 async def reply_to_user(interaction: discord.Interaction, message: str):
     channel = interaction.channel
-    if not isinstance(channel, discord.TextChannel) or not channel.guild or channel.guild.id != GUILD_ID:
-        await interaction.response.send_message("❌ هذا الأمر يعمل فقط في قنوات التيكت النصية داخل السيرفر.", ephemeral=True); return
+    state = guild_states.get(interaction.guild_id)
+    if not isinstance(channel, discord.TextChannel) or not channel.guild or state is None:
+        await interaction_tracer.respond(interaction, "❌ هذا الأمر يعمل فقط في قنوات التيكت النصية داخل السيرفر.", ephemeral=True); return
 
     channel_id_str = str(channel.id)
-    current_tickets = load_json(TICKET_FILE)
-    ticket_info = current_tickets.get(channel_id_str)
+    ticket_store = state.ticket_store
+    ticket_info = ticket_store.get(channel_id_str)
+    interaction_tracer.stage(interaction, "ticket_lookup")
 
     if not ticket_info or not ticket_info.get("user_id"):
-        await interaction.response.send_message("❌ هذه القناة لا تبدو كقناة تيكت نشطة أو أنها مؤرشفة.", ephemeral=True)
+        await interaction_tracer.respond(interaction, "❌ هذه القناة لا تبدو كقناة تيكت نشطة أو أنها مؤرشفة.", ephemeral=True)
         return
 
     user_id = ticket_info["user_id"]
     target_user = None
+    target_dm = None
     try:
-        target_user = await bot.fetch_user(user_id)
+        target_user = await user_cache.get_user(user_id, interaction.guild)
+        target_dm = await user_cache.get_dm_channel(user_id, interaction.guild)
     except discord.NotFound:
-        await interaction.response.send_message(f"❌ لم يتم العثور على المستخدم (ID: {user_id}).", ephemeral=True); return
+        await interaction_tracer.respond(interaction, f"❌ لم يتم العثور على المستخدم (ID: {user_id}).", ephemeral=True); return
     except Exception as e_fetch:
         print(f"Error fetching user {user_id}: {e_fetch}")
-        await interaction.response.send_message(f"❌ خطأ أثناء محاولة الوصول للمستخدم (ID: {user_id}).", ephemeral=True); return
-
-    staff_member = interaction.user
-    embed_to_user = discord.Embed(description=message, color=discord.Color.blue())
-    embed_to_user.set_author(name=f"رد من فريق الدعم ({staff_member.display_name})", icon_url=staff_member.display_avatar.url if staff_member.display_avatar else None)
-    embed_to_user.set_footer(text=f"من سيرفر: {interaction.guild.name} | قناة: #{channel.name}")
-    embed_to_user.timestamp = discord.utils.utcnow()
+        await interaction_tracer.respond(interaction, f"❌ خطأ أثناء محاولة الوصول للمستخدم (ID: {user_id}).", ephemeral=True); return
 
     try:
-        await target_user.send(embed=embed_to_user)
-    except discord.errors.Forbidden:
-        await interaction.response.send_message(f"❌ لا يمكن إرسال الرسالة إلى {target_user.mention} (الخاص مغلق أو قام بحظر البوت).", ephemeral=True)
-        await channel.send(f"⚠️ لم يتمكن البوت من إرسال الرد للخاص للمستخدم {target_user.mention}. رسالة من {staff_member.mention}:\n>>> {message}")
-        return
-    except Exception as e:
-        print(f"Error DM reply: {e}")
-        await interaction.response.send_message("❌ خطأ أثناء إرسال الرسالة للخاص.", ephemeral=True)
-        return
-
-    embed_in_channel = discord.Embed(description=message, color=discord.Color.green())
-    embed_in_channel.set_author(name=f"⬆️ رسالة أُرسلت إلى {target_user.name} بواسطة {staff_member.display_name}", icon_url=staff_member.display_avatar.url if staff_member.display_avatar else None)
-    embed_in_channel.timestamp = discord.utils.utcnow()
-    await channel.send(embed=embed_in_channel)
-    await interaction.response.send_message("✅ تم إرسال الرد للمستخدم بنجاح.", ephemeral=True)
+        async with ticket_locks.hold(("channel", channel.id), before_release=ticket_store.flush) as lease:
+            if channel_id_str not in ticket_store:
+                await interaction_tracer.respond(interaction, "❌ تم إغلاق هذه التذكرة للتو.", ephemeral=True); return
+            interaction_tracer.stage(interaction, "user_fetch")
+            staff_member = interaction.user
+            embed_to_user = discord.Embed(description=message, color=discord.Color.blue())
+            embed_to_user.set_author(name=f"رد من فريق الدعم ({staff_member.display_name})", icon_url=staff_member.display_avatar.url if staff_member.display_avatar else None)
+            embed_to_user.set_footer(text=f"من سيرفر: {interaction.guild.name} | قناة: #{channel.name}")
+            embed_to_user.timestamp = discord.utils.utcnow()
+
+            lease.check()
+            try:
+                await outbound.send(target_dm, embed=embed_to_user)
+                metrics.inc("relay_messages_total", direction="reply")
+                interaction_tracer.stage(interaction, "dm_send")
+            except discord.errors.Forbidden:
+                await interaction_tracer.respond(interaction, f"❌ لا يمكن إرسال الرسالة إلى {target_user.mention} (الخاص مغلق أو قام بحظر البوت).", ephemeral=True)
+                await outbound.send(channel, priority=PRIORITY_NOTIFY, content=f"⚠️ لم يتمكن البوت من إرسال الرد للخاص للمستخدم {target_user.mention}. رسالة من {staff_member.mention}:\n>>> {message}")
+                return
+            except Exception as e:
+                print(f"Error DM reply: {e}")
+                await interaction_tracer.respond(interaction, "❌ خطأ أثناء إرسال الرسالة للخاص.", ephemeral=True)
+                return
+
+            embed_in_channel = discord.Embed(description=message, color=discord.Color.green())
+            embed_in_channel.set_author(name=f"⬆️ رسالة أُرسلت إلى {target_user.name} بواسطة {staff_member.display_name}", icon_url=staff_member.display_avatar.url if staff_member.display_avatar else None)
+            embed_in_channel.timestamp = discord.utils.utcnow()
+            await outbound.send(channel, embed=embed_in_channel)
+            if transcript_writer:
+                transcript_writer.record(channel.id, "reply", staff_member, message)
+            await interaction_tracer.respond(interaction, "✅ تم إرسال الرد للمستخدم بنجاح.", ephemeral=True)
+    except LeaseLost as e:
+        print(f"⚠️ Gave up relaying a reply in ticket channel {channel.id}: {e}")
+        await interaction_tracer.respond(interaction, "❌ تعذر إرسال الرد بسبب تعارض مؤقت. يرجى المحاولة مرة أخرى.", ephemeral=True)
 
 @reply_to_user.error
 async def reply_to_user_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
      if isinstance(error, app_commands.MissingPermissions):
          if not interaction.response.is_done(): await interaction.response.send_message("❌ ليس لديك صلاحية `Manage Messages`.", ephemeral=True)
-         else: await interaction.followup.send("❌ ليس لديك صلاحية `Manage Messages`.", ephemeral=True)
+         else: await outbound.followup(interaction, "❌ ليس لديك صلاحية `Manage Messages`.", ephemeral=True)
      else:
          print(f"Error in reply command: {error}")
          if not interaction.response.is_done(): await interaction.response.send_message("❌ خطأ غير متوقع.", ephemeral=True)
-         else: await interaction.followup.send("❌ خطأ غير متوقع.", ephemeral=True)
+         else: await outbound.followup(interaction, "❌ خطأ غير متوقع.", ephemeral=True)
 
 @bot.tree.command(name="ping", description="عرض سرعة استجابة البوت (البنج)")
+@metrics.timed("interaction_handler_seconds", handler="ping")
+@interaction_tracer.traced("ping")
 async def ping(interaction: discord.Interaction):
     """Calculates and displays the bot's latency."""
     latency_ms = round(bot.latency * 1000)
@@ -611,11 +3423,11 @@ async def ping(interaction: discord.Interaction):
         color=discord.Color.green() if latency_ms < 150 else (discord.Color.orange() if latency_ms < 300 else discord.Color.red())
     )
     try:
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        await interaction_tracer.respond(interaction, embed=embed, ephemeral=True)
     except Exception as e:
         print(f"Error sending ping response: {e}")
         try:
-            await interaction.response.send_message(f"Pong! {latency_ms}ms", ephemeral=True)
+            await interaction_tracer.respond(interaction, f"Pong! {latency_ms}ms", ephemeral=True)
         except Exception as e_fallback:
              print(f"Failed to send fallback ping response: {e_fallback}")
 
@@ -627,104 +3439,443 @@ async def ping_error(interaction: discord.Interaction, error: app_commands.AppCo
         if not interaction.response.is_done():
             await interaction.response.send_message("❌ حدث خطأ أثناء حساب البنج.", ephemeral=True)
         else:
-            await interaction.followup.send("❌ حدث خطأ أثناء حساب البنج.", ephemeral=True)
+            await outbound.followup(interaction, "❌ حدث خطأ أثناء حساب البنج.", ephemeral=True)
     except Exception as e_handler:
         print(f"Error within ping error handler: {e_handler}")
 
+@bot.tree.command(name="reload", description="إعادة تحميل ملف الإعدادات config.json")
+@app_commands.checks.has_permissions(manage_guild=True)
+@metrics.timed("interaction_handler_seconds", handler="reload")
+@interaction_tracer.traced("reload")
+async def reload_config(interaction: discord.Interaction):
+    state = guild_states.get(interaction.guild_id)
+    if state is None:
+        await interaction_tracer.respond(interaction, "❌ هذا السيرفر غير مُعد لاستخدام البوت.", ephemeral=True); return
+    category_count = await state.config_cache.reload_async()
+    state.channel_pool.refill_all(interaction.guild, state.config_cache.categories)
+    print(f"🔄 Configuration reloaded by {interaction.user.name}: {category_count} categories.")
+    await interaction_tracer.respond(interaction, f"✅ تم إعادة تحميل الإعدادات. عدد الأقسام: **{category_count}**.", ephemeral=True)
+
+@reload_config.error
+async def reload_config_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    if isinstance(error, app_commands.MissingPermissions):
+        if not interaction.response.is_done(): await interaction.response.send_message("❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
+        else: await outbound.followup(interaction, "❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
+    else:
+        print(f"Error in reload command: {error}")
+        if not interaction.response.is_done(): await interaction.response.send_message("❌ خطأ غير متوقع.", ephemeral=True)
+        else: await outbound.followup(interaction, "❌ خطأ غير متوقع.", ephemeral=True)
+
+SEARCH_PAGE_SIZE = 10
+
+def build_search_embed(query, hits, page, categories):
+    title = f"🔎 نتائج البحث: {query}" if query else "🔎 التذاكر المغلقة"
+    embed = discord.Embed(title=title[:256], color=discord.Color.blurple())
+    if not hits:
+        embed.description = "لا توجد نتائج."
+    for hit in hits:
+        section = categories.get(hit["category_key"], {}).get("name", hit["category_key"] or "؟")
+        closed = f"<t:{int(hit['closed_at'])}:d>" if hit["closed_at"] else "—"
+        user = f"<@{hit['user_id']}>" if hit["user_id"] else "—"
+        value = f"<#{hit['channel_id']}> • {user} • {closed}"
+        if hit["snippet"]:
+            value += f"\n> {hit['snippet'][:300]}"
+        embed.add_field(name=f"{section} • {hit['channel_id']}", value=value[:1024], inline=False)
+    embed.set_footer(text=f"صفحة {page + 1}")
+    return embed
+
+class TicketSearchView(View):
+    def __init__(self, owner_id, state, query, user_id, category_key, page, has_next):
+        super().__init__(timeout=300)
+        self.owner_id = owner_id
+        self.state = state
+        self.query = query
+        self.user_id = user_id
+        self.category_key = category_key
+        self.page = page
+        self.previous_page.disabled = page == 0
+        self.next_page.disabled = not has_next
+
+    async def fetch(self, page):
+        hits = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.state.search_index.search(self.query, self.user_id, self.category_key, limit=SEARCH_PAGE_SIZE + 1, offset=page * SEARCH_PAGE_SIZE)
+        )
+        return hits[:SEARCH_PAGE_SIZE], len(hits) > SEARCH_PAGE_SIZE
+
+    async def show(self, interaction: Interaction, page):
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("فقط المستخدم الذي بدأ البحث يمكنه تقليب الصفحات.", ephemeral=True); return
+        hits, has_next = await self.fetch(page)
+        self.page = page
+        self.previous_page.disabled = page == 0
+        self.next_page.disabled = not has_next
+        await interaction.response.edit_message(embed=build_search_embed(self.query, hits, page, self.state.config_cache.get().categories), view=self)
+
+    @discord.ui.button(label="◀️ السابق", style=ButtonStyle.grey)
+    async def previous_page(self, interaction: Interaction, button: Button):
+        await self.show(interaction, max(self.page - 1, 0))
+
+    @discord.ui.button(label="التالي ▶️", style=ButtonStyle.grey)
+    async def next_page(self, interaction: Interaction, button: Button):
+        await self.show(interaction, self.page + 1)
+
+tickets_group = app_commands.Group(name="tickets", description="أدوات سجل التذاكر")
+
+@tickets_group.command(name="search", description="البحث في محادثات وبيانات التذاكر المغلقة")
+@app_commands.describe(query="كلمات البحث داخل المحادثات", user="صاحب التذكرة", section="مفتاح القسم", page="رقم الصفحة")
+@app_commands.checks.has_permissions(manage_messages=True)
+@metrics.timed("interaction_handler_seconds", handler="tickets search")
+@interaction_tracer.traced("tickets search", auto_defer=False)
+async def tickets_search(interaction: discord.Interaction, query: str = None, user: discord.User = None, section: str = None, page: app_commands.Range[int, 1, 1000] = 1):
+    state = guild_states.get(interaction.guild_id)
+    if state is None:
+        await interaction.response.send_message("❌ هذا السيرفر غير مُعد لاستخدام البوت.", ephemeral=True); return
+    if not state.search_index:
+        await interaction.response.send_message("❌ فهرس البحث غير مفعّل. فعّل `search_index` في `config.json`.", ephemeral=True); return
+    if not query and not user and not section:
+        await interaction.response.send_message("❌ حدد كلمات بحث أو مستخدماً أو قسماً على الأقل.", ephemeral=True); return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    view = TicketSearchView(interaction.user.id, state, query, user.id if user else None, section, page - 1, False)
+    try:
+        hits, has_next = await view.fetch(page - 1)
+    except sqlite3.Error as e:
+        print(f"❌ Error searching tickets for '{query}': {e}")
+        await outbound.followup(interaction, "❌ حدث خطأ أثناء البحث.", ephemeral=True); return
+    view.next_page.disabled = not has_next
+    await outbound.followup(interaction, embed=build_search_embed(query, hits, page - 1, state.config_cache.get().categories), view=view, ephemeral=True)
+
+@tickets_search.autocomplete("section")
+async def tickets_search_section_autocomplete(interaction: discord.Interaction, current: str):
+    state = guild_states.get(interaction.guild_id)
+    if state is None:
+        return []
+    return [
+        app_commands.Choice(name=settings.get("name", key)[:100], value=key)
+        for key, settings in state.config_cache.get().categories.items()
+        if current.lower() in key.lower() or current.lower() in settings.get("name", "").lower()
+    ][:25]
+
+@tickets_search.error
+async def tickets_search_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    if isinstance(error, app_commands.MissingPermissions):
+        if not interaction.response.is_done(): await interaction.response.send_message("❌ ليس لديك صلاحية `Manage Messages`.", ephemeral=True)
+        else: await outbound.followup(interaction, "❌ ليس لديك صلاحية `Manage Messages`.", ephemeral=True)
+    else:
+        print(f"Error in tickets search command: {error}")
+        if not interaction.response.is_done(): await interaction.response.send_message("❌ خطأ غير متوقع.", ephemeral=True)
+        else: await outbound.followup(interaction, "❌ خطأ غير متوقع.", ephemeral=True)
+
+bot.tree.add_command(tickets_group)
+
+@bot.tree.command(name="stats", description="عرض إحصائيات أداء البوت")
+@app_commands.checks.has_permissions(manage_guild=True)
+@metrics.timed("interaction_handler_seconds", handler="stats")
+@interaction_tracer.traced("stats")
+async def stats_command(interaction: discord.Interaction):
+    state = guild_states.get(interaction.guild_id)
+    if state is None:
+        await interaction_tracer.respond(interaction, "❌ هذا السيرفر غير مُعد لاستخدام البوت.", ephemeral=True); return
+    uptime = time.time() - metrics.started_at
+    embed = discord.Embed(title="📈 إحصائيات البوت", color=discord.Color.blurple())
+    embed.description = f"مدة التشغيل: **{datetime.timedelta(seconds=int(uptime))}** | البنج: **{round(bot.latency * 1000)}ms** | التذاكر المفتوحة: **{len(state.ticket_store)}**"
+    if len(guild_states) > 1:
+        embed.description += f" | كل السيرفرات: **{sum(len(other.ticket_store) for other in guild_states)}** في **{len(guild_states)}** سيرفر"
+
+    handlers = metrics.histogram_summary("interaction_handler_seconds", by="handler")
+    if handlers:
+        embed.add_field(name="⏱️ زمن الأوامر (عدد • متوسط • p50 • p99)", value="\n".join(
+            f"`{handler}`: {s['count']} • {s['avg_ms']}ms • {s['p50_ms']}ms • {s['p99_ms']}ms" for handler, s in sorted(handlers.items())
+        )[:1024], inline=False)
+
+    rest_routes = metrics.counter_totals("discord_rest_requests_total", by="route")
+    rate_limited = metrics.counter_totals("discord_rest_ratelimited_total", by="route")
+    rest_lines = [f"الطلبات: **{sum(rest_routes.values())}** | 429: **{sum(rate_limited.values())}**"]
+    rest_lines += [f"`{route}`: {count}" + (f" (429: {rate_limited[route]})" if route in rate_limited else "") for route, count in sorted(rest_routes.items(), key=lambda item: -item[1])[:5]]
+    embed.add_field(name="🌐 REST", value="\n".join(rest_lines)[:1024], inline=False)
+
+    relayed = metrics.counter_totals("relay_messages_total", by="direction")
+    delivery = metrics.histogram_summary("relay_delivery_seconds", by="direction")
+    relay_lines = [
+        f"`{direction}`: {count} ({round(count / max(uptime / 60, 1), 2)}/دقيقة)" + (f" • p99 {delivery[direction]['p99_ms']}ms" if direction in delivery else "")
+        for direction, count in sorted(relayed.items())
+    ]
+    embed.add_field(name="📨 نقل الرسائل", value="\n".join(relay_lines) or "لا يوجد", inline=False)
+
+    json_io = metrics.histogram_summary("json_io_seconds", by="op")
+    store_flush = metrics.histogram_summary("ticket_store_flush_seconds", by="status")
+    io_lines = [f"JSON `{op}`: {s['count']} • {s['avg_ms']}ms • p99 {s['p99_ms']}ms" for op, s in sorted(json_io.items())]
+    io_lines += [f"حفظ التذاكر `{status}`: {s['count']} • {s['avg_ms']}ms • p99 {s['p99_ms']}ms" for status, s in sorted(store_flush.items())]
+    embed.add_field(name="💾 القرص", value="\n".join(io_lines) or "لا يوجد", inline=False)
+
+    user_stats = user_cache.stats()
+    scheduler_stats = outbound.stats()
+    cache_lines = [
+        f"المستخدمون: {user_stats['size']} • إصابة {round(user_stats['hit_rate'] * 100, 1)}% • REST {user_stats['rest_fetches']}",
+        "طابور الإرسال: " + " | ".join(f"{PRIORITY_NAMES[p]} {scheduler_stats[PRIORITY_NAMES[p]]['queued']}/{scheduler_stats[PRIORITY_NAMES[p]]['sent']} ({scheduler_stats[PRIORITY_NAMES[p]]['avg_wait_ms']}ms)" for p in PRIORITY_NAMES) + f" • 429: {scheduler_stats['rate_limited']}"
+    ]
+    if attachment_forwarder.dedup:
+        dedup_stats = attachment_forwarder.dedup.stats()
+        cache_lines.append(f"المرفقات المكررة: {dedup_stats['hits']} • وفّرت {round(dedup_stats['bytes_saved'] / (1024 * 1024), 1)}MB")
+    pool_stats = state.channel_pool.stats()
+    if pool_stats:
+        cache_lines.append("القنوات الجاهزة: " + ", ".join(f"{key} {ready}" for key, ready in pool_stats.items()))
+    embed.add_field(name="🗃️ الكاش", value="\n".join(cache_lines)[:1024], inline=False)
+    await interaction_tracer.respond(interaction, embed=embed, ephemeral=True)
+
+@stats_command.error
+async def stats_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    if isinstance(error, app_commands.MissingPermissions):
+        if not interaction.response.is_done(): await interaction.response.send_message("❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
+        else: await outbound.followup(interaction, "❌ ليس لديك صلاحية `Manage Server`.", ephemeral=True)
+    else:
+        print(f"Error in stats command: {error}")
+        if not interaction.response.is_done(): await interaction.response.send_message("❌ خطأ غير متوقع.", ephemeral=True)
+        else: await outbound.followup(interaction, "❌ خطأ غير متوقع.", ephemeral=True)
+
 @bot.event
 async def on_ready():
+    global startup_task
     print(f"✅ Logged in as {bot.user.name} ({bot.user.id})")
     print(f"🔗 Invite Link: https://discord.com/api/oauth2/authorize?client_id={bot.user.id}&permissions=8&scope=bot%20applications.commands")
-    guild = bot.get_guild(GUILD_ID)
-    if not guild:
-        print(f"❌ Error: Bot not in specified guild {GUILD_ID}.")
-        await bot.close(); return
-    else:
+    targets = []
+    for state in guild_states:
+        guild = bot.get_guild(state.guild_id)
+        if not guild:
+            print(f"❌ Error: Bot not in specified guild {state.guild_id}.")
+            continue
         print(f"🌍 Operating in guild: {guild.name} ({guild.id})")
+        state.category_overflow.rebuild(guild)
+        targets.append((state, guild))
+    if not targets:
+        await bot.close(); return
+    if startup_task is not None:
+        print("🔁 Gateway session re-established; startup reconciliation already ran.")
+        return
+    if kv_sync:
+        kv_sync.start()
+    print(f"⏱️ Gateway ready {time.monotonic() - STARTED_AT:.2f}s after start ({'lean' if lean_gateway else 'full'} mode, {sum(len(guild.members) for _, guild in targets)} cached members, resident memory {_format_memory(resident_memory_bytes())}).")
+    startup_task = asyncio.get_running_loop().create_task(startup_reconcile(targets))
 
-        current_config = load_json(CONFIG_FILE)
-        current_ticket_data = load_json(TICKET_FILE)
+    await sync_command_tree(force="--sync-commands" in sys.argv)
 
-        all_archive_category_ids = set()
-        for cat_data in current_config.get("active_categories", {}).values():
-            if cat_data.get("archive_category_id"):
-                try:
-                    all_archive_category_ids.add(int(cat_data["archive_category_id"]))
-                except (ValueError, TypeError):
-                    print(f"⚠️ Invalid archive category ID '{cat_data['archive_category_id']}' found in config during startup cleanup.")
-
-        print(f"🔍 Found {len(all_archive_category_ids)} potential archive category IDs for cleanup: {all_archive_category_ids}")
-
-        tickets_to_remove = []
-        for channel_id_str, ticket_info in list(current_ticket_data.items()):
-             try:
-                 channel_id = int(channel_id_str)
-                 channel = guild.get_channel(channel_id)
-                 if not channel:
-                     print(f"🧹 Ticket channel {channel_id} (from data) not found. Removing.")
-                     tickets_to_remove.append(channel_id_str)
-                 elif channel.category_id in all_archive_category_ids:
-                     print(f"🧹 Ticket channel {channel_id} is in an archive category ({channel.category_id}). Removing from active data.")
-                     tickets_to_remove.append(channel_id_str)
-             except (ValueError, TypeError):
-                  print(f"🧹 Invalid channel ID key '{channel_id_str}' in tickets.json. Removing.")
-                  tickets_to_remove.append(channel_id_str)
-             except discord.NotFound:
-                  print(f"🧹 Ticket channel {channel_id_str} (from data) caused NotFound error. Removing.")
-                  tickets_to_remove.append(channel_id_str)
-
-        if tickets_to_remove:
-            updated_data = current_ticket_data.copy()
-            for channel_id_str_to_remove in tickets_to_remove:
-                if channel_id_str_to_remove in updated_data:
-                    del updated_data[channel_id_str_to_remove]
-            if save_json(TICKET_FILE, updated_data):
-                 print(f"✅ Removed {len(tickets_to_remove)} inactive/invalid ticket entries from {TICKET_FILE}.")
-            else:
-                 print(f"❌ Failed to save cleaned ticket data to {TICKET_FILE}.")
+    view_to_register = TicketOpenView()
+    view_to_register.add_item(Button(label="Open Ticket", style=ButtonStyle.secondary, custom_id="persistent_open_ticket_button"))
+    bot.add_view(view_to_register, message_id=None)
+    print("🔘 Persistent 'Open Ticket' button view registered.")
 
+def command_tree_fingerprint(tree, scope):
+    """Hash of every command's sync payload (names, descriptions, options, permissions) plus the sync scope."""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda c: (c.get("type", 1), c["name"]))
+    return hashlib.sha256(json.dumps({"scope": scope, "commands": payload}, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+async def sync_command_tree(force=False):
+    """Syncs slash commands only when the tree changed since the last successful sync.
+
+    With "command_sync_scope": "guild" (the default) the commands are copied
+    to every configured guild, which Discord applies immediately; the first
+    sync after a recorded scope change also clears the commands left at the
+    other scope, and guilds dropped from the configuration are cleared too.
+    Without a record of the previous sync nothing is cleared, so global
+    commands registered by other tooling are left alone.
+    """
+    scope = "global" if config.get("command_sync_scope") == "global" else "guild"
+    fingerprint = command_tree_fingerprint(bot.tree, scope)
+    guild_ids = guild_states.ids()
+    last_sync = load_json(COMMAND_SYNC_FILE)
+    last_guild_ids = last_sync.get("guild_ids") or ([last_sync["guild_id"]] if last_sync.get("guild_id") else [])
+    if not force and last_sync.get("fingerprint") == fingerprint and last_sync.get("application_id") == bot.application_id and last_guild_ids == guild_ids:
+        metrics.inc("command_sync_total", result="skipped")
+        print("🔄 Command tree unchanged since last sync; skipping.")
+        return
+    synced = []
     try:
-        guild_obj = discord.Object(id=GUILD_ID)
-        synced = await bot.tree.sync()
-        print(f"🔄 Synced {len(synced)} commands to guild {GUILD_ID}.")
+        with metrics.timer("command_sync_seconds", scope=scope):
+            if scope == "guild":
+                for guild_id in guild_ids:
+                    guild_obj = discord.Object(id=guild_id)
+                    bot.tree.copy_global_to(guild=guild_obj)
+                    synced = await bot.tree.sync(guild=guild_obj)
+                if last_sync.get("scope") == "global":
+                    await bot.http.bulk_upsert_global_commands(bot.application_id, payload=[])
+                    print("🧹 Cleared the global commands left from the previous global sync.")
+                stale_guild_ids = [guild_id for guild_id in last_guild_ids if guild_id not in guild_ids] if last_sync.get("scope") == "guild" else []
+            else:
+                synced = await bot.tree.sync()
+                stale_guild_ids = last_guild_ids if last_sync.get("scope") == "guild" else []
+            for guild_id in stale_guild_ids:
+                await bot.http.bulk_upsert_guild_commands(bot.application_id, guild_id, payload=[])
     except discord.errors.Forbidden as e_sync_forbidden:
-        print(f"❌ Failed to sync commands: {e_sync_forbidden}")
+        metrics.inc("command_sync_total", result="error")
+        print(f"❌ Failed to sync commands: {e_sync_forbidden}"); return
     except Exception as e_sync:
-        print(f"❌ Failed to sync commands: {e_sync}")
+        metrics.inc("command_sync_total", result="error")
+        print(f"❌ Failed to sync commands: {e_sync}"); return
+    metrics.inc("command_sync_total", result="synced")
+    save_json(COMMAND_SYNC_FILE, {"fingerprint": fingerprint, "scope": scope, "application_id": bot.application_id, "guild_ids": guild_ids})
+    print(f"🔄 Synced {len(synced)} commands {'to ' + str(len(guild_ids)) + ' guild(s)' if scope == 'guild' else 'globally'}.")
+
+async def startup_reconcile(targets):
+    """One-time check of every guild's tickets against its channels, run off the on_ready path.
+
+    Afterwards the ticket indexes are kept current by on_guild_channel_delete
+    and on_guild_channel_update, so reconnects do not rescan them.
+    """
+    started = time.perf_counter()
+    checked = await asyncio.gather(*(reconcile_guild(state, guild) for state, guild in targets))
+
+    transcript_archiver.start(lambda: [
+        (guild, state.config_cache.get().archive_category_ids)
+        for state, guild in ((state, bot.get_guild(state.guild_id)) for state in guild_states) if guild
+    ])
+    metrics_port = int(config.get("metrics_port", 0))
+    if metrics_port:
+        try:
+            await metrics.start_server(config.get("metrics_host", "127.0.0.1"), metrics_port)
+        except OSError as e:
+            print(f"❌ Could not start metrics endpoint on port {metrics_port}: {e}")
+    metrics.observe("startup_reconcile_seconds", time.perf_counter() - started)
+    print(f"✅ Startup reconciliation checked {sum(checked)} tickets in {len(targets)} guild(s) in {time.perf_counter() - started:.2f}s (resident memory {_format_memory(resident_memory_bytes())}).")
+
+async def reconcile_guild(state, guild):
+    """Drops tickets whose channel is gone or archived and re-adopts pool channels; returns the tickets checked."""
+    ticket_store = state.ticket_store
+    all_archive_category_ids = state.config_cache.get().archive_category_ids
+    print(f"🔍 Found {len(all_archive_category_ids)} potential archive category IDs for cleanup in guild {guild.id}: {all_archive_category_ids}")
+
+    tickets_to_remove = []
+    tickets_to_check = ticket_store.items()
+    for index, (channel_id_str, ticket_info) in enumerate(tickets_to_check):
+        if index and index % RECONCILE_BATCH_SIZE == 0:
+            await asyncio.sleep(0)
+        try:
+            channel_id = int(channel_id_str)
+            channel = guild.get_channel(channel_id)
+            if not channel:
+                print(f"🧹 Ticket channel {channel_id} (from data) not found. Removing.")
+                tickets_to_remove.append((channel_id_str, "orphaned"))
+            elif channel.category_id in all_archive_category_ids:
+                print(f"🧹 Ticket channel {channel_id} is in an archive category ({channel.category_id}). Removing from active data.")
+                tickets_to_remove.append((channel_id_str, "closed"))
+        except (ValueError, TypeError):
+            print(f"🧹 Invalid channel ID key '{channel_id_str}' in ticket data. Removing.")
+            tickets_to_remove.append((channel_id_str, "orphaned"))
+
+    state.category_overflow.reclaim_all(guild)
+
+    pooled = state.channel_pool.adopt(guild, state.config_cache.categories, {int(k) for k, _ in ticket_store.items() if k.isdigit()})
+    if pooled:
+        print(f"🏊 Adopted {pooled} pre-created ticket channels in guild {guild.id}.")
+    state.channel_pool.refill_all(guild, state.config_cache.categories)
+
+    if tickets_to_remove:
+        for channel_id_str_to_remove, removal_status in tickets_to_remove:
+            ticket_store.remove(channel_id_str_to_remove, status=removal_status)
+        if await ticket_store.flush():
+             print(f"✅ Removed {len(tickets_to_remove)} inactive/invalid ticket entries from {state.ticket_backend.filename}.")
+        else:
+             print(f"❌ Failed to save cleaned ticket data to {state.ticket_backend.filename}.")
+    return len(tickets_to_check)
 
-    view_to_register = TicketOpenView()
-    view_to_register.add_item(Button(label="Open Ticket", style=ButtonStyle.secondary, custom_id="persistent_open_ticket_button"))
-    bot.add_view(view_to_register, message_id=None)
-    print("🔘 Persistent 'Open Ticket' button view registered.")
+async def forget_ticket_channel(state, channel, status):
+    """Drops a ticket whose channel was deleted or archived outside /close."""
+    channel_id_str = str(channel.id)
+    async with ticket_locks.hold(("channel", channel.id), before_release=state.ticket_store.flush):
+        ticket_info = state.ticket_store.get(channel_id_str)
+        if not ticket_info or not state.ticket_store.remove(channel_id_str, status=status):
+            return
+        print(f"🧹 Ticket channel {channel.id} was {'archived' if status == 'closed' else 'deleted'} outside the bot. Removed from active data.")
+        transcript_path = await transcript_writer.finalize(channel.id) if transcript_writer else None
+        if state.search_index:
+            await asyncio.get_running_loop().run_in_executor(None, state.search_index.index_ticket, channel.id, dict(ticket_info), time.time(), transcript_path)
+
+@bot.event
+async def on_guild_channel_create(channel: discord.abc.GuildChannel):
+    state = guild_states.get(channel.guild.id)
+    if state is None: return
+    state.category_overflow.channel_added(channel.category_id, channel.id)
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    state = guild_states.get(channel.guild.id)
+    if state is None: return
+    state.category_overflow.channel_removed(channel.category_id, channel.id)
+    if str(channel.id) in state.ticket_store:
+        await forget_ticket_channel(state, channel, "orphaned")
+    if channel.category_id in state.config_cache.get().overflow_owners:
+        await state.category_overflow.reclaim(channel.guild, channel.category_id)
+
+@bot.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    state = guild_states.get(after.guild.id)
+    if state is None or before.category_id == after.category_id: return
+    state.category_overflow.channel_removed(before.category_id, after.id)
+    state.category_overflow.channel_added(after.category_id, after.id)
+    if str(after.id) in state.ticket_store and after.category_id in state.config_cache.get().archive_category_ids:
+        await forget_ticket_channel(state, after, "closed")
+    if before.category_id in state.config_cache.get().overflow_owners:
+        await state.category_overflow.reclaim(after.guild, before.category_id)
 
 @bot.event
 async def on_interaction(interaction: Interaction):
     if interaction.type == discord.InteractionType.component:
         custom_id = interaction.data.get("custom_id") if interaction.data else None
         if custom_id == "persistent_open_ticket_button":
-            view = View(timeout=180)
-            view.add_item(CategorySelect(interaction.user.id))
-            await interaction.response.send_message("يرجى اختيار القسم المطلوب لفتح التذكرة:", view=view, ephemeral=True)
+            state = guild_states.get(interaction.guild_id)
+            if state is None: return
+            with metrics.timer("interaction_handler_seconds", handler="open_button"):
+                async with interaction_tracer.trace(interaction, "open_button"):
+                    view = View(timeout=180)
+                    view.add_item(CategorySelect(interaction.user.id, state))
+                    await interaction_tracer.respond(interaction, "يرجى اختيار القسم المطلوب لفتح التذكرة:", view=view, ephemeral=True)
             return
 
+async def relay_embeds_to_user(user_id, guild, ticket_channel, embeds):
+    """Relays staff message embeds from a ticket channel to its owner's DM, batching them per send."""
+    try:
+        target_dm = await user_cache.get_dm_channel(user_id, guild)
+        for batch in batch_embeds(embeds):
+            try:
+                await outbound.send(target_dm, embeds=batch)
+                metrics.inc("relay_messages_total", len(batch), direction="ticket_to_user")
+                for embed in batch:
+                    if embed.timestamp:
+                        metrics.observe("relay_delivery_seconds", (discord.utils.utcnow() - embed.timestamp).total_seconds(), direction="ticket_to_user")
+            except discord.errors.Forbidden:
+                await outbound.send(ticket_channel, f"⚠️ لم أتمكن من إرسال إشعار لـ <@{user_id}> (الخاص مغلق).", delete_after=30, allowed_mentions=discord.AllowedMentions.none(), priority=PRIORITY_NOTIFY)
+                return
+            except Exception as e_dm:
+                print(f"Error sending channel msg to DM ({user_id}): {e_dm}")
+    except discord.NotFound: print(f"User {user_id} (from ticket data) not found.")
+    except Exception as e_proc_ch: print(f"Error relaying messages for ticket {ticket_channel.id}: {e_proc_ch}")
+
+async def claim_direct_message(message):
+    """True if this process should relay the DM. Several processes may see the same DM; only the first claim wins."""
+    try:
+        claimed, _ = await asyncio.get_running_loop().run_in_executor(None, functools.partial(kv.put, f"dm/{message.id}", kv_owner, version=0, ttl=DM_CLAIM_TTL))
+        if claimed:
+            await kv_sync.catch_up()
+        return claimed
+    except KvError as e:
+        print(f"⚠️ Could not claim DM {message.id} in the shared store ({e}). Relaying it anyway.")
+        return True
+
 @bot.event
 async def on_message(message: discord.Message):
     if message.author.bot or message.webhook_id: return
-    guild = bot.get_guild(GUILD_ID)
-    if not guild: return
-
-    current_tickets = load_json(TICKET_FILE)
-    current_config = load_json(CONFIG_FILE)
 
-    if message.guild and message.guild.id == GUILD_ID and isinstance(message.channel, discord.TextChannel):
+    if message.guild and isinstance(message.channel, discord.TextChannel):
+        state = guild_states.get(message.guild.id)
+        if state is None: return
+        guild = message.guild
         channel_id_str = str(message.channel.id)
-        ticket_info = current_tickets.get(channel_id_str)
+        ticket_info = state.ticket_store.get(channel_id_str)
 
         if ticket_info and ticket_info.get("user_id"):
             user_id = ticket_info["user_id"]
+            if transcript_writer:
+                transcript_writer.record_message(message.channel.id, "channel", message)
             try:
                 if message.author.id != user_id:
-                    target_user = await bot.fetch_user(user_id)
                     embed_to_user = discord.Embed(description=message.content if message.content else "[رسالة فارغة]", color=discord.Color.orange())
                     embed_to_user.set_author(name=f"رسالة من {message.author.display_name} في تذكرتك", icon_url=message.author.display_avatar.url if message.author.display_avatar else None)
                     embed_to_user.set_footer(text=f"من سيرفر: {guild.name} | قناة: #{message.channel.name}")
@@ -737,80 +3888,133 @@ async def on_message(message: discord.Message):
                          attach_field_value = "\n".join(f"{att.filename}" for att in message.attachments)
                          embed_to_user.add_field(name="📎 مرفقات", value=attach_field_value if attach_field_value else "لا يوجد", inline=False)
 
-                    try:
-                        await target_user.send(embed=embed_to_user)
-                    except discord.errors.Forbidden:
-                        await message.channel.send(f"⚠️ لم أتمكن من إرسال إشعار لـ <@{user_id}> (الخاص مغلق).", delete_after=30, allowed_mentions=discord.AllowedMentions.none())
-                    except Exception as e_dm:
-                        print(f"Error sending channel msg to DM ({user_id}): {e_dm}")
-            except discord.NotFound: print(f"User {user_id} (from ticket data) not found.")
+                    ticket_channel = message.channel
+                    async def deliver(embeds):
+                        await relay_embeds_to_user(user_id, guild, ticket_channel, embeds)
+                    if relay_coalescer.enabled:
+                        relay_coalescer.add(channel_id_str, embed_to_user, deliver)
+                    else:
+                        await deliver([embed_to_user])
             except Exception as e_proc_ch: print(f"Error processing channel message for ticket {channel_id_str}: {e_proc_ch}")
         return
 
     if isinstance(message.channel, discord.DMChannel):
+        if kv_sync and not await claim_direct_message(message): return
         user = message.author
         user_id_to_find = user.id
         target_channel_id = None
         target_channel = None
 
-        all_archive_category_ids_dm = set()
-        for cat_data in current_config.get("active_categories", {}).values():
-            if cat_data.get("archive_category_id"):
-                try: all_archive_category_ids_dm.add(int(cat_data["archive_category_id"]))
-                except (ValueError, TypeError): pass
-
-        for chan_id_str, ticket_info in current_tickets.items():
-            if ticket_info.get("user_id") == user_id_to_find:
-                try:
-                    chan_id = int(chan_id_str)
-                    potential_channel = guild.get_channel(chan_id)
-                    if potential_channel and potential_channel.category_id not in all_archive_category_ids_dm:
-                         target_channel_id = chan_id
-                         target_channel = potential_channel
-                         break
-                except (ValueError, TypeError, discord.NotFound): continue
+        for state, chan_id_str, _ in guild_states.open_tickets_for_user(user_id_to_find):
+            guild = bot.get_guild(state.guild_id)
+            if not guild and not kv_sync: continue
+            try:
+                chan_id = int(chan_id_str)
+                if not guild:
+                    # Guild served by another process; its open tickets are still known through the shared store.
+                    target_channel_id = chan_id
+                    target_channel = bot.get_partial_messageable(chan_id, guild_id=state.guild_id, type=discord.ChannelType.text)
+                    break
+                potential_channel = guild.get_channel(chan_id)
+                if potential_channel and potential_channel.category_id not in state.config_cache.get().archive_category_ids:
+                     target_channel_id = chan_id
+                     target_channel = potential_channel
+                     break
+            except (ValueError, TypeError, discord.NotFound): continue
 
         if target_channel:
             embed_to_channel = discord.Embed(description=message.content if message.content else "[رسالة فارغة]", color=discord.Color.purple())
             embed_to_channel.set_author(name=f"💬 رسالة من {user.display_name} ({user.name}) عبر الخاص", icon_url=user.display_avatar.url if user.display_avatar else None)
             embed_to_channel.timestamp = message.created_at
 
-            files_to_send = []
-            attachment_links_text = []
+            forwarded = ForwardedAttachments(attachment_forwarder)
             if message.attachments:
-                for attachment in message.attachments:
-                    if attachment.size < 8 * 1024 * 1024:
-                        try:
-                            file_bytes = await attachment.read()
-                            files_to_send.append(File(io.BytesIO(file_bytes), filename=attachment.filename))
-                        except Exception as e_attach:
-                            print(f"Could not forward attachment {attachment.filename}: {e_attach}")
-                            attachment_links_text.append(f"{attachment.filename} (خطأ في القراءة)")
-                    else:
-                        attachment_links_text.append(f"{attachment.filename} (حجم كبير)")
-
-                if attachment_links_text:
-                    embed_to_channel.add_field(name="📎 مرفقات (روابط/أخطاء)", value="\n".join(attachment_links_text), inline=False)
+                filesize_limit = target_channel.guild.filesize_limit if target_channel.guild else discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES
+                forwarded = await attachment_forwarder.forward(message.attachments, filesize_limit, dedup_scope=target_channel.id)
+                if forwarded.notes:
+                    embed_to_channel.add_field(name="📎 مرفقات (روابط/أخطاء)", value="\n".join(forwarded.notes)[:1024], inline=False)
 
             try:
-                await target_channel.send(embed=embed_to_channel, files=files_to_send if files_to_send else None)
+                sent_message = await outbound.send(target_channel, embed=embed_to_channel, files=forwarded.files if forwarded.files else None)
+                forwarded.remember_upload(target_channel.id, sent_message)
+                metrics.inc("relay_messages_total", direction="user_to_ticket")
+                metrics.inc("relay_attachments_total", len(forwarded.files), direction="user_to_ticket")
+                metrics.observe("relay_delivery_seconds", (discord.utils.utcnow() - message.created_at).total_seconds(), direction="user_to_ticket")
+                if transcript_writer:
+                    transcript_writer.record_message(target_channel.id, "dm", message)
                 await message.add_reaction("✅")
             except discord.errors.Forbidden:
-                await user.send(f"❌ عذراً، لم أتمكن من إرسال رسالتك إلى القناة {target_channel.mention}.")
+                await outbound.send(user, priority=PRIORITY_NOTIFY, content=f"❌ عذراً، لم أتمكن من إرسال رسالتك إلى القناة {target_channel.mention}.")
             except Exception as e_send_ch:
                 print(f"Error sending DM message to channel {target_channel_id}: {e_send_ch}")
                 await message.add_reaction("❌")
+            finally:
+                await forwarded.close()
         else:
             pass
         return
 
 if __name__ == "__main__":
+    if "--reindex-transcripts" in sys.argv:
+        indexed_states = [state for state in guild_states if state.search_index]
+        if not indexed_states:
+            print("❌ Error: --reindex-transcripts requires \"search_index\": true in config.json.")
+        else:
+            # Transcripts of all guilds share one directory; each goes to the guild whose ticket history
+            # or existing index knows the channel, and unknown ones to the main guild.
+            transcript_dir = config.get("transcript_dir") or TRANSCRIPT_DIR
+            names = os.listdir(transcript_dir) if os.path.isdir(transcript_dir) else []
+            channel_ids = sorted({name.split(".", 1)[0] for name in names if name.endswith(".jsonl.gz") and name.split(".", 1)[0].isdigit()}, key=int)
+            known_ids = {state.guild_id: state.search_index.indexed_channel_ids() for state in indexed_states}
+            fallback_state = guild_states.get(GUILD_ID) if guild_states.get(GUILD_ID).search_index else None
+            indexed = {state.guild_id: 0 for state in indexed_states}
+            skipped = 0
+            for channel_id in channel_ids:
+                owner = next((state for state in indexed_states if isinstance(state.ticket_backend, SqliteTicketBackend) and state.ticket_backend.history(channel_id)[0] is not None), None)
+                owner = owner or next((state for state in indexed_states if channel_id in known_ids[state.guild_id]), fallback_state)
+                if owner is None:
+                    skipped += 1
+                    continue
+                ticket_info, closed_at = closed_ticket_info(owner, channel_id)
+                owner.search_index.index_ticket(channel_id, ticket_info, closed_at, ticket_transcript_path(transcript_dir, channel_id))
+                indexed[owner.guild_id] += 1
+            for state in indexed_states:
+                state.search_index.close()
+                print(f"✅ Indexed {indexed[state.guild_id]} transcripts from {transcript_dir} into {state.search_index.filename} (guild {state.guild_id}).")
+            if skipped:
+                print(f"⚠️ Skipped {skipped} transcripts of unknown guilds; enable search_index in the main config.json to index them there.")
+        sys.exit()
+    if "--import-tickets" in sys.argv:
+        for state in guild_states:
+            ticket_backend = state.ticket_backend
+            if not isinstance(ticket_backend, (SqliteTicketBackend, KvTicketBackend)):
+                print(f"❌ Error: --import-tickets requires \"storage_backend\": \"sqlite\" or \"kv\" in the config of guild {state.guild_id}.")
+                continue
+            ticket_file = os.path.join(state.data_dir, TICKET_FILE)
+            journal_file = os.path.join(state.data_dir, TICKET_JOURNAL_FILE)
+            imported = ticket_backend.import_json(ticket_file, journal_file=journal_file if os.path.exists(journal_file) else None)
+            if imported is not None:
+                print(f"✅ Imported {imported} ticket entries from {ticket_file} into {ticket_backend.filename}.")
+            ticket_backend.shutdown([], None)
+        sys.exit()
     if not BOT_TOKEN or BOT_TOKEN == "التوكن_الحقيقي_بتاعك_هنا":
         print("❌ Error: Bot token missing or placeholder in config.json!")
     else:
+        if gateway_recorder:
+            primary_state = guild_states.get(GUILD_ID)
+            gateway_recorder.install(bot._connection, primary_state.config_cache.get().data, primary_state.ticket_store.items())
+            print(f"🎙️ Recording gateway events to {gateway_recorder.filename}{' (redacted)' if gateway_recorder.redact else ''}.")
         try:
             bot.run(BOT_TOKEN)
         except discord.errors.LoginFailure: print("❌ Error: Failed to log in. Check bot_token.")
         except discord.errors.PrivilegedIntentsRequired: print("❌ Error: Privileged Gateway Intents not enabled!")
         except Exception as e: print(f"❌ An unexpected error occurred: {e}")
+        finally:
+            if transcript_writer:
+                transcript_writer.flush_sync()
+            if gateway_recorder:
+                gateway_recorder.flush_sync()
+            for state in guild_states:
+                if not state.ticket_store.flush_sync():
+                    print(f"❌ Failed to flush pending ticket data to {state.ticket_backend.filename} on shutdown.")
         
\ No newline at end of file
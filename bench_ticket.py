@@ -0,0 +1,600 @@
+"""Offline benchmarks for Ticket.py against an in-process stand-in for Discord.
+
+Every scenario runs in a fresh interpreter inside a temporary directory with
+its own config.json and tickets.json. The bot's REST calls (discord.py's
+HTTPClient and the interaction webhook adapter) are answered by FakeDiscord,
+which also feeds the matching gateway events back into the bot's connection
+state, so handlers run against real discord.py models without a network.
+
+    python bench_ticket.py                         # all scenarios
+    python bench_ticket.py open relay --rest-latency 40
+    python bench_ticket.py --save bench.json       # record a baseline
+    python bench_ticket.py --baseline bench.json   # exit 1 on regressions
+    python bench_ticket.py replay --capture gateway.jsonl.gz --speed 10
+
+The replay scenario feeds a capture written by Ticket.py's
+"gateway_capture_file" option through the same connection state parsers,
+event handlers and command tree. Ids the bot creates during the replay are
+new, so later captured events that refer to channels created in the original
+run may take different branches; the load shape is what gets reproduced.
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import gc
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import discord
+from discord.webhook import async_ as webhook_async
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("open", "relay", "startup")
+OPTIONAL_SCENARIOS = ("replay",)
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def latency_summary(samples):
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2) if samples else 0.0
+    }
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+class FakeDiscord:
+    """Answers discord.py REST requests from memory and mirrors them as gateway events."""
+    ROUTES = [
+        ("POST", r"/guilds/(\d+)/channels", "create_channel"),
+        ("PATCH", r"/channels/(\d+)", "edit_channel"),
+        ("DELETE", r"/channels/(\d+)", "delete_channel"),
+        ("POST", r"/channels/(\d+)/messages", "send_message"),
+        ("PATCH", r"/channels/(\d+)/messages/(\d+)", "edit_message"),
+        ("DELETE", r"/channels/(\d+)/messages/(\d+)", "no_content"),
+        ("PUT", r"/channels/(\d+)/messages/(\d+)/reactions/.+", "no_content"),
+        ("POST", r"/users/@me/channels", "create_dm"),
+        ("GET", r"/users/(\d+)", "get_user"),
+        ("PUT", r"/applications/(\d+)/commands", "sync_commands"),
+        ("PUT", r"/applications/(\d+)/guilds/(\d+)/commands", "sync_commands"),
+        ("POST", r"/interactions/(\d+)/([^/]+)/callback", "interaction_callback"),
+        ("POST", r"/webhooks/(\d+)/([^/]+)", "followup"),
+        ("PATCH", r"/webhooks/(\d+)/([^/]+)/messages/.+", "followup"),
+    ]
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._ids = itertools.count(discord.utils.time_snowflake(discord.utils.utcnow()))
+        self.users = {}
+        self.channels = {}
+        self.calls = {}
+        self.state = None
+        self.guild_id = self.next_id()
+        self.bot_user = self.user_payload("TicketBot", bot=True)
+
+    def next_id(self):
+        return next(self._ids)
+
+    @staticmethod
+    def now():
+        return discord.utils.utcnow().isoformat()
+
+    def user_payload(self, name, bot=False):
+        user = {"id": str(self.next_id()), "username": name, "discriminator": "0", "global_name": None, "avatar": None, "bot": bot}
+        self.users[user["id"]] = user
+        return user
+
+    def member_payload(self, user, roles=(), permissions=0):
+        return {"user": user, "roles": [str(r) for r in roles], "joined_at": self.now(), "deaf": False, "mute": False, "flags": 0, "permissions": str(permissions)}
+
+    def channel_payload(self, name, channel_type=0, parent_id=None, topic=None):
+        channel = {
+            "id": str(self.next_id()), "type": channel_type, "guild_id": str(self.guild_id), "name": name, "position": len(self.channels),
+            "permission_overwrites": [], "parent_id": str(parent_id) if parent_id else None, "topic": topic, "nsfw": False,
+            "last_message_id": None, "rate_limit_per_user": 0
+        }
+        self.channels[channel["id"]] = channel
+        return channel
+
+    def message_payload(self, channel_id, author, content="", embeds=(), flags=0, member=None):
+        message = {
+            "id": str(self.next_id()), "channel_id": str(channel_id), "author": author, "content": content,
+            "timestamp": self.now(), "edited_timestamp": None, "tts": False, "mention_everyone": False, "mentions": [],
+            "mention_roles": [], "attachments": [], "embeds": list(embeds), "pinned": False, "type": 0, "flags": flags
+        }
+        if member is not None:
+            message["guild_id"] = str(self.guild_id)
+            message["member"] = {k: v for k, v in member.items() if k != "user"}
+        return message
+
+    def guild_payload(self, roles, members, channels):
+        default_role = {"id": str(self.guild_id), "name": "@everyone", "permissions": "0", "position": 0, "color": 0, "hoist": False, "managed": False, "mentionable": False, "flags": 0}
+        return {
+            "id": str(self.guild_id), "name": "Bench Guild", "owner_id": self.bot_user["id"], "roles": [default_role] + roles,
+            "emojis": [], "stickers": [], "features": [], "member_count": len(members), "members": members,
+            "channels": channels, "threads": [], "premium_tier": 0, "unavailable": False, "large": False
+        }
+
+    def role_payload(self, name):
+        return {"id": str(self.next_id()), "name": name, "permissions": "0", "position": 1, "color": 0, "hoist": False, "managed": False, "mentionable": True, "flags": 0}
+
+    def attach(self, bot, guild_data):
+        """Logs bot's connection state in as bot_user with guild_data cached, and routes all REST calls here."""
+        self.state = bot._connection
+        self.state.user = discord.ClientUser(state=self.state, data=self.bot_user)
+        self.state.application_id = int(self.bot_user["id"])
+        self.state._add_guild(discord.Guild(data=guild_data, state=self.state))
+        bot.http.request = self.request
+        bot.ws = FakeGateway()
+        webhook_async.async_context.set(FakeWebhookAdapter(self))
+
+    async def request(self, route, *, files=None, form=None, **kwargs):
+        path = route.url.split("/api/v10", 1)[-1].split("?", 1)[0]
+        for method, pattern, handler in self.ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match and method == route.method:
+                key = f"{method} {pattern}"
+                self.calls[key] = self.calls.get(key, 0) + 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                payload = kwargs.get("json") or {}
+                if form:
+                    payload = next((json.loads(part["value"]) for part in form if part.get("name") == "payload_json"), {})
+                return getattr(self, handler)(payload, *match.groups())
+        raise RuntimeError(f"FakeDiscord has no handler for {route.method} {path}")
+
+    def create_channel(self, payload, guild_id):
+        channel = self.channel_payload(payload["name"], payload.get("type", 0), payload.get("parent_id"), payload.get("topic"))
+        channel["permission_overwrites"] = payload.get("permission_overwrites", [])
+        self.state.parse_channel_create(channel)
+        return channel
+
+    def edit_channel(self, payload, channel_id):
+        channel = self.channels.get(channel_id) or self.channels.setdefault(channel_id, dict(self.channel_payload("unknown"), id=channel_id))
+        channel.update({k: v for k, v in payload.items() if k in ("name", "parent_id", "topic", "permission_overwrites", "position")})
+        self.state.parse_channel_update(dict(channel))
+        return channel
+
+    def delete_channel(self, payload, channel_id):
+        channel = self.channels.pop(channel_id)
+        self.state.parse_channel_delete(channel)
+        return channel
+
+    def send_message(self, payload, channel_id):
+        return self.message_payload(channel_id, self.bot_user, payload.get("content") or "", payload.get("embeds") or ())
+
+    def edit_message(self, payload, channel_id, message_id):
+        message = self.send_message(payload, channel_id)
+        message["id"] = message_id
+        return message
+
+    def no_content(self, payload, *ids):
+        return None
+
+    def create_dm(self, payload):
+        recipient = self.get_user(payload, str(payload["recipient_id"]))
+        return {"id": str(self.next_id()), "type": 1, "recipients": [recipient], "last_message_id": None}
+
+    def get_user(self, payload, user_id):
+        if user_id not in self.users:
+            self.users[user_id] = {"id": user_id, "username": f"user{user_id[-4:]}", "discriminator": "0", "global_name": None, "avatar": None, "bot": False}
+        return self.users[user_id]
+
+    def sync_commands(self, payload, application_id, guild_id=None):
+        return [dict(command, id=str(self.next_id()), application_id=application_id, version="1") for command in payload]
+
+    def interaction_callback(self, payload, interaction_id, token):
+        return {"interaction": {"id": interaction_id, "type": payload.get("type", 4)}}
+
+    def followup(self, payload, application_id, token):
+        return self.message_payload(self.guild_id, self.bot_user, payload.get("content") or "", payload.get("embeds") or (), payload.get("flags", 0))
+
+    def interaction(self, member, channel_id, interaction_type, data, message=None):
+        payload = {
+            "id": str(self.next_id()), "application_id": self.bot_user["id"], "type": interaction_type, "token": f"token-{self.next_id()}",
+            "version": 1, "guild_id": str(self.guild_id), "channel_id": str(channel_id), "channel": dict(self.channels[str(channel_id)]),
+            "member": member, "data": data, "locale": "ar", "app_permissions": "8", "attachment_size_limit": 25 * 1024 * 1024
+        }
+        if message is not None:
+            payload["message"] = message
+        return discord.Interaction(data=payload, state=self.state)
+
+    def guild_message(self, channel_id, member, content):
+        data = self.message_payload(channel_id, member["user"], content, member=member)
+        channel = self.state._get_guild(self.guild_id).get_channel(int(channel_id))
+        return discord.Message(state=self.state, channel=channel, data=data)
+
+class FakeGateway:
+    """Just enough of DiscordWebSocket for Client.latency."""
+    latency = 0.0
+
+class FakeWebhookAdapter(webhook_async.AsyncWebhookAdapter):
+    """Sends interaction responses and followups to FakeDiscord instead of the webhook endpoints."""
+    def __init__(self, fake):
+        super().__init__()
+        self.fake = fake
+
+    async def request(self, route, session, *, payload=None, multipart=None, files=None, **kwargs):
+        if multipart:
+            payload = next((json.loads(part["value"]) for part in multipart if part.get("name") == "payload_json"), {})
+        return await self.fake.request(route, json=payload or {})
+
+def write_world(fake, tickets, live_tickets, members_count, sections=1):
+    """Writes config.json/tickets.json and returns the guild payload plus the ids the scenarios need."""
+    mod_role = fake.role_payload("Support")
+    staff = fake.member_payload(fake.user_payload("staff"), roles=[mod_role["id"]], permissions=discord.Permissions.all().value)
+    channels, categories = [], {}
+    for index in range(sections):
+        key = f"section{index}"
+        active = fake.channel_payload(f"Tickets {key}", channel_type=4)
+        archive = fake.channel_payload(f"Archive {key}", channel_type=4)
+        channels += [active, archive]
+        categories[key] = {"name": key, "category_id": int(active["id"]), "archive_category_id": int(archive["id"])}
+    members = [fake.member_payload(fake.user_payload(f"user{i}")) for i in range(members_count)]
+    ticket_data, ticket_channels = {}, []
+    keys = list(categories)
+    for i in range(tickets):
+        key = keys[i % len(keys)]
+        owner = members[i % len(members)]["user"]["id"] if members else str(fake.next_id())
+        if i < live_tickets:
+            channel = fake.channel_payload(f"ticket-user{i}-{key}", parent_id=categories[key]["category_id"])
+            channels.append(channel)
+            ticket_channels.append(channel["id"])
+            channel_id = channel["id"]
+        else:
+            channel_id = str(fake.next_id())
+        ticket_data[channel_id] = {"user_id": int(owner), "category_key": key, "opened_at": time.time()}
+    config = {
+        "bot_token": "bench", "guild_id": fake.guild_id, "moderator_role_id": int(mod_role["id"]), "ticket_prefix": "ticket-",
+        "active_categories": categories
+    }
+    with open("config.json", "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    with open("tickets.json", "w", encoding="utf-8") as f:
+        json.dump(ticket_data, f)
+    guild_data = fake.guild_payload([mod_role], members + [staff, fake.member_payload(fake.bot_user)], channels)
+    return guild_data, {"staff": staff, "members": members, "ticket_channels": ticket_channels, "sections": keys}
+
+def import_ticket():
+    sys.path.insert(0, REPO_DIR)
+    import Ticket
+    return Ticket
+
+async def start_bot(Ticket, fake, guild_data, args):
+    await Ticket.bot._async_setup_hook()
+    fake.attach(Ticket.bot, guild_data)
+    if args.no_rate_limits:
+        Ticket.outbound = Ticket.SendScheduler(queue_size=100000, route_rate=10 ** 9, global_rate=10 ** 9)
+
+async def scenario_open(args, fake, world, Ticket):
+    """Members click the open button and pick a section concurrently."""
+    guild = Ticket.bot.get_guild(fake.guild_id)
+    panel_channel = fake.channel_payload("open-ticket")
+    fake.state.parse_channel_create(panel_channel)
+    button_latencies, select_latencies = [], []
+
+    async def open_one(member):
+        start = time.perf_counter()
+        await Ticket.on_interaction(fake.interaction(member, panel_channel["id"], 3, {"custom_id": "persistent_open_ticket_button", "component_type": 2}))
+        button_latencies.append(time.perf_counter() - start)
+        ephemeral = fake.message_payload(panel_channel["id"], fake.bot_user, "pick", flags=64)
+        interaction = fake.interaction(member, panel_channel["id"], 3, {"custom_id": "category_select", "component_type": 3, "values": [world["sections"][0]]}, message=ephemeral)
+        select = Ticket.CategorySelect(int(member["user"]["id"]), Ticket.guild_states.get(fake.guild_id))
+        select._refresh_state(interaction, interaction.data)
+        start = time.perf_counter()
+        await select.callback(interaction)
+        select_latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(open_one(member) for member in world["members"][:args.opens]))
+    elapsed = time.perf_counter() - started
+    await Ticket.guild_states.get(fake.guild_id).ticket_store.flush()
+    opened = sum(1 for _ in guild.text_channels if _.name.startswith("ticket-"))
+    return {
+        "ops": len(select_latencies), "seconds": elapsed, "throughput": len(select_latencies) / elapsed,
+        "latency": {"open_button": latency_summary(button_latencies), "category_select": latency_summary(select_latencies)},
+        "extra": {"channels_opened": opened, "open_tickets": len(Ticket.guild_states.get(fake.guild_id).ticket_store)}
+    }
+
+async def scenario_relay(args, fake, world, Ticket):
+    """Staff post at a fixed rate across the open tickets; each message is relayed to the owner's DM."""
+    total = int(args.rate * args.duration)
+    channels = world["ticket_channels"]
+    latencies = []
+
+    async def relay_one(message, due):
+        await Ticket.on_message(message)
+        latencies.append(time.perf_counter() - due)
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(total):
+        due = started + i / args.rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        message = fake.guild_message(channels[i % len(channels)], world["staff"], f"staff reply {i}")
+        tasks.append(asyncio.create_task(relay_one(message, due)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    return {
+        "ops": total, "seconds": elapsed, "throughput": total / elapsed,
+        "latency": {"on_message": latency_summary(latencies)},
+        "extra": {"offered_rate": args.rate, "tickets": len(channels), "dm_sends": fake.calls.get("POST /channels/(\\d+)/messages", 0)}
+    }
+
+async def scenario_startup(args, fake, world, Ticket):
+    """Runs on_ready over a large tickets.json where most channels no longer exist."""
+    started = time.perf_counter()
+    await Ticket.on_ready()
+    ready = time.perf_counter() - started
+    await Ticket.startup_task
+    await Ticket.guild_states.get(fake.guild_id).ticket_store.flush()
+    elapsed = time.perf_counter() - started
+    calls_before_resync = sum(fake.calls.values())
+    await Ticket.sync_command_tree()
+    return {
+        "ops": args.startup_tickets, "seconds": elapsed, "throughput": args.startup_tickets / elapsed,
+        "latency": {"on_ready": latency_summary([ready]), "reconcile": latency_summary([elapsed])},
+        "extra": {"open_tickets_after": len(Ticket.guild_states.get(fake.guild_id).ticket_store), "cached_members": len(Ticket.bot.get_guild(fake.guild_id).members), "resync_rest_calls": sum(fake.calls.values()) - calls_before_resync}
+    }
+
+def load_capture(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def write_replay_world(fake, events):
+    """Recreates config.json, tickets.json and the main guild from a capture's header events."""
+    header = {}
+    for event in events:
+        if event["e"] in ("CONFIG", "TICKETS", "READY", "GUILD_CREATE") and event["e"] not in header:
+            if event["e"] == "GUILD_CREATE" and "CONFIG" in header and event["d"].get("id") != str(header["CONFIG"]["d"].get("guild_id")):
+                continue
+            header[event["e"]] = event
+    missing = [name for name in ("CONFIG", "READY", "GUILD_CREATE") if name not in header]
+    if missing:
+        raise SystemExit(f"Capture is missing {', '.join(missing)}; it must start before the bot connects.")
+    config = dict(header["CONFIG"]["d"], bot_token="bench", storage_backend="json")
+    for key in ("gateway_capture_file", "metrics_port", "sqlite_file"):
+        config.pop(key, None)
+    with open("config.json", "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    with open("tickets.json", "w", encoding="utf-8") as f:
+        json.dump(header.get("TICKETS", {}).get("d", {}), f)
+    guild_data = header["GUILD_CREATE"]["d"]
+    fake.guild_id = int(config["guild_id"])
+    fake.bot_user = header["READY"]["d"]["user"]
+    for member in guild_data.get("members", []):
+        fake.users[member["user"]["id"]] = member["user"]
+    for channel in guild_data.get("channels", []):
+        fake.channels[channel["id"]] = dict(channel, guild_id=str(fake.guild_id))
+    skipped = {id(event) for event in header.values()}
+    return guild_data, [event for event in events if id(event) not in skipped]
+
+def instrument_handlers(Ticket, latencies):
+    """Times the bot's gateway event handlers and app command invocations by name."""
+    def timed(label, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                latencies.setdefault(label(*args) if callable(label) else label, []).append(time.perf_counter() - start)
+        return wrapper
+    for event in ("on_message", "on_interaction", "on_guild_channel_create", "on_guild_channel_delete", "on_guild_channel_update"):
+        setattr(Ticket.bot, event, timed(event, getattr(Ticket.bot, event)))
+    Ticket.bot.tree._call = timed(lambda interaction: f"/{interaction.data.get('name')}", Ticket.bot.tree._call)
+
+async def fake_download(session, attachment, in_memory, forwarded):
+    """Stands in for AttachmentForwarder._download so replays never touch the CDN."""
+    fp = io.BytesIO(b"\0" * attachment.size)
+    forwarded._buffers.append(fp)
+    return discord.File(fp, filename=attachment.filename), hashlib.sha256(attachment.url.encode()).hexdigest()
+
+async def scenario_replay(args, fake, world, Ticket):
+    """Feeds captured gateway events through the bot at original (or scaled) timing."""
+    latencies = {}
+    instrument_handlers(Ticket, latencies)
+    Ticket.attachment_forwarder._download = fake_download
+    await Ticket.on_ready()
+    await Ticket.startup_task
+    parsers = fake.state.parsers
+    unroutable = 0
+    tasks = []
+
+    async def select_section(data):
+        interaction = discord.Interaction(data=data, state=fake.state)
+        select = Ticket.CategorySelect(interaction.user.id, Ticket.guild_states.get(interaction.guild_id))
+        select._refresh_state(interaction, interaction.data)
+        start = time.perf_counter()
+        await select.callback(interaction)
+        latencies.setdefault("category_select", []).append(time.perf_counter() - start)
+
+    first_offset = world[0]["t"] if world else 0.0
+    started = time.perf_counter()
+    for event in world:
+        if args.speed > 0:
+            delay = started + (event["t"] - first_offset) / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        name, data = event["e"], event["d"]
+        if name in ("CHANNEL_CREATE", "CHANNEL_UPDATE"):
+            fake.channels[data["id"]] = data
+        elif name == "CHANNEL_DELETE":
+            fake.channels.pop(data["id"], None)
+        custom_id = (data.get("data") or {}).get("custom_id") if name == "INTERACTION_CREATE" else None
+        if custom_id == "category_select":
+            tasks.append(asyncio.create_task(select_section(data)))
+            continue
+        if custom_id and custom_id != "persistent_open_ticket_button":
+            unroutable += 1
+        parsers[name](data)
+        await asyncio.sleep(0)
+    pending = [task for task in asyncio.all_tasks() if task.get_name().startswith(("discord.py: ", "CommandTree-invoker"))]
+    await asyncio.wait(tasks + pending, timeout=args.settle)
+    elapsed = time.perf_counter() - started
+    handled = sum(len(samples) for samples in latencies.values())
+    return {
+        "ops": len(world), "seconds": elapsed, "throughput": len(world) / elapsed,
+        "latency": {label: latency_summary(samples) for label, samples in sorted(latencies.items())},
+        "extra": {"speed": args.speed, "handler_calls": handled, "unroutable_components": unroutable}
+    }
+
+def run_scenario(name, args):
+    """Runs one scenario in this (fresh) process and returns its result dict."""
+    workdir = tempfile.mkdtemp(prefix=f"bench-ticket-{name}-")
+    os.chdir(workdir)
+    fake = FakeDiscord(latency=args.rest_latency / 1000)
+    if name == "open":
+        guild_data, world = write_world(fake, tickets=0, live_tickets=0, members_count=args.opens)
+    elif name == "relay":
+        guild_data, world = write_world(fake, tickets=args.tickets, live_tickets=args.tickets, members_count=args.tickets)
+    elif name == "replay":
+        guild_data, world = write_replay_world(fake, load_capture(args.capture))
+    else:
+        guild_data, world = write_world(fake, tickets=args.startup_tickets, live_tickets=args.startup_live, members_count=args.startup_members)
+    if args.lean_gateway:
+        with open("config.json", encoding="utf-8") as f:
+            config = json.load(f)
+        config["lean_gateway"] = True
+        with open("config.json", "w", encoding="utf-8") as f:
+            json.dump(config, f)
+    gc.collect()
+    baseline_rss = peak_rss_mb()
+    with contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext():
+        import_started = time.perf_counter()
+        Ticket = import_ticket()
+        import_seconds = time.perf_counter() - import_started
+
+        async def main():
+            await start_bot(Ticket, fake, guild_data, args)
+            return await globals()[f"scenario_{name}"](args, fake, world, Ticket)
+        result = asyncio.run(main())
+    result.update({
+        "scenario": name,
+        "import_seconds": round(import_seconds, 4),
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_before_import_mb": baseline_rss,
+        "rest_calls": sum(fake.calls.values()),
+        "throughput": round(result["throughput"], 2),
+        "seconds": round(result["seconds"], 4)
+    })
+    return result
+
+def print_report(results):
+    for result in results:
+        print(f"\n== {result['scenario']} ==")
+        print(f"  ops: {result['ops']} in {result['seconds']}s -> {result['throughput']}/s | import {result['import_seconds']}s | REST calls {result['rest_calls']}")
+        print(f"  peak RSS: {result['peak_rss_mb']} MB (before import {result['rss_before_import_mb']} MB)")
+        for handler, summary in result["latency"].items():
+            print(f"  {handler:<24} n={summary['count']:<6} p50={summary['p50_ms']}ms p99={summary['p99_ms']}ms max={summary['max_ms']}ms")
+        for key, value in result.get("extra", {}).items():
+            print(f"  {key}: {value}")
+
+def compare(results, baseline, tolerance):
+    """Returns regressions: throughput or any p99 worse than baseline by more than tolerance."""
+    regressions = []
+    previous = {result["scenario"]: result for result in baseline}
+    for result in results:
+        old = previous.get(result["scenario"])
+        if not old:
+            continue
+        if result["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append(f"{result['scenario']}: throughput {old['throughput']}/s -> {result['throughput']}/s")
+        for handler, summary in result["latency"].items():
+            old_p99 = old["latency"].get(handler, {}).get("p99_ms")
+            if old_p99 and summary["p99_ms"] > old_p99 * (1 + tolerance):
+                regressions.append(f"{result['scenario']}: {handler} p99 {old_p99}ms -> {summary['p99_ms']}ms")
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Offline benchmarks for Ticket.py")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario", help=f"any of {', '.join(SCENARIOS + OPTIONAL_SCENARIOS)} (default: {', '.join(SCENARIOS)})")
+    parser.add_argument("--opens", type=int, default=200, help="concurrent ticket opens (open)")
+    parser.add_argument("--tickets", type=int, default=50, help="open tickets receiving staff messages (relay)")
+    parser.add_argument("--rate", type=float, default=40.0, help="staff messages per second (relay)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of relay traffic (relay)")
+    parser.add_argument("--startup-tickets", type=int, default=50000, help="entries in tickets.json (startup)")
+    parser.add_argument("--startup-live", type=int, default=450, help="how many of them still have a channel (startup)")
+    parser.add_argument("--startup-members", type=int, default=1000, help="guild members in the GUILD_CREATE payload (startup)")
+    parser.add_argument("--lean-gateway", action="store_true", help="run the bot with \"lean_gateway\": true")
+    parser.add_argument("--capture", help="gateway capture to feed through the bot (replay)")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed multiplier, 0 for as fast as possible (replay)")
+    parser.add_argument("--settle", type=float, default=30.0, help="seconds to wait for handlers still running after the last event (replay)")
+    parser.add_argument("--rest-latency", type=float, default=0.0, help="simulated REST round trip in milliseconds")
+    parser.add_argument("--no-rate-limits", action="store_true", help="lift the send scheduler's Discord rate limits")
+    parser.add_argument("--save", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression against --baseline")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own output")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS + OPTIONAL_SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    if "replay" in args.scenarios and not args.capture:
+        parser.error("the replay scenario needs --capture")
+    return args
+
+def child_argv(args):
+    """Scenario options forwarded to the per-scenario subprocess."""
+    argv = [
+        "--opens", str(args.opens), "--tickets", str(args.tickets), "--rate", str(args.rate), "--duration", str(args.duration),
+        "--startup-tickets", str(args.startup_tickets), "--startup-live", str(args.startup_live), "--startup-members", str(args.startup_members), "--rest-latency", str(args.rest_latency),
+        "--speed", str(args.speed), "--settle", str(args.settle)
+    ]
+    if args.capture:
+        argv += ["--capture", os.path.abspath(args.capture)]
+    if args.no_rate_limits:
+        argv.append("--no-rate-limits")
+    if args.lean_gateway:
+        argv.append("--lean-gateway")
+    return argv
+
+def main(argv):
+    args = parse_args(argv)
+    if args.run_one:
+        result = run_scenario(args.run_one, args)
+        sys.__stdout__.write("BENCH_RESULT " + json.dumps(result) + "\n")
+        return 0
+    results = []
+    for name in args.scenarios:
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", name] + child_argv(args), capture_output=True, text=True)
+        lines = [line for line in completed.stdout.splitlines() if line.startswith("BENCH_RESULT ")]
+        if completed.returncode != 0 or not lines:
+            print(f"❌ Scenario '{name}' failed:\n{completed.stdout[-2000:]}{completed.stderr[-4000:]}")
+            return 1
+        results.append(json.loads(lines[-1][len("BENCH_RESULT "):]))
+    print_report(results)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"⚠️ Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
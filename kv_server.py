@@ -0,0 +1,219 @@
+"""Local stand-in for the shared key-value service used by Ticket.py's "kv_url" option.
+
+Several bot processes (one per shard group) point "kv_url" at the same
+service to share open tickets, section config and locks. This server keeps
+everything in memory and speaks the small HTTP/JSON protocol KvClient uses:
+
+    GET    /kv/<key>                       -> {"value", "version"} | 404
+    PUT    /kv/<key>   {"value", "version", "ttl"}
+                                           -> {"version"} | 409 {"version"}
+    DELETE /kv/<key>?version=<n>           -> {"version"} | 409 {"version"}
+    GET    /scan?prefix=<p>                -> {"items": [{"key", "value", "version"}], "seq"}
+    POST   /lease/<name>  {"owner", "ttl"} -> {"expires_in"} | 409 {"owner", "expires_in"}
+    DELETE /lease/<name>?owner=<o>         -> {"released"}
+    GET    /changes?since=<seq>&timeout=<s>
+                                           -> {"seq", "changes": [{"seq", "key", "value", "version"}]}
+                                              | {"seq", "reset": true}
+
+Every write gets the next sequence number as its version. A "version" of 0
+on PUT/DELETE means "only if the key does not exist", any other number
+means "only if the key still has this version", and no version writes
+unconditionally. /changes long-polls for writes after "since"; when "since"
+has fallen out of the change history the caller must reload with /scan.
+
+    python kv_server.py --port 7380
+    python kv_server.py --port 7380 --snapshot kv.json   # keep data across restarts
+
+It is meant for local testing of multi-process setups, not as a production
+store: there is a single node and no authentication.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+
+from aiohttp import web
+
+class KvStore:
+    """Versioned keys with optional expiry, named leases and a bounded change log."""
+    def __init__(self, history=10000):
+        self.items = {}
+        self.leases = {}
+        self.seq = 0
+        self.history = collections.deque(maxlen=history)
+        self.trimmed_through = 0
+        self._changed = None
+
+    def _get_changed(self):
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        return self._changed
+
+    def _live(self, key):
+        item = self.items.get(key)
+        if item is not None and item[2] is not None and item[2] <= time.monotonic():
+            del self.items[key]
+            return None
+        return item
+
+    def _record(self, key, value, version):
+        if len(self.history) == self.history.maxlen:
+            self.trimmed_through = self.history[0]["seq"]
+        self.history.append({"seq": version, "key": key, "value": value, "version": version})
+        asyncio.get_running_loop().create_task(self._notify())
+
+    async def _notify(self):
+        condition = self._get_changed()
+        async with condition:
+            condition.notify_all()
+
+    def get(self, key):
+        return self._live(key)
+
+    def put(self, key, value, expected=None, ttl=None):
+        current = self._live(key)
+        current_version = current[1] if current else 0
+        if expected is not None and expected != current_version:
+            return False, current_version
+        self.seq += 1
+        self.items[key] = [value, self.seq, time.monotonic() + ttl if ttl else None]
+        if not ttl:
+            self._record(key, value, self.seq)
+        return True, self.seq
+
+    def delete(self, key, expected=None):
+        current = self._live(key)
+        current_version = current[1] if current else 0
+        if expected is not None and expected != current_version:
+            return False, current_version
+        if current is None:
+            return True, 0
+        del self.items[key]
+        self.seq += 1
+        if current[2] is None:
+            self._record(key, None, self.seq)
+        return True, self.seq
+
+    def scan(self, prefix):
+        return [(key, item[0], item[1]) for key in sorted(self.items) if key.startswith(prefix) for item in [self._live(key)] if item]
+
+    def acquire(self, name, owner, ttl):
+        now = time.monotonic()
+        holder = self.leases.get(name)
+        if holder and holder[0] != owner and holder[1] > now:
+            return False, holder
+        self.leases[name] = (owner, now + ttl)
+        return True, self.leases[name]
+
+    def release(self, name, owner):
+        holder = self.leases.get(name)
+        if holder and holder[0] == owner:
+            del self.leases[name]
+            return True
+        return False
+
+    def changes_since(self, since):
+        if since is None:
+            return {"seq": self.seq, "changes": []}
+        if since < self.trimmed_through:
+            return {"seq": self.seq, "reset": True}
+        return {"seq": self.seq, "changes": [change for change in self.history if change["seq"] > since]}
+
+    async def wait_for_changes(self, since, timeout):
+        if since is None or self.seq > since or timeout <= 0:
+            return
+        condition = self._get_changed()
+        async with condition:
+            try:
+                await asyncio.wait_for(condition.wait_for(lambda: self.seq > since), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def load(self, filename):
+        with open(filename, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        self.seq = self.trimmed_through = int(data.get("seq", 0))
+        self.items = {key: [value, version, None] for key, (value, version) in data.get("items", {}).items()}
+
+    def save(self, filename):
+        temp_filename = f"{filename}.tmp"
+        with open(temp_filename, "w", encoding="utf-8") as f:
+            json.dump({"seq": self.seq, "items": {key: [item[0], item[1]] for key, item in self.items.items() if item[2] is None}}, f, ensure_ascii=False)
+        os.replace(temp_filename, filename)
+
+def _version_param(request):
+    raw = request.query.get("version")
+    return int(raw) if raw not in (None, "") else None
+
+def build_app(store):
+    routes = web.RouteTableDef()
+
+    @routes.get("/kv/{key:.+}")
+    async def get_key(request):
+        item = store.get(request.match_info["key"])
+        if item is None:
+            return web.json_response({"version": 0}, status=404)
+        return web.json_response({"value": item[0], "version": item[1]})
+
+    @routes.put("/kv/{key:.+}")
+    async def put_key(request):
+        body = await request.json()
+        ok, version = store.put(request.match_info["key"], body.get("value"), body.get("version"), body.get("ttl"))
+        return web.json_response({"version": version}, status=200 if ok else 409)
+
+    @routes.delete("/kv/{key:.+}")
+    async def delete_key(request):
+        ok, version = store.delete(request.match_info["key"], _version_param(request))
+        return web.json_response({"version": version}, status=200 if ok else 409)
+
+    @routes.get("/scan")
+    async def scan(request):
+        items = [{"key": key, "value": value, "version": version} for key, value, version in store.scan(request.query.get("prefix", ""))]
+        return web.json_response({"items": items, "seq": store.seq})
+
+    @routes.post("/lease/{name:.+}")
+    async def acquire(request):
+        body = await request.json()
+        ok, holder = store.acquire(request.match_info["name"], body["owner"], float(body.get("ttl", 15)))
+        return web.json_response({"owner": holder[0], "expires_in": round(holder[1] - time.monotonic(), 3)}, status=200 if ok else 409)
+
+    @routes.delete("/lease/{name:.+}")
+    async def release(request):
+        return web.json_response({"released": store.release(request.match_info["name"], request.query.get("owner"))})
+
+    @routes.get("/changes")
+    async def changes(request):
+        since = request.query.get("since")
+        since = int(since) if since not in (None, "") else None
+        await store.wait_for_changes(since, min(float(request.query.get("timeout", 0)), 60.0))
+        return web.json_response(store.changes_since(since))
+
+    app = web.Application()
+    app.add_routes(routes)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for Ticket.py's shared key-value service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7380)
+    parser.add_argument("--snapshot", help="load keys from this file at start and save them on shutdown")
+    parser.add_argument("--history", type=int, default=10000, help="changes kept for /changes before callers must rescan")
+    args = parser.parse_args()
+
+    store = KvStore(history=args.history)
+    if args.snapshot and os.path.exists(args.snapshot):
+        store.load(args.snapshot)
+        print(f"📂 Loaded {len(store.items)} keys from {args.snapshot}.")
+    app = build_app(store)
+    if args.snapshot:
+        async def save_snapshot(app):
+            store.save(args.snapshot)
+            print(f"💾 Saved {len(store.items)} keys to {args.snapshot}.")
+        app.on_shutdown.append(save_snapshot)
+    print(f"🗄️ Key-value stand-in listening on http://{args.host}:{args.port}")
+    web.run_app(app, host=args.host, port=args.port, print=None, access_log=None)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import json
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope="session")
+def Ticket(tmp_path_factory):
+    # Ticket.py reads config.json from the working directory at import time.
+    workdir = tmp_path_factory.mktemp("ticket")
+    (workdir / "config.json").write_text(json.dumps({"bot_token": "test", "guild_id": 1, "active_categories": {}}), encoding="utf-8")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        import Ticket
+        yield Ticket
+    finally:
+        sys.path.remove(REPO_DIR)
+        os.chdir(cwd)
+
+@pytest.fixture(scope="session")
+def kv_server():
+    sys.path.insert(0, REPO_DIR)
+    try:
+        import kv_server
+        yield kv_server
+    finally:
+        sys.path.remove(REPO_DIR)
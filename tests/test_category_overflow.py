@@ -0,0 +1,115 @@
+"""Slot accounting of CategoryOverflow and the ChannelPool refills that go through it."""
+import asyncio
+import itertools
+import json
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+def make_category_class():
+    class FakeCategory(discord.CategoryChannel):
+        text_channels = property(lambda self: self._members)
+        channels = property(lambda self: self._members)
+        overwrites = property(lambda self: {})
+
+        def __init__(self, category_id, name):
+            self.id = category_id
+            self.name = name
+            self._members = []
+    return FakeCategory
+
+class FakeGuild:
+    id = 1
+
+    def __init__(self, category_class):
+        self.category_class = category_class
+        self.ids = itertools.count(1000)
+        self.objects = {}
+        self.default_role = object()
+        self.me = object()
+        self.created_categories = 0
+
+    def add_category(self, category_id, name="Support"):
+        category = self.objects[category_id] = self.category_class(category_id, name)
+        return category
+
+    def get_channel(self, channel_id):
+        return self.objects.get(channel_id)
+
+    async def create_category(self, name, overwrites, reason):
+        await asyncio.sleep(0.01)
+        self.created_categories += 1
+        return self.add_category(next(self.ids), name)
+
+    async def create_text_channel(self, name, overwrites, category, topic, reason):
+        await asyncio.sleep(0)
+        channel = SimpleNamespace(id=next(self.ids), category_id=category.id, topic=topic)
+        self.objects[channel.id] = channel
+        category._members.append(channel)
+        return channel
+
+@pytest.fixture
+def world(Ticket, tmp_path):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({"active_categories": {"support": {"name": "Support", "category_id": 10, "archive_category_id": 20, "pool_size": 3, "pool_refill_interval": 0.01}}}), encoding="utf-8")
+    config_cache = Ticket.ConfigCache(str(config_file))
+    config_cache.reload()
+    guild = FakeGuild(make_category_class())
+    guild.add_category(10)
+    guild.add_category(20, "Archive")
+    return Ticket.CategoryOverflow(config_cache, limit=2), guild
+
+def test_reservations_count_until_released_and_channels_count_once(world):
+    overflow, guild = world
+
+    async def main():
+        first = await overflow.acquire(guild, "support", "active")
+        second = await overflow.acquire(guild, "support", "active")
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first.id == second.id == 10
+    assert overflow.count(10) == 2
+    overflow.channel_added(10, 500)
+    overflow.channel_added(10, 500)
+    overflow.release(10)
+    assert overflow.count(10) == 2
+    overflow.channel_removed(10, 500)
+    overflow.release(10)
+    assert overflow.count(10) == 0
+
+def test_concurrent_acquires_share_one_new_overflow_category(world):
+    overflow, guild = world
+    overflow.channel_added(10, 500)
+
+    async def main():
+        return await asyncio.gather(*(overflow.acquire(guild, "support", "active") for _ in range(3)))
+
+    categories = asyncio.run(main())
+    chain = overflow.chain_ids("support", "active")
+    assert guild.created_categories == 1 and len(chain) == 2
+    assert sorted(category.id for category in categories) == [chain[0], chain[1], chain[1]]
+    assert overflow.count(chain[0]) == 2 and overflow.count(chain[1]) == 2
+
+def test_archive_chain_is_accounted_separately(world):
+    overflow, guild = world
+
+    async def main():
+        return await overflow.acquire(guild, "support", "archive")
+
+    assert asyncio.run(main()).id == 20
+    assert overflow.count(20) == 1 and overflow.count(10) == 0
+
+def test_pool_refill_spills_into_an_overflow_category(Ticket, world):
+    overflow, guild = world
+    pool = Ticket.ChannelPool(overflow)
+
+    async def main():
+        await pool._refill(guild, "support", overflow.config_cache.get().categories["support"])
+
+    asyncio.run(main())
+    chain = overflow.chain_ids("support", "active")
+    assert pool.stats() == {"support": 3}
+    assert len(chain) == 2
+    assert overflow.count(chain[0]) == 2 and overflow.count(chain[1]) == 1
@@ -0,0 +1,45 @@
+"""Compare-and-set, leases and the change feed of the kv_server.py stand-in."""
+import asyncio
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_put_and_delete_are_compare_and_set(kv_server):
+    async def main():
+        store = kv_server.KvStore()
+        assert store.put("config/1", {"a": 1}, expected=0) == (True, 1)
+        assert store.put("config/1", {"a": 2}, expected=0) == (False, 1)
+        assert store.put("config/1", {"a": 2}, expected=1) == (True, 2)
+        assert store.put("config/1", {"a": 3}, expected=1) == (False, 2)
+        assert store.delete("config/1", expected=1) == (False, 2)
+        assert store.delete("config/1", expected=2) == (True, 3)
+        assert store.get("config/1") is None
+        assert store.put("config/1", {"a": 4}) == (True, 4)
+        await asyncio.sleep(0)
+
+    run(main())
+
+def test_lease_is_exclusive_until_released_or_expired(kv_server):
+    store = kv_server.KvStore()
+    assert store.acquire("lock/user:1", "a", 30)[0]
+    assert store.acquire("lock/user:1", "a", 30)[0]
+    ok, holder = store.acquire("lock/user:1", "b", 30)
+    assert not ok and holder[0] == "a"
+    assert not store.release("lock/user:1", "b")
+    assert store.release("lock/user:1", "a")
+    assert store.acquire("lock/user:1", "b", 0.0)[0]
+    assert store.acquire("lock/user:1", "a", 30)[0]
+
+def test_change_feed_reports_writes_and_asks_for_a_rescan_when_trimmed(kv_server):
+    async def main():
+        store = kv_server.KvStore(history=2)
+        for i in range(3):
+            store.put(f"tickets/1/{i}", {"user_id": i})
+        store.put("lock-like", 1, ttl=5)
+        await asyncio.sleep(0)
+        return store
+
+    store = run(main())
+    assert [change["key"] for change in store.changes_since(1)["changes"]] == ["tickets/1/1", "tickets/1/2"]
+    assert store.changes_since(0).get("reset")
+    assert store.changes_since(None) == {"seq": 4, "changes": []}
@@ -0,0 +1,91 @@
+"""KeyedLocks exclusivity and how LeaseLocks reports a lease lost while held."""
+import asyncio
+
+import pytest
+
+class FakeKv:
+    """Grants each lease request while grants last; every later request (a renewal) is refused."""
+    def __init__(self, grants=10 ** 6):
+        self.grants = grants
+        self.released = []
+
+    def acquire(self, name, owner, ttl):
+        self.grants -= 1
+        return self.grants >= 0
+
+    def release(self, name, owner):
+        self.released.append(name)
+        return True
+
+def test_keyed_locks_serialize_one_key_only(Ticket):
+    locks = Ticket.KeyedLocks()
+    events = []
+
+    async def worker(key, label):
+        async with locks.hold(key) as lease:
+            events.append(f"{label}+")
+            await asyncio.sleep(0.01)
+            lease.check()
+            events.append(f"{label}-")
+
+    async def main():
+        await asyncio.gather(worker("a", "a1"), worker("a", "a2"), worker("b", "b1"))
+
+    asyncio.run(main())
+    assert events.index("a1-") < events.index("a2+")
+    assert events.index("b1+") < events.index("a1-")
+    assert len(locks) == 0
+
+def test_lost_lease_raises_at_the_next_check_without_interrupting_the_holder(Ticket):
+    kv = FakeKv(grants=1)
+    locks = Ticket.LeaseLocks(kv, "owner", ttl=0.15)
+    flushed = []
+    steps = []
+
+    async def flush():
+        flushed.append(True)
+
+    async def main():
+        async with locks.hold(("channel", 7), before_release=flush) as lease:
+            lease.check()
+            await asyncio.sleep(0.1)
+            steps.append("slept")
+            assert lease.lost
+            lease.check()
+            steps.append("after check")
+
+    with pytest.raises(Ticket.LeaseLost):
+        asyncio.run(main())
+    assert steps == ["slept"]
+    assert flushed == [True]
+    assert kv.released == ["lock/channel:7"]
+    assert len(locks) == 0
+
+def test_renewed_lease_stays_valid(Ticket):
+    kv = FakeKv()
+    locks = Ticket.LeaseLocks(kv, "owner", ttl=0.15)
+
+    async def main():
+        async with locks.hold("user") as lease:
+            await asyncio.sleep(0.2)
+            lease.check()
+            return lease.lost
+
+    assert asyncio.run(main()) is False
+    assert kv.released == ["lock/user"]
+
+def test_lease_is_acquired_after_the_other_holder_releases(Ticket):
+    kv = FakeKv(grants=0)
+    locks = Ticket.LeaseLocks(kv, "owner", ttl=1.0)
+
+    async def main():
+        async def free_later():
+            await asyncio.sleep(0.1)
+            kv.grants = 10
+        releaser = asyncio.get_running_loop().create_task(free_later())
+        async with locks.hold("section") as lease:
+            lease.check()
+        await releaser
+
+    asyncio.run(main())
+    assert kv.released == ["lock/section"]
@@ -0,0 +1,35 @@
+"""Full-text search over indexed ticket transcripts (TicketSearchIndex)."""
+import gzip
+import json
+
+def write_transcript(path, *messages):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for author, text in messages:
+            f.write(json.dumps({"n": author, "c": text, "t": "2024-01-01T00:00:00"}) + "\n")
+
+def test_indexed_transcripts_are_searchable_and_reindexing_replaces_them(Ticket, tmp_path):
+    index = Ticket.TicketSearchIndex(str(tmp_path / "search.db"))
+    transcript = tmp_path / "11.jsonl.gz"
+    write_transcript(transcript, ("alice", "my refund has not arrived"), ("staff", "checking the invoice now"))
+    assert index.index_ticket(11, {"user_id": 5, "category_key": "billing"}, 1700000000.0, str(transcript)) == 2
+    write_transcript(tmp_path / "12.jsonl.gz", ("bob", "the refund button is broken"))
+    index.index_ticket(12, {"user_id": 6, "category_key": "bugs"}, 1700000100.0, str(tmp_path / "12.jsonl.gz"))
+
+    assert sorted(hit["channel_id"] for hit in index.search("refund")) == ["11", "12"]
+    assert [hit["channel_id"] for hit in index.search("refund", category_key="billing")] == ["11"]
+    assert [hit["channel_id"] for hit in index.search(user_id=6)] == ["12"]
+    assert "**invoice**" in index.search("invoice")[0]["snippet"]
+
+    write_transcript(transcript, ("alice", "never mind, it arrived"))
+    assert index.index_ticket(11, {}, None, str(transcript)) == 1
+    assert index.search("invoice") == []
+    assert index.search(user_id=5)[0]["category_key"] == "billing"
+    assert index.indexed_channel_ids() == {"11", "12"}
+    index.close()
+
+def test_quotes_in_queries_are_taken_literally(Ticket, tmp_path):
+    index = Ticket.TicketSearchIndex(str(tmp_path / "search.db"))
+    write_transcript(tmp_path / "1.jsonl.gz", ("alice", 'error "E42" on login'))
+    index.index_ticket(1, {"user_id": 1}, None, str(tmp_path / "1.jsonl.gz"))
+    assert [hit["channel_id"] for hit in index.search('"E42')] == ["1"]
+    index.close()
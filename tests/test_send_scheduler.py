@@ -0,0 +1,72 @@
+"""Ordering and per-route rate limiting of the outbound SendScheduler."""
+import asyncio
+import time
+
+from yarl import URL
+
+def test_items_queued_together_are_sent_by_priority_then_in_order(Ticket):
+    scheduler = Ticket.SendScheduler(route_rate=100, global_rate=100)
+    sent = []
+
+    def factory(label):
+        async def send():
+            sent.append(label)
+            return label
+        return send
+
+    async def main():
+        items = [
+            (Ticket.PRIORITY_NOTIFY, "notify-1"), (Ticket.PRIORITY_RELAY, "relay-1"), (Ticket.PRIORITY_INTERACTION, "interaction-1"),
+            (Ticket.PRIORITY_RELAY, "relay-2"), (Ticket.PRIORITY_NOTIFY, "notify-2"), (Ticket.PRIORITY_INTERACTION, "interaction-2")
+        ]
+        return await asyncio.gather(*(scheduler.submit(f"channel:{i}", factory(label), priority) for i, (priority, label) in enumerate(items)))
+
+    results = asyncio.run(main())
+    assert results == ["notify-1", "relay-1", "interaction-1", "relay-2", "notify-2", "interaction-2"]
+    assert sent == ["interaction-1", "interaction-2", "relay-1", "relay-2", "notify-1", "notify-2"]
+    assert scheduler.stats()["relay"]["sent"] == 2
+
+def test_a_throttled_route_does_not_hold_up_other_routes(Ticket):
+    scheduler = Ticket.SendScheduler(route_rate=1, route_per=0.3, global_rate=100)
+    finished = {}
+
+    async def send(label):
+        finished[label] = time.monotonic()
+
+    async def main():
+        started = time.monotonic()
+        await asyncio.gather(
+            scheduler.submit("channel:1", lambda: send("busy-1")),
+            scheduler.submit("channel:1", lambda: send("busy-2")),
+            scheduler.submit("channel:2", lambda: send("other"))
+        )
+        return started
+
+    started = asyncio.run(main())
+    assert finished["busy-1"] - started < 0.1
+    assert finished["other"] - started < 0.1
+    assert finished["busy-2"] - started >= 0.25
+
+def test_errors_reach_the_submitter(Ticket):
+    scheduler = Ticket.SendScheduler()
+
+    async def fail():
+        raise ValueError("boom")
+
+    async def main():
+        try:
+            await scheduler.submit("channel:1", fail)
+        except ValueError as e:
+            return str(e)
+
+    assert asyncio.run(main()) == "boom"
+
+def test_rate_limits_from_the_http_trace_penalize_the_channel_bucket(Ticket):
+    scheduler = Ticket.SendScheduler(route_rate=5, route_per=5.0)
+    scheduler._bucket("channel:42").reserve()
+    scheduler.note_rate_limit(URL("https://discord.com/api/v10/channels/42/messages"), 2.0)
+    scheduler.note_rate_limit(URL("https://discord.com/api/v10/channels/42/messages/7/reactions/x/@me"), 2.0)
+    scheduler.note_rate_limit(URL("https://discord.com/api/v10/guilds/1/channels"), 2.0)
+    assert scheduler.rate_limited == 1
+    assert scheduler._bucket("channel:42").reserve() >= 2.0
+    assert scheduler._bucket("channel:43").reserve() == 0.0
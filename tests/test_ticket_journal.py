@@ -0,0 +1,17 @@
+"""Crash-safety checks for the JSON ticket journal (JsonTicketBackend with journal_file)."""
+
+def test_torn_journal_tail_is_dropped_before_next_append(Ticket, tmp_path):
+    snapshot, journal = str(tmp_path / "tickets.json"), str(tmp_path / "tickets.journal")
+    backend = Ticket.JsonTicketBackend(snapshot, journal_file=journal)
+    assert backend.write([("set", "1", {"user_id": 1}, None, None)])
+    with open(journal, "ab") as f:
+        f.write(b'{"op":"set","key":"2","val')  # crash in the middle of the second append
+
+    backend = Ticket.JsonTicketBackend(snapshot, journal_file=journal)
+    assert backend.load() == {"1": {"user_id": 1}}
+    assert backend.write([("set", "3", {"user_id": 3}, None, None)])
+
+    reloaded = Ticket.JsonTicketBackend(snapshot, journal_file=journal)
+    assert reloaded.load() == {"1": {"user_id": 1}, "3": {"user_id": 3}}
+    with open(journal, "rb") as f:
+        assert f.read().count(b"\n") == 2